@@ -1,15 +1,50 @@
-from flask import Flask, request, render_template, send_file, jsonify
+from flask import Flask, request, render_template, jsonify
 import os
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 import socket
+import time
+import multipart_stream
+import resumable
+import http_range
+import file_index
+import integrity
+import chunk_store
+import batch
+import media_cache
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 * 1024  # 16GB max-limit
+app.config['UPLOAD_WRITE_BUFFER'] = 4 * 1024 * 1024  # 上传写盘缓冲区
+# 上传的文件按内容分块去重保存在 uploads/.store 下，设为 0 时恢复为每个文件单独保存
+app.config['DEDUP_STORE'] = os.environ.get('EREVENT_DEDUP_STORE', '1') != '0'
 
 # 确保上传目录存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# 去重存储，未启用时为 None
+store = chunk_store.ChunkStore(os.path.join(app.config['UPLOAD_FOLDER'], '.store')) if app.config['DEDUP_STORE'] else None
+
+# 分块上传会话，未完成的数据保存在 uploads/.partial 下；启用去重存储时分块边收边写进存储
+uploads = resumable.ResumableUploads(app.config['UPLOAD_FOLDER'], store=store)
+
+# 文件列表索引，页面加载不再逐个 stat 文件
+files_index = file_index.FileIndex(app.config['UPLOAD_FOLDER'], extra=store)
+files_index.start_watcher()
+
+def open_upload(filename):
+    # 以只读文件对象打开上传目录中的文件，去重存储中的文件按清单拼接
+    manifest = store.get(filename) if store is not None else None
+    if manifest is not None:
+        return chunk_store.ManifestReader(store, manifest)
+    return open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'rb')
+
+# 文件浏览用的元数据和缩略图，上传完成后在后台计算，保存在 uploads/.meta 下
+media = media_cache.MediaCache(app.config['UPLOAD_FOLDER'], open_upload, files_index.get)
+# /meta、/thumb 等待后台计算结果的最长时间（秒），超时返回 202
+app.config['MEDIA_WAIT'] = 2
+
 def get_local_ip():
     try:
         # 获取本机IP地址
@@ -21,19 +56,44 @@ def get_local_ip():
     except:
         return '127.0.0.1'
 
+def list_files():
+    # 从索引中取一页文件，参数: page, per_page, sort(name/size/mtime), order(asc/desc)
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(500, max(1, request.args.get('per_page', 50, type=int)))
+    sort = request.args.get('sort', 'name')
+    if sort not in file_index.SORT_KEYS:
+        sort = 'name'
+    order = 'desc' if request.args.get('order') == 'desc' else 'asc'
+    entries, total = files_index.page(page, per_page, sort, reverse=order == 'desc')
+    files = [{
+        'name': entry.name,
+        'size': entry.size,
+        'size_formatted': format_size(entry.size),
+        'mtime': entry.mtime,
+        'etag': http_range.make_etag(entry.size, entry.mtime),
+        'thumbnail': media.thumbnail_candidate(entry.name)
+    } for entry in entries]
+    return {
+        'files': files,
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'pages': max(1, -(-total // per_page)),
+        'sort': sort,
+        'order': order
+    }
+
 @app.route('/')
 def index():
-    files = []
-    for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        if os.path.isfile(file_path):
-            size = os.path.getsize(file_path)
-            files.append({
-                'name': filename,
-                'size': size,
-                'size_formatted': format_size(size)
-            })
-    return render_template('index.html', files=files, local_ip=get_local_ip())
+    listing = list_files()
+    store_stats = store.stats() if store is not None else None
+    if store_stats is not None:
+        store_stats['saved_formatted'] = format_size(store_stats['saved_bytes'])
+    return render_template('index.html', local_ip=get_local_ip(), store_stats=store_stats, **listing)
+
+@app.route('/api/files')
+def api_files():
+    return jsonify(list_files())
 
 def format_size(size):
     # 格式化文件大小显示
@@ -45,39 +105,337 @@ def format_size(size):
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    if 'file' not in request.files:
+    # 直接从请求流中增量解析 multipart，数据只写一次到 uploads/
+    # 可选的 X-Checksum 头（"blake2b:<hex>"）为整个文件的摘要，见 integrity.ChunkHasher
+    start = time.perf_counter()
+    filename = None
+    file_path = None
+    out = None
+    writer = None
+    size = 0
+    try:
+        expected = integrity.parse_header(request.headers.get('X-Checksum'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    hasher = integrity.ChunkHasher(expected[0] if expected else integrity.DEFAULT_ALGORITHM)
+    try:
+        for event in multipart_stream.iter_events(request.stream, request.content_type):
+            if event[0] == 'file' and event[1] == 'file' and filename is None:
+                filename = secure_filename(event[2] or '')
+                if not filename:
+                    return jsonify({'error': '没有选择文件'}), 400
+                if store is not None:
+                    writer = store.writer()
+                    out = writer
+                else:
+                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                    out = open(file_path, 'wb', buffering=app.config['UPLOAD_WRITE_BUFFER'])
+            elif event[0] == 'data' and out is not None:
+                out.write(event[1])
+                hasher.update(event[1])
+                size += len(event[1])
+            elif event[0] == 'end' and out is not None:
+                if writer is None:
+                    out.flush()
+                    os.fsync(out.fileno())
+                    out.close()
+                out = None
+    except multipart_stream.MultipartError as e:
+        if writer is not None:
+            writer.abort()
+        return jsonify({'error': str(e)}), 400
+    finally:
+        if out is not None:
+            # 上传中断，删除不完整的文件
+            if writer is not None:
+                writer.abort()
+            else:
+                out.close()
+                os.remove(file_path)
+
+    if filename is None:
         return jsonify({'error': '没有文件被上传'}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': '没有选择文件'}), 400
-    
-    if file:
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-        size = os.path.getsize(file_path)
-        return jsonify({
-            'message': '文件上传成功',
-            'filename': filename,
-            'size': size,
-            'size_formatted': format_size(size)
-        })
+    hasher.finish()
+    if expected and expected[1] != hasher.file_digest():
+        if writer is not None:
+            writer.abort()
+        else:
+            os.remove(file_path)
+        return jsonify({'error': '文件校验失败，请重新上传'}), 422
+    if writer is not None:
+        try:
+            writer.commit(filename)
+        except chunk_store.StoreError as e:
+            writer.abort()
+            return jsonify({'error': e.message}), e.status
+        replace_plain_file(filename)
+    files_index.add(filename)
+    # 上传时已经算好了整个文件的摘要，后台不必再读一遍
+    media.schedule(filename, checksum=hasher.describe())
+
+    elapsed = time.perf_counter() - start
+    return jsonify({
+        'message': '文件上传成功',
+        'filename': filename,
+        'size': size,
+        'size_formatted': format_size(size),
+        'elapsed': round(elapsed, 3),
+        'bytes_per_second': int(size / elapsed) if elapsed > 0 else size,
+        'checksum': hasher.describe()
+    })
+
+@app.route('/upload/init', methods=['POST'])
+def init_chunked_upload():
+    data = request.json or {}
+    try:
+        session = uploads.init(
+            data.get('filename'),
+            data.get('size'),
+            chunk_size=data.get('chunk_size'),
+            key=data.get('key')
+        )
+    except resumable.UploadError as e:
+        return jsonify({'error': e.message}), e.status
+    return jsonify(session.to_dict())
+
+@app.route('/upload/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    try:
+        session = uploads.get(upload_id)
+    except resumable.UploadError as e:
+        return jsonify({'error': e.message}), e.status
+    return jsonify(session.to_dict())
+
+@app.route('/upload/<upload_id>/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    # 可选的 X-Chunk-Checksum 头为该分块的摘要，不匹配时返回 422，只需重传这一块
+    try:
+        expected = integrity.parse_header(request.headers.get('X-Chunk-Checksum'))
+        session, digest = uploads.write_chunk(upload_id, index, request.stream, expected)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except resumable.UploadError as e:
+        return jsonify({'error': e.message}), e.status
+    return jsonify({
+        'index': index,
+        'checksum': digest,
+        'received_chunks': len(session.received),
+        'offset': session.confirmed_offset
+    })
+
+@app.route('/upload/<upload_id>/finalize', methods=['POST'])
+def finalize_chunked_upload(upload_id):
+    try:
+        session, file_path = uploads.finalize(upload_id)
+    except resumable.UploadError as e:
+        return jsonify({'error': e.message}), e.status
+    if file_path is None:
+        # 已经提交到去重存储
+        replace_plain_file(session.filename)
+    files_index.add(session.filename)
+    media.schedule(session.filename)
+    return jsonify({
+        'message': '文件上传成功',
+        'filename': session.filename,
+        'size': session.size,
+        'size_formatted': format_size(session.size)
+    })
+
+@app.route('/upload/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    try:
+        uploads.abort(upload_id)
+    except resumable.UploadError as e:
+        return jsonify({'error': e.message}), e.status
+    return jsonify({'message': '上传已取消'})
+
+class UploadSink:
+    # 批量上传的解包目标：上传目录是平的，相对路径中的 / 变成 _（a/b.txt -> a_b.txt）
+    def __init__(self):
+        self.files = []
+
+    def make_dir(self, path, mtime, mode):
+        pass
+
+    def save(self, path, chunks, size, mtime, mode):
+        filename = secure_filename(path)
+        if not filename:
+            raise batch.BatchError(f'无效的文件名: {path!r}')
+        if store is not None:
+            writer = store.writer()
+            try:
+                for chunk in chunks:
+                    writer.write(chunk)
+                writer.commit(filename, mtime)
+            except BaseException:
+                writer.abort()
+                raise
+            replace_plain_file(filename)
+        else:
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            with open(file_path, 'wb', buffering=app.config['UPLOAD_WRITE_BUFFER']) as out:
+                for chunk in chunks:
+                    out.write(chunk)
+            os.utime(file_path, (mtime, mtime))
+        files_index.add(filename)
+        media.schedule(filename)
+        self.files.append(filename)
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    # 一次请求上传整个目录，请求体为 batch 数据流（见 batch.py），边接收边解包
+    start = time.perf_counter()
+    sink = UploadSink()
+    try:
+        result = batch.extract(request.stream, sink)
+    except (batch.BatchError, chunk_store.StoreError, ValueError) as e:
+        # 已经完整收到的文件保留，客户端可以只重传剩下的
+        if isinstance(e, chunk_store.StoreError):
+            return jsonify({'error': e.message, 'saved': len(sink.files)}), e.status
+        return jsonify({'error': str(e), 'saved': len(sink.files)}), 400
+    elapsed = time.perf_counter() - start
+    return jsonify({
+        'message': '文件上传成功',
+        'count': result['count'],
+        'size': result['size'],
+        'size_formatted': format_size(result['size']),
+        'elapsed': round(elapsed, 3)
+    })
+
+def replace_plain_file(filename):
+    # 去重存储中的文件覆盖上传目录里的同名普通文件
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if os.path.isfile(file_path):
+        os.remove(file_path)
+
+@app.route('/api/store/check', methods=['POST'])
+def store_check():
+    # 请求体 {"chunks": [sha256, ...]}，返回服务器还没有的分块，客户端只需上传这些
+    if store is None:
+        return jsonify({'error': '未启用去重存储'}), 404
+    digests = (request.json or {}).get('chunks')
+    if not isinstance(digests, list) or len(digests) > chunk_store.MAX_CHECK:
+        return jsonify({'error': '参数无效'}), 400
+    return jsonify({'missing': store.missing(digests)})
+
+@app.route('/api/store/chunk/<digest>', methods=['PUT'])
+def store_put_chunk(digest):
+    if store is None:
+        return jsonify({'error': '未启用去重存储'}), 404
+    try:
+        created = store.put_chunk(digest, request.stream)
+    except chunk_store.StoreError as e:
+        return jsonify({'error': e.message}), e.status
+    return jsonify({'chunk': digest, 'created': created})
+
+@app.route('/api/store/commit', methods=['POST'])
+def store_commit():
+    # 请求体 {"filename", "size", "chunks": [sha256, ...]}，分块按 chunk_size 依次排列；
+    # 还有分块未上传时返回 409 和缺少的分块列表
+    if store is None:
+        return jsonify({'error': '未启用去重存储'}), 404
+    data = request.json or {}
+    try:
+        manifest = store.commit(data.get('filename'), data.get('size'), data.get('chunks'))
+    except chunk_store.StoreError as e:
+        body = {'error': e.message}
+        if e.status == 409:
+            body['missing'] = store.missing(data['chunks'])
+        return jsonify(body), e.status
+    replace_plain_file(manifest.name)
+    files_index.add(manifest.name)
+    media.schedule(manifest.name)
+    return jsonify({
+        'message': '文件上传成功',
+        'filename': manifest.name,
+        'size': manifest.size,
+        'size_formatted': format_size(manifest.size)
+    })
+
+@app.route('/api/store/stats')
+def store_stats():
+    if store is None:
+        return jsonify({'enabled': False})
+    stats = store.stats()
+    stats['enabled'] = True
+    stats['saved_formatted'] = format_size(stats['saved_bytes'])
+    return jsonify(stats)
 
 @app.route('/download/<filename>')
 def download_file(filename):
-    return send_file(
-        os.path.join(app.config['UPLOAD_FOLDER'], filename),
-        as_attachment=True
-    )
+    # 支持 Range（断点续传、分段并行下载）和 ETag/Last-Modified 条件请求
+    file_path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if file_path is None or filename.startswith('.'):
+        return jsonify({'error': '文件不存在'}), 404
+    manifest = store.get(filename) if store is not None else None
+    if manifest is not None:
+        reader = chunk_store.ManifestReader(store, manifest)
+        return http_range.send_ranges(reader, manifest.size, manifest.mtime, filename)
+    if not os.path.isfile(file_path):
+        return jsonify({'error': '文件不存在'}), 404
+    return http_range.send_path(file_path, filename)
 
 @app.route('/delete/<filename>', methods=['DELETE'])
 def delete_file(filename):
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    if os.path.exists(file_path):
+    file_path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if file_path is None or filename.startswith('.'):
+        return jsonify({'error': '文件不存在'}), 404
+    media.discard(files_index.get(filename))
+    if store is not None and store.delete(filename):
+        files_index.remove(filename)
+        return jsonify({'message': '文件删除成功'})
+    if os.path.isfile(file_path):
         os.remove(file_path)
+        files_index.remove(filename)
         return jsonify({'message': '文件删除成功'})
     return jsonify({'error': '文件不存在'}), 404
 
+def media_pending():
+    response = jsonify({'status': 'pending'})
+    response.status_code = 202
+    response.headers['Retry-After'] = '1'
+    return response
+
+def media_cacheable(response, etag):
+    # 带上与文件列表相同的 ?v=<etag> 时内容不会再变，浏览器可以长期缓存，翻页返回时不再发请求
+    if request.args.get('v') == etag:
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+@app.route('/meta/<filename>')
+def file_meta(filename):
+    # MIME 类型、校验和、图片尺寸等，结果还没算好时返回 202，稍后重试
+    if filename.startswith('.'):
+        return jsonify({'error': '文件不存在'}), 404
+    entry, meta = media.get(filename, wait=app.config['MEDIA_WAIT'])
+    if entry is None:
+        return jsonify({'error': '文件不存在'}), 404
+    if meta is None:
+        return media_pending()
+    etag = http_range.make_etag(entry.size, entry.mtime)
+    response = jsonify(meta)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return media_cacheable(response.make_conditional(request), etag)
+
+@app.route('/thumb/<filename>')
+def file_thumb(filename):
+    if filename.startswith('.'):
+        return jsonify({'error': '文件不存在'}), 404
+    entry, meta = media.get(filename, wait=app.config['MEDIA_WAIT'])
+    if entry is None:
+        return jsonify({'error': '文件不存在'}), 404
+    if meta is None:
+        return media_pending()
+    thumb_path = media.thumb_path(entry, meta)
+    if thumb_path is None:
+        return jsonify({'error': '没有缩略图'}), 404
+    try:
+        response = http_range.send_path(thumb_path, filename, mimetype='image/jpeg', as_attachment=False)
+    except FileNotFoundError:
+        # 缩略图刚好被淘汰
+        return jsonify({'error': '没有缩略图'}), 404
+    return media_cacheable(response, http_range.make_etag(entry.size, entry.mtime))
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,465 @@
+import asyncio
+import logging
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, unquote_to_bytes
+
+# 生产环境用的 asyncio HTTP/1.1 服务器，替代 Flask 开发服务器。
+#
+# 连接（包括空闲的 keep-alive 连接和 SSE 长连接）全部由事件循环管理，
+# 不占用线程；只有正在执行的 WSGI 请求占用线程池中的一个线程，线程数即 workers。
+# 需要长时间挂起的接口（如 SSE）可以注册为原生协程路由，完全不占线程。
+#
+# 请求体按需从事件循环读取（WSGI 线程每次 read 时才从套接字取数据，自带背压），
+# 响应体逐块写回；应用使用 wsgi.file_wrapper 返回真实文件时通过 loop.sendfile 发送。
+#
+# 收到 SIGINT/SIGTERM 后不再接受新连接，关闭空闲连接和 SSE 连接，
+# 等待正在处理的请求完成（最多 SHUTDOWN_GRACE 秒），然后调用 on_shutdown
+
+DEFAULT_WORKERS = int(os.environ.get('EREVENT_WORKERS', 32))
+MAX_HEADER_SIZE = 64 * 1024
+HEADER_TIMEOUT = 10
+KEEPALIVE_TIMEOUT = 75
+WRITE_TIMEOUT = 60
+SHUTDOWN_GRACE = 10
+BACKLOG = 4096
+READ_SIZE = 1024 * 1024
+READ_AHEAD = 64 * 1024
+# 应用没有读完的请求体，剩余部分不超过该大小时读掉以保持连接，否则直接关闭连接
+MAX_DISCARD = 1024 * 1024
+
+_REASONS = {
+    100: 'Continue', 200: 'OK', 400: 'Bad Request', 408: 'Request Timeout',
+    413: 'Payload Too Large', 431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+
+class BadRequest(Exception):
+    def __init__(self, status=400):
+        super().__init__(status)
+        self.status = status
+
+
+class Body:
+    # 请求体，支持 Content-Length 和 chunked 两种方式
+    def __init__(self, reader, length=None, chunked=False):
+        self.reader = reader
+        self.remaining = length or 0
+        self.chunked = chunked
+        self.done = not chunked and not length
+        self.consumed = 0
+
+    async def read(self, size=READ_SIZE):
+        if self.done or size == 0:
+            return b''
+        if self.chunked and self.remaining == 0:
+            line = await self.reader.readline()
+            try:
+                self.remaining = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise BadRequest()
+            if self.remaining == 0:
+                # 跳过 trailer
+                while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                self.done = True
+                return b''
+        data = await self.reader.read(min(size, self.remaining))
+        if not data:
+            raise ConnectionResetError('请求体不完整')
+        self.remaining -= len(data)
+        self.consumed += len(data)
+        if self.remaining == 0:
+            if self.chunked:
+                await self.reader.readline()
+            else:
+                self.done = True
+        return data
+
+    async def discard(self, limit=MAX_DISCARD):
+        # 返回 False 表示剩余数据太多，应直接关闭连接
+        start = self.consumed
+        while await self.read():
+            if self.consumed - start > limit:
+                return False
+        return True
+
+
+class _WSGIInput:
+    # 在 WSGI 线程里读取请求体，每次 read 切换到事件循环执行
+    def __init__(self, body, loop):
+        self.body = body
+        self.loop = loop
+        self.buffer = b''
+        self.pos = 0
+
+    def _read(self, size):
+        return asyncio.run_coroutine_threadsafe(self.body.read(size), self.loop).result()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self.buffer[self.pos:]]
+            self.buffer = b''
+            self.pos = 0
+            while data := self._read(READ_SIZE):
+                parts.append(data)
+            return b''.join(parts)
+        if self.pos >= len(self.buffer):
+            if size >= READ_AHEAD:
+                return self._read(size)
+            # 小块读取（如逐帧解析）一次多取一些，减少切换到事件循环的次数
+            self.buffer = self._read(READ_AHEAD)
+            self.pos = 0
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        while b'\n' not in self.buffer and (size < 0 or len(self.buffer) < size):
+            data = self._read(READ_SIZE)
+            if not data:
+                break
+            self.buffer += data
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def __iter__(self):
+        while line := self.readline():
+            yield line
+
+
+class FileWrapper:
+    # wsgi.file_wrapper：能取到 fileno 时由服务器用 sendfile 发送，否则按块读取
+    def __init__(self, f, block_size=READ_SIZE):
+        self.file = f
+        self.block_size = block_size
+
+    def __iter__(self):
+        while data := self.file.read(self.block_size):
+            yield data
+
+    def close(self):
+        if hasattr(self.file, 'close'):
+            self.file.close()
+
+
+class Request:
+    def __init__(self, server, reader, writer, method, target, version, headers):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        path, _, self.query_string = target.partition('?')
+        self.path = unquote_to_bytes(path).decode('latin-1')
+        self.query = dict(parse_qsl(self.query_string))
+        self.body = None
+
+    def header(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    @property
+    def keep_alive(self):
+        connection = self.header('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    @property
+    def remote_addr(self):
+        peer = self.writer.get_extra_info('peername')
+        return peer[0] if peer else ''
+
+    async def read_body(self, limit=MAX_DISCARD):
+        parts = []
+        size = 0
+        while data := await self.body.read():
+            size += len(data)
+            if size > limit:
+                raise BadRequest(413)
+            parts.append(data)
+        return b''.join(parts)
+
+    async def write(self, data):
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), WRITE_TIMEOUT)
+
+    async def send_response(self, status, headers, body=b'', keep_alive=True):
+        # 原生路由使用：一次性发送完整响应
+        keep_alive = keep_alive and self.keep_alive and not self.server.closing
+        lines = [f'HTTP/1.1 {status} {_REASONS.get(status, "")}']
+        lines += [f'{name}: {value}' for name, value in headers]
+        lines.append(f'Content-Length: {len(body)}')
+        lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+        await self.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        return keep_alive
+
+
+class Server:
+    def __init__(self, app, workers=DEFAULT_WORKERS, routes=None, stream_routes=None):
+        # routes: {(method, path): async handler(request) -> keep_alive}
+        # stream_routes 中的路径是长连接，关闭服务器时不等待它们结束
+        self.app = app
+        self.workers = workers
+        self.routes = routes or {}
+        self.stream_routes = set(stream_routes or ())
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='wsgi')
+        self.closing = False
+        self.loop = None
+        # 任务 -> (writer, 状态)，状态为 idle / active / stream
+        self.connections = {}
+        self.host = None
+        self.port = None
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = (writer, 'idle')
+        first = True
+        try:
+            while not self.closing:
+                try:
+                    request = await self._read_request(reader, writer, HEADER_TIMEOUT if first else KEEPALIVE_TIMEOUT)
+                except BadRequest as e:
+                    await self._simple_response(writer, e.status)
+                    break
+                if request is None:
+                    break
+                first = False
+                stream = request.path in self.stream_routes
+                self.connections[task] = (writer, 'stream' if stream else 'active')
+                try:
+                    keep_alive = await self._dispatch(request)
+                    if keep_alive and not await request.body.discard():
+                        keep_alive = False
+                except (BadRequest, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    keep_alive = False
+                self.connections[task] = (writer, 'idle')
+                if not keep_alive:
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logging.exception('HTTP connection error')
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
+
+    async def _read_request(self, reader, writer, timeout):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        except asyncio.LimitOverrunError:
+            raise BadRequest(431)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            return None
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            raise BadRequest()
+        if version not in ('HTTP/1.0', 'HTTP/1.1'):
+            raise BadRequest()
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise BadRequest()
+            name = name.strip().lower()
+            value = value.strip()
+            headers[name] = f'{headers[name]}, {value}' if name in headers else value
+        request = Request(self, reader, writer, method, target, version, headers)
+        chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        length = None
+        if not chunked and 'content-length' in headers:
+            try:
+                length = int(headers['content-length'])
+            except ValueError:
+                raise BadRequest()
+            if length < 0:
+                raise BadRequest()
+        request.body = Body(reader, length, chunked)
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        return request
+
+    async def _simple_response(self, writer, status):
+        body = _REASONS.get(status, '').encode()
+        writer.write(f'HTTP/1.1 {status} {_REASONS.get(status, "")}\r\nContent-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+        try:
+            await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+
+    async def _dispatch(self, request):
+        handler = self.routes.get((request.method, request.path))
+        if handler is not None:
+            return await handler(request)
+        return await self.loop.run_in_executor(self.executor, self._run_wsgi, request)
+
+    def _environ(self, request):
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': request.path,
+            'QUERY_STRING': request.query_string,
+            'SERVER_NAME': self.host or 'localhost',
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': request.version,
+            'REMOTE_ADDR': request.remote_addr,
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': _WSGIInput(request.body, self.loop),
+            'wsgi.input_terminated': request.body.chunked,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+        }
+        for name, value in request.headers.items():
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'content-length':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+        return environ
+
+    def _run_wsgi(self, request):
+        # 在线程池中执行；返回是否保持连接
+        loop = self.loop
+        state = {'status': None, 'headers': None, 'sent': False, 'chunked': False, 'keep_alive': False}
+
+        def send(data):
+            asyncio.run_coroutine_threadsafe(request.write(data), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and state['sent']:
+                raise exc_info[1].with_traceback(exc_info[2])
+            state['status'] = status
+            state['headers'] = headers
+            return write
+
+        def send_head():
+            status_code = int(state['status'].split(' ', 1)[0])
+            names = {name.lower() for name, _ in state['headers']}
+            keep_alive = request.keep_alive and not self.closing
+            lines = [f"HTTP/1.1 {state['status']}"]
+            lines += [f'{name}: {value}' for name, value in state['headers']
+                      if name.lower() not in ('connection', 'transfer-encoding')]
+            no_body = request.method == 'HEAD' or status_code in (204, 304) or status_code < 200
+            if 'content-length' not in names and not no_body:
+                if request.version == 'HTTP/1.1':
+                    state['chunked'] = True
+                    lines.append('Transfer-Encoding: chunked')
+                else:
+                    keep_alive = False
+            lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+            state['keep_alive'] = keep_alive
+            state['sent'] = True
+            return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        def write(data):
+            if not data and state['sent']:
+                return
+            head = b'' if state['sent'] else send_head()
+            if data and state['chunked']:
+                data = b'%x\r\n%b\r\n' % (len(data), data)
+            send(head + data)
+
+        try:
+            result = self.app(self._environ(request), start_response)
+        except Exception:
+            logging.exception('WSGI application error')
+            state['status'] = '500 Internal Server Error'
+            state['headers'] = [('Content-Type', 'text/plain'), ('Content-Length', '21')]
+            result = [b'Internal Server Error']
+        try:
+            if isinstance(result, FileWrapper) and self._sendfile_ok(result, state['headers']):
+                send(send_head())
+                f = result.file
+                count = int(dict((k.lower(), v) for k, v in state['headers'])['content-length'])
+                asyncio.run_coroutine_threadsafe(
+                    loop.sendfile(request.writer.transport, f, f.tell(), count), loop).result()
+            else:
+                for data in result:
+                    if data:
+                        write(data)
+                if not state['sent']:
+                    write(b'')
+            if state['chunked']:
+                send(b'0\r\n\r\n')
+        except Exception:
+            if not state['sent']:
+                logging.exception('WSGI application error')
+            return False
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return state['keep_alive']
+
+    @staticmethod
+    def _sendfile_ok(result, headers):
+        if not any(name.lower() == 'content-length' for name, _ in headers):
+            return False
+        try:
+            result.file.fileno()
+        except (AttributeError, OSError, ValueError):
+            return False
+        return True
+
+    async def serve(self, host, port, on_shutdown=None, ready=None):
+        self.loop = asyncio.get_running_loop()
+        self.host = host
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_SIZE, backlog=BACKLOG)
+        self.port = server.sockets[0].getsockname()[1]
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        self.stop = stop.set
+        logging.info(f"Serving on http://{host}:{self.port} with {self.workers} workers")
+        if ready is not None:
+            ready(self)
+        try:
+            await stop.wait()
+        finally:
+            await self.shutdown(server)
+            if on_shutdown is not None:
+                on_shutdown()
+
+    async def shutdown(self, server):
+        logging.info("Shutting down, waiting for active requests...")
+        self.closing = True
+        server.close()
+        for task, (writer, status) in list(self.connections.items()):
+            if status == 'idle':
+                writer.close()
+            elif status == 'stream':
+                task.cancel()
+        deadline = self.loop.time() + SHUTDOWN_GRACE
+        while self.connections and self.loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        for task in list(self.connections):
+            task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run(app, host='0.0.0.0', port=5000, workers=DEFAULT_WORKERS, routes=None, stream_routes=None,
+        on_shutdown=None):
+    server = Server(app, workers, routes, stream_routes)
+    asyncio.run(server.serve(host, port, on_shutdown))
@@ -0,0 +1,419 @@
+import asyncio
+import ipaddress
+import json
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+import compression
+import integrity
+import netio
+import transfer
+
+# 异步传输核心：设备间的文件传输（等待连接、读取控制头、按区间收发数据）全部在一个事件循环里进行，
+# 不再为每个传输、每个连接各开一个阻塞在 accept/recv 上的线程。
+#
+# - 协议与 transfer.py 完全相同，两端可以一端用线程实现、一端用异步实现
+# - 发送走 loop.sock_sendfile（Linux 上即 os.sendfile）；接收时 sock_recv_into 到缓冲区池中的缓冲区，
+#   再经 transfer.FileSink 写入预分配的 .part 文件（固定用 pwrite：mmap 的缺页会阻塞事件循环）
+# - 内存有界：每个正在接收的连接占用缓冲区池中的一个缓冲区，池的总大小为 MEMORY_LIMIT，
+#   用完时新的连接排队等待，而不是继续分配
+# - 可取消：任务被取消（或超过总超时）时关闭它的所有连接，接收端删除 .part 并通知发送端失败；
+#   另外单个连接超过 IDLE_TIMEOUT 没有数据也会失败
+# - 解压交给一个小线程池；增量传输请求（op=delta）仍用阻塞实现，在同一个线程池里处理
+#
+# EREVENT_EVENT_LOOP 选择事件循环：auto（默认，安装了 uvloop 就用）、uvloop、asyncio
+
+EVENT_LOOP = os.environ.get('EREVENT_EVENT_LOOP', 'auto')
+# 接收缓冲区池：单个缓冲区大小和总大小
+ASYNC_BUFFER_SIZE = 256 * 1024
+MEMORY_LIMIT = int(os.environ.get('EREVENT_TRANSFER_MEMORY', 64 * 1024 * 1024))
+# 连接发送端、单个连接无数据的超时
+CONNECT_TIMEOUT = netio.CONNECT_TIMEOUT
+IDLE_TIMEOUT = transfer.IDLE_TIMEOUT
+# 解压和阻塞操作的线程数
+BLOCKING_WORKERS = 8
+
+
+def new_event_loop(kind=EVENT_LOOP):
+    if kind == 'uvloop' or (kind == 'auto' and uvloop is not None):
+        if uvloop is None:
+            raise RuntimeError('EREVENT_EVENT_LOOP=uvloop，但没有安装 uvloop')
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+class BufferPool:
+    # 有上限的接收缓冲区池，在事件循环中使用；allocated 为实际分配过的缓冲区个数
+    def __init__(self, size=ASYNC_BUFFER_SIZE, limit=MEMORY_LIMIT):
+        self.size = size
+        self.count = max(1, limit // size)
+        self.allocated = 0
+        self._free = []
+        self._available = asyncio.Semaphore(self.count)
+
+    @asynccontextmanager
+    async def buffer(self):
+        await self._available.acquire()
+        buf = self._free.pop() if self._free else None
+        if buf is None:
+            self.allocated += 1
+            buf = bytearray(self.size)
+        try:
+            yield buf
+        finally:
+            self._free.append(buf)
+            self._available.release()
+
+
+class TransferCore:
+    def __init__(self, loop=EVENT_LOOP, memory_limit=MEMORY_LIMIT, buffer_size=ASYNC_BUFFER_SIZE):
+        self.loop = new_event_loop(loop)
+        self.buffers = BufferPool(buffer_size, memory_limit)
+        self.executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix='transfer-blocking')
+        self._thread = threading.Thread(target=self._run, name='transfer-loop', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_default_executor(self.executor)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        # 可以在任意线程中调用，返回 concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        # 在其他线程中同步等待结果，超时时取消
+        return self.submit(asyncio.wait_for(coro, timeout)).result()
+
+    async def run_blocking(self, fn, *args):
+        # 在事件循环中等待一个阻塞函数（如批量传输、增量传输）在线程池中执行完
+        return await self.loop.run_in_executor(self.executor, fn, *args)
+
+    async def _run_settled(self, fn, *args):
+        # 与 run_blocking 相同，但被取消（包括超时）时先等线程池里的调用真正结束再抛出 CancelledError：
+        # 取消只能取消 future，线程里的 pwrite 还在用缓冲区和 .part 的 fd，
+        # 调用方随后会把缓冲区还给池、关闭 .part
+        future = self.loop.run_in_executor(self.executor, fn, *args)
+        cancelled = False
+        while True:
+            try:
+                result = await asyncio.shield(future)
+                break
+            except asyncio.CancelledError:
+                if future.done():
+                    raise
+                cancelled = True
+        if cancelled:
+            raise asyncio.CancelledError()
+        return result
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=False)
+
+    # 基础读写
+
+    async def _recv_into(self, sock, view, timeout=IDLE_TIMEOUT):
+        n = await asyncio.wait_for(self.loop.sock_recv_into(sock, view), timeout)
+        if not n:
+            raise transfer.TransferError('连接意外关闭')
+        return n
+
+    async def _recv_exact(self, sock, size, timeout=IDLE_TIMEOUT):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        received = 0
+        while received < size:
+            received += await self._recv_into(sock, view[received:], timeout)
+        return bytes(buf)
+
+    async def _recv_header(self, sock, timeout=transfer.HEADER_TIMEOUT):
+        length = netio.header_length(await self._recv_exact(sock, netio.HEADER_PREFIX_SIZE, timeout))
+        return json.loads(await self._recv_exact(sock, length, timeout))
+
+    async def _send_header(self, sock, header):
+        await asyncio.wait_for(self.loop.sock_sendall(sock, netio.encode_header(header)), IDLE_TIMEOUT)
+
+    async def _connect(self, host, port):
+        try:
+            family = socket.AF_INET6 if ipaddress.ip_address(host).version == 6 else socket.AF_INET
+            addresses = [(family, (host, port))]
+        except ValueError:
+            infos = await self.loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            addresses = [(info[0], info[4]) for info in infos]
+        error = None
+        for family, address in addresses:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                await asyncio.wait_for(self.loop.sock_connect(sock, address), CONNECT_TIMEOUT)
+                return transfer.tune_socket(sock)
+            except (OSError, asyncio.TimeoutError) as e:
+                sock.close()
+                error = e
+        raise netio.ConnectError(f'无法连接发送端 {host}:{port}: {error}')
+
+    async def _sendfile(self, sock, f, offset, count, throttle):
+        # 与 transfer.send_file 相同：限速时按 THROTTLE_SLICE 分段，每段之前取令牌
+        step = netio.THROTTLE_SLICE if throttle is not None else count
+        sent = 0
+        while sent < count:
+            n = min(step, count - sent)
+            if throttle is not None:
+                await throttle(n)
+            try:
+                done = await self.loop.sock_sendfile(sock, f, offset + sent, n)
+            except NotImplementedError:
+                # 没有实现 sock_sendfile 的事件循环（如 uvloop）
+                done = await self._send_from_file(sock, f, offset + sent, n)
+            sent += done
+            if done != n:
+                break
+        if sent != count:
+            raise transfer.TransferError(f'发送不完整: {sent}/{count} 字节')
+        return sent
+
+    async def _send_from_file(self, sock, f, offset, count):
+        # 不从接收缓冲区池中取：同一进程内的发送端占满缓冲区池会让接收端无法读取
+        buf = bytearray(min(self.buffers.size, count))
+        view = memoryview(buf)
+        f.seek(offset)
+        sent = 0
+        while sent < count:
+            n = await self._run_settled(f.readinto, view[:min(len(buf), count - sent)])
+            if not n:
+                break
+            await asyncio.wait_for(self.loop.sock_sendall(sock, view[:n]), IDLE_TIMEOUT)
+            sent += n
+        return sent
+
+    # 发送端
+
+    async def serve_file(self, server_socket, path, hasher=None, pending=None, throttle=None,
+                         accept_timeout=transfer.ACCEPT_TIMEOUT, idle_timeout=transfer.IDLE_TIMEOUT):
+        # 与 transfer.serve_file 相同，只是 throttle 为协程函数（见 scheduler.Job.athrottle）。
+        # 被取消时关闭所有数据连接，调用方负责关闭监听套接字
+        server_socket.setblocking(False)
+        errors = []
+        tasks = set()
+        finished = False
+        timeout = accept_timeout
+        try:
+            while True:
+                if pending is not None:
+                    conn, header = pending
+                    pending = None
+                else:
+                    try:
+                        conn, _ = await asyncio.wait_for(self.loop.sock_accept(server_socket), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    try:
+                        header = await self._recv_header(conn)
+                    except (OSError, ValueError, asyncio.TimeoutError, transfer.TransferError) as e:
+                        # 单个连接的控制头出错不影响监听套接字
+                        conn.close()
+                        errors.append(transfer.TransferError(f'读取控制头失败: {e}'))
+                        continue
+                timeout = idle_timeout
+                if header.get('op') == 'done':
+                    conn.close()
+                    if not header.get('ok', True):
+                        errors.append(transfer.TransferError('接收端报告传输失败'))
+                    finished = True
+                    break
+                conn.setblocking(False)
+                transfer.tune_socket(conn)
+                task = self.loop.create_task(self._handle(conn, header, path, hasher, throttle, errors))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        if not finished:
+            raise transfer.TransferError(str(errors[0]) if errors else '等待接收端连接超时')
+        if errors:
+            raise transfer.TransferError(str(errors[0]))
+
+    async def _handle(self, conn, header, path, hasher, throttle, errors):
+        try:
+            with conn, open(path, 'rb') as f:
+                if header.get('op') == 'range' and not header.get('compression'):
+                    offset, length = int(header['offset']), int(header['length'])
+                    await self._sendfile(conn, f, offset, length, throttle)
+                    if header.get('checksums'):
+                        if hasher is not None:
+                            await self._send_header(
+                                conn, transfer.trailer(hasher.digests, offset, length, hasher.chunk_size))
+                        else:
+                            await self._send_header(conn, {'chunks': {}})
+                else:
+                    # 压缩和增量传输沿用阻塞实现，在线程池中处理这一个连接
+                    conn.setblocking(True)
+                    await self.loop.run_in_executor(self.executor, transfer.serve_request, conn, f, header,
+                                                    hasher, self._blocking(throttle))
+        except (OSError, ValueError, KeyError, asyncio.TimeoutError, transfer.TransferError) as e:
+            errors.append(e)
+
+    def _blocking(self, throttle):
+        # 把协程版的 throttle 包装成线程中可以调用的函数
+        if throttle is None:
+            return None
+        return lambda n: asyncio.run_coroutine_threadsafe(throttle(n), self.loop).result()
+
+    # 接收端
+
+    async def receive_file(self, host, port, path, size, streams=transfer.DEFAULT_STREAMS, checksum=None,
+                           throttle=None, codecs=None):
+        # 与 transfer.receive_file 相同（参数、返回值、.part 文件和重传），throttle 为协程函数
+        checksum = integrity.negotiate(checksum)
+        compress = compression.negotiate(codecs)
+        chunk_size = checksum['chunk_size'] if checksum else integrity.CHUNK_SIZE
+        ranges = transfer.plan_ranges(size, streams, align=chunk_size)
+        errors = []
+        bad_chunks = []
+        digests = {}
+        unverified = []
+        retransmitted = 0
+        committed = False
+        # 一个连接都没有建立时发送端不知道有这次接收，不需要通知，调用方可以换一个地址重试
+        connected = False
+        # 预分配（fallocate）可能较慢，与写盘、计算摘要一样不在事件循环里做
+        sink = await self.run_blocking(transfer.FileSink, path, size, 'pwrite', self.buffers.size)
+
+        async def fetch(offset, length):
+            # 先从缓冲区池取到缓冲区再发出请求：没有缓冲区时不读数据，发送端已经发出的数据
+            # 会堆积在双方的内核缓冲区里，所以连接也要排队
+            nonlocal connected
+            try:
+                async with self.buffers.buffer() as buf:
+                    with await self._connect(host, port) as s:
+                        connected = True
+                        header = {'op': 'range', 'offset': offset, 'length': length}
+                        hasher = None
+                        if checksum:
+                            header['checksums'] = True
+                            hasher = integrity.ChunkHasher(checksum['algorithm'], chunk_size, offset // chunk_size)
+                        if compress:
+                            header.update(compress)
+                        await self._send_header(s, header)
+                        if compress:
+                            await self._recv_compressed(s, sink, offset, length, compress['compression'], buf,
+                                                        hasher, throttle)
+                        else:
+                            await self._recv_range(s, sink, offset, length, buf, hasher, throttle)
+                        if hasher is not None:
+                            bad, missing = transfer.check_trailer(await self._recv_header(s, IDLE_TIMEOUT), hasher)
+                            bad_chunks.extend(bad)
+                            unverified.append(missing)
+                            digests.update(hasher.digests)
+            except (OSError, ValueError, asyncio.TimeoutError, transfer.TransferError) as e:
+                errors.append(e)
+
+        async def fetch_all(ranges):
+            await asyncio.gather(*(fetch(*r) for r in ranges))
+
+        try:
+            await fetch_all(ranges)
+            for _ in range(transfer.MAX_RETRANSMITS):
+                if errors or not bad_chunks:
+                    break
+                # 只重新请求校验失败的分块
+                retry = sorted(set(bad_chunks))
+                bad_chunks.clear()
+                retransmitted += len(retry)
+                await fetch_all([(i * chunk_size, min(chunk_size, size - i * chunk_size)) for i in retry])
+            if not errors and bad_chunks:
+                errors.append(transfer.TransferError(f'{len(set(bad_chunks))} 个分块多次校验失败'))
+            if not errors and checksum and checksum.get('digest'):
+                if integrity.combine((digests[i] for i in sorted(digests)), checksum['algorithm']) != checksum['digest']:
+                    errors.append(transfer.TransferError('文件整体校验失败'))
+            if not errors:
+                try:
+                    # fsync 可能较慢，不在事件循环里做
+                    await self._run_settled(sink.commit)
+                    committed = True
+                except OSError as e:
+                    errors.append(transfer.TransferError(f'保存文件失败: {e}'))
+        finally:
+            # 出错或被取消（包括超时）时删除 .part，并通知发送端结束。
+            # 走到这里时各个 fetch 都已经结束，没有仍在写 .part 的线程（见 _run_settled）
+            if not committed:
+                await self._run_settled(sink.abort)
+            if connected or not errors:
+                await self._notify_done(host, port, committed)
+        if errors and not connected and isinstance(errors[0], netio.ConnectError):
+            raise errors[0]
+        if errors:
+            raise transfer.TransferError(f'接收失败: {errors[0]}')
+        return {
+            'size': size,
+            'verified': bool(checksum) and not any(unverified),
+            'retransmitted_chunks': retransmitted,
+            'compression': compress['compression'] if compress else None
+        }
+
+    async def _recv_range(self, sock, sink, offset, length, buf, hasher, throttle):
+        view = memoryview(buf)
+        received = 0
+        while received < length:
+            n = await self._recv_into(sock, view[:min(len(buf), length - received)])
+            await self._run_settled(self._store, sink, view[:n], offset + received, hasher)
+            if throttle is not None:
+                await throttle(n)
+            received += n
+        return received
+
+    async def _recv_compressed(self, sock, sink, offset, length, codec, buf, hasher, throttle):
+        # 与 compression.recv_range 相同，解压、写盘和计算摘要在线程池中进行
+        decompress = compression.decompressor(codec)
+        received = 0
+        while received < length:
+            compressed, wire, size = compression.parse_frame(
+                await self._recv_exact(sock, compression.FRAME_SIZE), length - received)
+            if not compressed:
+                await self._recv_range(sock, sink, offset + received, size, buf, hasher, throttle)
+            else:
+                await self._run_settled(self._unpack, decompress, await self._recv_exact(sock, wire), size,
+                                        sink, offset + received, hasher)
+                if throttle is not None:
+                    await throttle(wire)
+            received += size
+        return received
+
+    @staticmethod
+    def _store(sink, data, offset, hasher):
+        # 在线程池中执行：pwrite 和计算摘要都会释放 GIL，各个传输的写盘和摘要可以在多个核上同时进行，
+        # 不会卡住事件循环上的其他传输
+        sink.write(data, offset)
+        if hasher is not None:
+            hasher.update(data)
+
+    @staticmethod
+    def _unpack(decompress, frame, size, sink, offset, hasher):
+        data = decompress(frame, size)
+        if len(data) != size:
+            raise transfer.TransferError('解压后的长度不一致')
+        TransferCore._store(sink, data, offset, hasher)
+
+    async def _notify_done(self, host, port, ok):
+        try:
+            with await self._connect(host, port) as s:
+                await self._send_header(s, {'op': 'done', 'ok': ok})
+        except (OSError, asyncio.TimeoutError, transfer.TransferError):
+            pass
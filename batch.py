@@ -0,0 +1,307 @@
+import os
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import integrity
+import transfer
+
+# 批量传输：把整个目录作为一个连续的数据流发送，代替每个文件一次请求/一次握手/一个连接。
+#
+# 数据流由若干帧组成（类似 tar，但头部更紧凑）：
+#   F + 路径长度(H) + 大小(Q) + 修改时间(d) + 权限(I) + 路径(UTF-8) + 文件数据
+#   D + 路径长度(H) + 0 + 修改时间 + 权限 + 路径                      目录（保留空目录）
+#   E + 文件数(Q) + 数据字节数(Q) + 全部文件数据的摘要(16 字节)       结束
+# 路径一律用 / 分隔，相对于所选目录。
+#
+# 发送端用线程池提前读取后面的小文件（受 PREFETCH_BYTES 限制），小帧合并到 WRITE_BUFFER 后再输出；
+# 接收端边收边解包，小文件交给写盘线程池，大文件在接收线程里直接写入
+
+PREFETCH_WORKERS = 8
+PREFETCH_BYTES = 64 * 1024 * 1024
+# 小于该大小的文件整个读入内存，由线程池预读和写盘
+SMALL_FILE = 1024 * 1024
+WRITE_BUFFER = 1024 * 1024
+WRITERS = 4
+# 接收端最多积压的待写小文件数
+MAX_PENDING_WRITES = 64
+CONTENT_TYPE = 'application/x-erevent-batch'
+ALGORITHM = 'blake2b'
+
+_ENTRY = struct.Struct('!cHQdI')
+_END = struct.Struct('!cQQ16s')
+_FILE = b'F'
+_DIR = b'D'
+_EOF = b'E'
+
+
+class BatchError(Exception):
+    pass
+
+
+class Entry:
+    __slots__ = ('kind', 'path', 'size', 'mtime', 'mode', 'source')
+
+    def __init__(self, kind, path, size, mtime, mode, source=None):
+        self.kind = kind
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.source = source
+
+
+def scan(root):
+    # 遍历目录，返回 (条目列表, 文件数, 文件总大小)；符号链接和特殊文件跳过
+    entries = []
+    count = 0
+    total = 0
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(root, rel) if rel else root) as it:
+            items = sorted(it, key=lambda e: e.name)
+        for item in items:
+            path = f'{rel}/{item.name}' if rel else item.name
+            if item.is_symlink():
+                continue
+            st = item.stat(follow_symlinks=False)
+            if item.is_dir(follow_symlinks=False):
+                entries.append(Entry(_DIR, path, 0, st.st_mtime, st.st_mode & 0o7777))
+                stack.append(path)
+            elif item.is_file(follow_symlinks=False):
+                entries.append(Entry(_FILE, path, st.st_size, st.st_mtime, st.st_mode & 0o7777, item.path))
+                count += 1
+                total += st.st_size
+    return entries, count, total
+
+
+def _read_small(entry):
+    with open(entry.source, 'rb') as f:
+        data = f.read(entry.size + 1)
+    if len(data) != entry.size:
+        raise BatchError(f'文件在发送过程中被修改: {entry.path}')
+    return data
+
+
+def _frame(entry):
+    path = entry.path.encode('utf-8')
+    return _ENTRY.pack(entry.kind, len(path), entry.size, entry.mtime, entry.mode) + path
+
+
+def iter_stream(entries, workers=PREFETCH_WORKERS):
+    # 依次生成数据流的各段（约 WRITE_BUFFER 大小），可直接作为 HTTP 请求体或逐段写入套接字
+    hasher = integrity.new_hash(ALGORITHM)
+    out = bytearray()
+    pending = deque()
+    budget = 0
+    remaining = iter(entries)
+    count = 0
+    total = 0
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch-read') as pool:
+        def prefetch():
+            # 在内存上限内为后面的小文件提交读取任务，大文件留到轮到时再顺序读取
+            nonlocal budget
+            while budget < PREFETCH_BYTES and len(pending) < PREFETCH_BYTES // 4096:
+                entry = next(remaining, None)
+                if entry is None:
+                    return
+                future = None
+                if entry.kind == _FILE and entry.size <= SMALL_FILE:
+                    future = pool.submit(_read_small, entry)
+                    budget += entry.size
+                pending.append((entry, future))
+
+        try:
+            prefetch()
+            while pending:
+                entry, future = pending.popleft()
+                out += _frame(entry)
+                if entry.kind == _FILE:
+                    count += 1
+                    total += entry.size
+                    if future is not None:
+                        data = future.result()
+                        budget -= entry.size
+                        hasher.update(data)
+                        out += data
+                    else:
+                        if out:
+                            yield bytes(out)
+                            out.clear()
+                        sent = 0
+                        with open(entry.source, 'rb') as f:
+                            while sent < entry.size and (data := f.read(min(WRITE_BUFFER, entry.size - sent))):
+                                hasher.update(data)
+                                sent += len(data)
+                                yield data
+                        if sent != entry.size:
+                            raise BatchError(f'文件在发送过程中被修改: {entry.path}')
+                prefetch()
+                if len(out) >= WRITE_BUFFER:
+                    yield bytes(out)
+                    out.clear()
+            out += _END.pack(_EOF, count, total, hasher.digest())
+            yield bytes(out)
+        finally:
+            for _, future in pending:
+                if future is not None:
+                    future.cancel()
+
+
+def safe_path(root, path):
+    # 拒绝绝对路径和 ..，防止写到目标目录之外
+    parts = path.split('/')
+    if not path or path.startswith('/') or any(p in ('', '.', '..') or '\\' in p or ':' in p for p in parts):
+        raise BatchError(f'无效的路径: {path!r}')
+    return os.path.join(root, *parts)
+
+
+class DirectorySink:
+    # 把数据流解包到目录 root 下
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def make_dir(self, path, mtime, mode):
+        # 不使用对端发来的目录权限，按本机 umask 创建
+        os.makedirs(safe_path(self.root, path), exist_ok=True)
+
+    def save(self, path, chunks, size, mtime, mode):
+        # 与 transfer.FileSink 相同：先写 .part，完整收到并落盘后才原子地替换目标文件，
+        # 数据流中途断开时目标路径上仍是原来的文件
+        target = safe_path(self.root, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        part_path = target + transfer.PART_SUFFIX
+        try:
+            with open(part_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            # 权限来自对端，只保留读写执行位，去掉 setuid/setgid/sticky
+            os.chmod(part_path, (mode & 0o777) or 0o644)
+            os.utime(part_path, (mtime, mtime))
+            os.replace(part_path, target)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+
+
+def _read_exact(stream, size):
+    if not size:
+        return b''
+    data = stream.read(size)
+    if len(data) == size:
+        return data
+    parts = [data]
+    received = len(data)
+    while received < size:
+        data = stream.read(size - received)
+        if not data:
+            raise BatchError(f'数据流提前结束: {received}/{size} 字节')
+        parts.append(data)
+        received += len(data)
+    return b''.join(parts)
+
+
+def extract(stream, sink, writers=WRITERS, throttle=None):
+    # 从 stream（带 read 方法的文件对象）读取数据流并交给 sink。
+    # 小文件由线程池写盘，大文件在当前线程里边收边写；返回文件数和字节数
+    hasher = integrity.new_hash(ALGORITHM)
+    pending = deque()
+    count = 0
+    total = 0
+
+    def large_chunks(size):
+        remaining = size
+        while remaining > 0:
+            data = stream.read(min(WRITE_BUFFER, remaining))
+            if not data:
+                raise BatchError('数据流提前结束')
+            hasher.update(data)
+            if throttle is not None:
+                throttle(len(data))
+            remaining -= len(data)
+            yield data
+
+    with ThreadPoolExecutor(max_workers=writers, thread_name_prefix='batch-write') as pool:
+        try:
+            while True:
+                kind = _read_exact(stream, 1)
+                if kind == _EOF:
+                    _, expected_count, expected_total, digest = _END.unpack(
+                        kind + _read_exact(stream, _END.size - 1))
+                    break
+                if kind not in (_FILE, _DIR):
+                    raise BatchError('无效的数据帧')
+                _, path_length, size, mtime, mode = _ENTRY.unpack(kind + _read_exact(stream, _ENTRY.size - 1))
+                path = _read_exact(stream, path_length).decode('utf-8')
+                if kind == _DIR:
+                    sink.make_dir(path, mtime, mode)
+                    continue
+                count += 1
+                total += size
+                if size > SMALL_FILE:
+                    sink.save(path, large_chunks(size), size, mtime, mode)
+                    continue
+                data = _read_exact(stream, size)
+                hasher.update(data)
+                if throttle is not None:
+                    throttle(size)
+                pending.append(pool.submit(sink.save, path, (data,), size, mtime, mode))
+                while len(pending) > MAX_PENDING_WRITES or (pending and pending[0].done()):
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+    if (count, total) != (expected_count, expected_total):
+        raise BatchError(f'条目不完整: {count}/{expected_count} 个文件, {total}/{expected_total} 字节')
+    if hasher.digest() != digest:
+        raise BatchError('批量数据校验失败')
+    return {'count': count, 'size': total}
+
+
+def serve_batch(server_socket, entries, accept_timeout=transfer.ACCEPT_TIMEOUT, throttle=None):
+    # 发送端：等待接收端的 {"op": "batch"} 连接，在这一个连接上发送整个数据流
+    request = transfer.accept_request(server_socket, accept_timeout)
+    if request is None:
+        raise transfer.TransferError('等待接收端连接超时')
+    conn, header = request
+    with conn:
+        if header.get('op') != 'batch':
+            raise transfer.TransferError(f"未知的控制操作: {header.get('op')}")
+        transfer.tune_socket(conn)
+        for chunk in iter_stream(entries):
+            if throttle is not None:
+                throttle(len(chunk))
+            conn.sendall(chunk)
+    # 与流水线发送相同：没有收到接收端的确认不能算成功
+    done = transfer.accept_request(server_socket, transfer.IDLE_TIMEOUT)
+    if done is None:
+        raise transfer.TransferError('等待接收端确认超时')
+    done[0].close()
+    if done[1].get('op') != 'done' or not done[1].get('ok', True):
+        raise transfer.TransferError('接收端报告传输失败')
+
+
+def receive_batch(host, port, dest, throttle=None):
+    # 连接失败时抛出 netio.ConnectError，发送端没有收到任何请求，不需要通知
+    s = transfer.connect(host, port)
+    ok = False
+    try:
+        with s:
+            transfer.tune_socket(s)
+            transfer.send_header(s, {'op': 'batch'})
+            with s.makefile('rb', buffering=transfer.BUFFER_SIZE) as stream:
+                result = extract(stream, DirectorySink(dest), throttle=throttle)
+        ok = True
+        return result
+    except (OSError, ValueError, BatchError) as e:
+        raise transfer.TransferError(f'批量接收失败: {e}')
+    finally:
+        transfer.notify_done(host, port, ok)
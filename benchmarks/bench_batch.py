@@ -0,0 +1,87 @@
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from common import throughput, print_table
+import batch
+import transfer
+
+
+def make_tree(root, count, size):
+    # count 个小文件，每个目录 500 个
+    for i in range(count):
+        directory = os.path.join(root, f'd{i // 500}')
+        if i % 500 == 0:
+            os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'f{i}.bin'), 'wb') as f:
+            f.write(os.urandom(size))
+
+
+def listen():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(transfer.MAX_STREAMS)
+    return listener
+
+
+def per_file(entries, dest):
+    # 旧方式：每个文件一个监听套接字、一次连接和一次 done 通知
+    for entry in entries:
+        target = os.path.join(dest, *entry.path.split('/'))
+        if entry.source is None:
+            os.makedirs(target, exist_ok=True)
+            continue
+        listener = listen()
+        t = threading.Thread(target=transfer.serve_file, args=(listener, entry.source), daemon=True)
+        t.start()
+        transfer.receive_file('127.0.0.1', listener.getsockname()[1], target, entry.size, streams=1)
+        t.join()
+        listener.close()
+
+
+def batched(entries, dest):
+    listener = listen()
+    t = threading.Thread(target=batch.serve_batch, args=(listener, entries), daemon=True)
+    t.start()
+    batch.receive_batch('127.0.0.1', listener.getsockname()[1], dest)
+    t.join()
+    listener.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='大量小文件：逐个传输与批量数据流的对比')
+    parser.add_argument('--files', default='1000,10000')
+    parser.add_argument('--file-size', type=int, default=4096)
+    args = parser.parse_args()
+
+    rows = []
+    for count in (int(n) for n in args.files.split(',')):
+        workdir = tempfile.mkdtemp(prefix='erevent-bench-batch-')
+        try:
+            src = os.path.join(workdir, 'src')
+            make_tree(src, count, args.file_size)
+            entries, _, size = batch.scan(src)
+            for name, run in (('per-file', per_file), ('batch', batched)):
+                dest = os.path.join(workdir, name)
+                os.makedirs(dest)
+                start = time.perf_counter()
+                run(entries, dest)
+                elapsed = time.perf_counter() - start
+                rows.append({
+                    'mode': name,
+                    'files': count,
+                    'files/s': f'{count / elapsed:.0f}',
+                    'MB/s': f'{throughput(size, elapsed):.1f}',
+                    'seconds': f'{elapsed:.2f}',
+                })
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_table(f'{args.file_size} byte files over loopback', rows, ['mode', 'files', 'files/s', 'MB/s', 'seconds'])
+
+
+if __name__ == '__main__':
+    main()
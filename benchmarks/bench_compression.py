@@ -0,0 +1,78 @@
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from common import MB, make_test_file, throughput, print_table
+import compression
+import scheduler
+import transfer
+
+
+def run_once(path, size, codecs, link_rate, dest):
+    # 发送端用令牌桶模拟链路速度（按实际发送的字节限速），0 表示不限速
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    transfer.tune_socket(listener)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(transfer.MAX_STREAMS)
+    bucket = scheduler.TokenBucket(link_rate, burst=64 * 1024)
+    wire = []
+    lock = threading.Lock()
+
+    def throttle(n):
+        with lock:
+            wire.append(n)
+        bucket.consume(n)
+
+    t = threading.Thread(target=transfer.serve_file, args=(listener, path),
+                         kwargs={'throttle': throttle}, daemon=True)
+    t.start()
+    start = time.perf_counter()
+    transfer.receive_file('127.0.0.1', listener.getsockname()[1], dest, size, streams=1, codecs=codecs)
+    elapsed = time.perf_counter() - start
+    t.join()
+    listener.close()
+    return elapsed, sum(wire)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='不同链路速度下自适应压缩与原始传输的吞吐对比')
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--links', default='12.5,125,0', help='模拟的链路速度（MB/s），0 表示不限速')
+    parser.add_argument('--codecs', default=','.join(compression.codecs()))
+    args = parser.parse_args()
+
+    size = args.size_mb * MB
+    files = {
+        'text': make_test_file(size, compressible=True),
+        'random': make_test_file(size),
+    }
+    dest = tempfile.mktemp(prefix='erevent-bench-recv-')
+    modes = [('raw', None)] + [(codec, [codec]) for codec in args.codecs.split(',')]
+    rows = []
+    try:
+        for link in (float(x) for x in args.links.split(',')):
+            for data, path in files.items():
+                for mode, codecs in modes:
+                    elapsed, wire = run_once(path, size, codecs, int(link * MB), dest)
+                    rows.append({
+                        'link_MB/s': link or 'unlimited',
+                        'data': data,
+                        'mode': mode,
+                        'MB/s': f'{throughput(size, elapsed):.1f}',
+                        'wire_ratio': f'{wire / size:.3f}',
+                        'seconds': f'{elapsed:.2f}',
+                    })
+    finally:
+        for path in files.values():
+            os.remove(path)
+        if os.path.exists(dest):
+            os.remove(dest)
+    print_table(f'{args.size_mb} MB, adaptive compression vs raw', rows,
+                ['link_MB/s', 'data', 'mode', 'MB/s', 'wire_ratio', 'seconds'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from common import MB, make_test_file, throughput, print_table
+import atransfer
+import transfer
+
+# 同时进行大量传输：每个传输一个监听套接字、一个数据连接，发送端和接收端在同一进程中。
+# threads 为原来的实现（每个传输的发送、接收以及每个数据连接各一个线程），async 为 atransfer 的事件循环；
+# async-cancel 在传输进行中取消一半，检查被取消的传输没有留下 .part 文件。
+# 每种方式在单独的子进程中运行，以便分别统计线程数峰值和内存峰值
+
+
+def listener():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    s.listen(transfer.MAX_STREAMS)
+    return s
+
+
+class ThreadSampler:
+    # 每 10 毫秒记录一次线程数
+    def __init__(self):
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(0.01):
+            self.peak = max(self.peak, threading.active_count())
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.peak
+
+
+def run_threads(source, size, count, workdir):
+    listeners = [listener() for _ in range(count)]
+    senders = [threading.Thread(target=transfer.serve_file, args=(l, source), daemon=True) for l in listeners]
+    failures = []
+
+    def receive(i, port):
+        try:
+            transfer.receive_file('127.0.0.1', port, os.path.join(workdir, f'{i}.bin'), size, streams=1)
+        except transfer.TransferError as e:
+            failures.append(e)
+
+    receivers = [threading.Thread(target=receive, args=(i, l.getsockname()[1]), daemon=True)
+                 for i, l in enumerate(listeners)]
+    for t in senders + receivers:
+        t.start()
+    for t in senders + receivers:
+        t.join()
+    for l in listeners:
+        l.close()
+    return count - len(failures), 0
+
+
+async def yield_loop(n):
+    await asyncio.sleep(0.001)
+
+
+def run_async(source, size, count, workdir, cancel=False):
+    core = atransfer.TransferCore()
+    listeners = [listener() for _ in range(count)]
+    senders = [core.submit(core.serve_file(l, source)) for l in listeners]
+    # 取消时每个数据块之后让出一次事件循环，保证取消发生在传输进行中
+    throttle = yield_loop if cancel else None
+    receivers = [core.submit(core.receive_file('127.0.0.1', l.getsockname()[1], os.path.join(workdir, f'{i}.bin'),
+                                               size, streams=1, throttle=throttle))
+                 for i, l in enumerate(listeners)]
+    if cancel:
+        time.sleep(0.2)
+        for future in receivers[::2]:
+            future.cancel()
+    done = cancelled = 0
+    for future in receivers:
+        try:
+            future.result()
+            done += 1
+        except concurrent.futures.CancelledError:
+            cancelled += 1
+        except transfer.TransferError:
+            pass
+    # 被取消的接收端会通知发送端失败，发送端的错误不再计数
+    for future in senders:
+        try:
+            future.result()
+        except transfer.TransferError:
+            pass
+    for l in listeners:
+        l.close()
+    buffer_bytes = core.buffers.allocated * core.buffers.size
+    core.close()
+    return done, cancelled, buffer_bytes
+
+
+def child(mode, size, count):
+    workdir = tempfile.mkdtemp(prefix='erevent-bench-concurrency-')
+    source = make_test_file(size, directory=workdir)
+    try:
+        sampler = ThreadSampler()
+        start = time.perf_counter()
+        if mode == 'threads':
+            done, cancelled = run_threads(source, size, count, workdir)
+            # 每个接收端一个 FileSink，各自分配一个缓冲区
+            buffer_bytes = count * min(transfer.BUFFER_SIZE, size)
+        else:
+            done, cancelled, buffer_bytes = run_async(source, size, count, workdir, cancel=mode == 'async-cancel')
+        elapsed = time.perf_counter() - start
+        peak_threads = sampler.stop()
+        leftover = sum(1 for name in os.listdir(workdir) if name.endswith(transfer.PART_SUFFIX))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps({
+        'mode': mode,
+        'done': done,
+        'cancelled': cancelled,
+        'MB/s': f'{throughput(size * done, elapsed):.1f}',
+        'seconds': f'{elapsed:.2f}',
+        'peak_threads': peak_threads,
+        'peak_rss_MB': f'{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}',
+        'recv_buffer_MB': f'{buffer_bytes / MB:.1f}',
+        '.part_left': leftover,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='同时进行 1000 个传输：每个传输一组线程与单个事件循环的对比')
+    parser.add_argument('--transfers', type=int, default=1000)
+    parser.add_argument('--size-mb', type=float, default=1)
+    parser.add_argument('--modes', default='threads,async,async-cancel')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    size = int(args.size_mb * MB)
+    if args.child:
+        child(args.child, size, args.transfers)
+        return
+
+    rows = []
+    for mode in args.modes.split(','):
+        output = subprocess.run([sys.executable, __file__, '--child', mode, '--transfers', str(args.transfers),
+                                 '--size-mb', str(args.size_mb)], capture_output=True, text=True)
+        if output.returncode != 0:
+            rows.append({'mode': mode, 'done': 'error: ' + output.stderr.strip().splitlines()[-1]})
+            continue
+        rows.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    print_table(f'{args.transfers} concurrent transfers of {args.size_mb:g} MB over loopback', rows,
+                ['mode', 'done', 'cancelled', 'MB/s', 'seconds', 'peak_threads', 'peak_rss_MB', 'recv_buffer_MB',
+                 '.part_left'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from common import ROOT, print_table
+
+# 协调服务器压力测试：模拟 N 台设备注册后持续发送心跳，并穿插查询设备列表
+# （大部分是按 seq 的增量查询，少量完整列表），统计每秒请求数和延迟分位数。
+# 服务器在子进程中运行，可以对比 Flask 开发服务器（dev）和 serve.py 的 asyncio 服务器（async）
+
+DEV_SERVER = '''
+import logging, sys
+logging.disable(logging.CRITICAL)
+import server
+from werkzeug.serving import WSGIRequestHandler, run_simple
+WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+run_simple('127.0.0.1', int(sys.argv[1]), server.app, threaded=True)
+'''
+
+LIST_SAMPLES = 20
+DEFAULT_LIST_RATIO = 0.1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(target, port, workers):
+    if target == 'dev':
+        cmd = [sys.executable, '-c', DEV_SERVER, str(port)]
+    else:
+        cmd = [sys.executable, os.path.join(ROOT, 'serve.py'), 'server', '--host', '127.0.0.1',
+               '--port', str(port), '--workers', str(workers), '--no-zeroconf']
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('服务器没有启动')
+
+
+class Connection:
+    # 最小的 HTTP/1.1 keep-alive 客户端，只处理带 Content-Length 的响应
+    def __init__(self, port):
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        data = json.dumps(body).encode() if body is not None else b''
+        head = f'{method} {path} HTTP/1.1\r\nHost: bench\r\nContent-Length: {len(data)}\r\n'
+        if body is not None:
+            head += 'Content-Type: application/json\r\n'
+        self.writer.write(head.encode() + b'\r\n' + data)
+        try:
+            response_head = await self.reader.readuntil(b'\r\n\r\n')
+            length = 0
+            for line in response_head.split(b'\r\n')[1:]:
+                name, _, value = line.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    length = int(value)
+            payload = await self.reader.readexactly(length)
+            if b'connection: close' in response_head.lower():
+                self.close()
+            return int(response_head.split(b' ', 2)[1]), payload
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.close()
+            raise
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+async def load(port, devices, connections, duration, list_ratio):
+    ids = [f'bench-{i}' for i in range(devices)]
+    conns = [Connection(port) for _ in range(connections)]
+
+    async def register(conn, part):
+        # 开发服务器的监听队列较短，大量并发连接时可能被重置，注册阶段重试
+        for device_id in part:
+            for attempt in range(5):
+                try:
+                    await conn.request('POST', '/api/register', {'device_id': device_id, 'device_name': device_id})
+                    break
+                except (OSError, asyncio.IncompleteReadError):
+                    await asyncio.sleep(0.1 * (attempt + 1))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(register(conn, ids[i::connections]) for i, conn in enumerate(conns)))
+    register_elapsed = time.perf_counter() - start
+
+    # 没有其他负载时完整设备列表的延迟，随设备数增长
+    list_latencies = []
+    for _ in range(LIST_SAMPLES):
+        start = time.perf_counter()
+        _, body = await conns[0].request('GET', '/api/devices')
+        list_latencies.append(time.perf_counter() - start)
+    snapshot = json.loads(body)
+    cursor = (snapshot.get('epoch'), snapshot.get('seq', 0))
+
+    latencies = []
+    errors = 0
+    stop_at = time.perf_counter() + duration
+
+    async def worker(conn, part):
+        nonlocal errors
+        rng = random.Random(id(conn))
+        i = 0
+        while time.perf_counter() < stop_at:
+            roll = rng.random()
+            if roll < list_ratio * 0.1:
+                method, path, body = 'GET', '/api/devices', None
+            elif roll < list_ratio:
+                method, path, body = 'GET', f'/api/devices?epoch={cursor[0]}&since={cursor[1]}', None
+            else:
+                method, path, body = 'POST', '/api/heartbeat', {'device_id': part[i % len(part)]}
+                i += 1
+            start = time.perf_counter()
+            try:
+                status, _ = await conn.request(method, path, body)
+                if status != 200:
+                    errors += 1
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(conn, ids[i::connections] or ids) for i, conn in enumerate(conns)))
+    elapsed = time.perf_counter() - start
+    for conn in conns:
+        conn.close()
+    return {
+        'register_rps': devices / register_elapsed,
+        'list_bytes': len(body),
+        'list_p50_ms': percentile(list_latencies, 0.50),
+        'list_p99_ms': percentile(list_latencies, 0.99),
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50),
+        'p99_ms': percentile(latencies, 0.99),
+    }
+
+
+def run(target, devices, connections, duration, workers, list_ratio):
+    port = free_port()
+    proc = start_server(target, port, workers)
+    try:
+        result = asyncio.run(load(port, devices, min(devices, connections), duration, list_ratio))
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    result.update({'target': target, 'devices': devices, 'connections': min(devices, connections)})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='协调服务器压力测试（每秒请求数、p99 延迟）')
+    parser.add_argument('--targets', default='dev,async')
+    parser.add_argument('--devices', default='100,1000,10000')
+    parser.add_argument('--connections', type=int, default=500, help='并发连接数上限，设备平均分配到各连接')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--list-ratio', type=float, default=DEFAULT_LIST_RATIO, help='设备列表查询占全部请求的比例')
+    parser.add_argument('--json', help='把结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    rows = []
+    for devices in (int(n) for n in args.devices.split(',')):
+        for target in args.targets.split(','):
+            rows.append(run(target, devices, args.connections, args.duration, args.workers, args.list_ratio))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+    print_table('coordinator load', [format_row(row) for row in rows], COLUMNS)
+
+
+COLUMNS = ['target', 'devices', 'connections', 'register_rps', 'list_p50_ms', 'list_p99_ms',
+           'requests', 'errors', 'rps', 'p50_ms', 'p99_ms']
+
+
+def format_row(row):
+    return dict(row, **{key: f'{row[key]:.1f}' if key.endswith('_ms') else f'{row[key]:.0f}'
+                        for key in ('register_rps', 'list_p50_ms', 'list_p99_ms', 'rps', 'p50_ms', 'p99_ms')})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from common import MB, make_test_file, throughput, print_table
+import delta
+import integrity
+import transfer
+
+
+def modify(src, dst, fraction, seed=0):
+    # 复制旧文件后随机改写 fraction 比例的数据（4KB 为单位），并在开头附近插入 1000 字节，
+    # 模拟原地修改加上一次会导致后续数据错位的插入
+    rng = random.Random(seed)
+    shutil.copyfile(src, dst)
+    size = os.path.getsize(dst)
+    region = 4096
+    with open(dst, 'r+b') as f:
+        for _ in range(int(size * fraction) // region):
+            f.seek(rng.randrange(0, size - region))
+            f.write(os.urandom(region))
+    with open(dst, 'rb') as f:
+        data = f.read()
+    cut = min(len(data), 1024 * 1024 + 123)
+    with open(dst, 'wb') as f:
+        f.write(data[:cut] + os.urandom(1000) + data[cut:])
+
+
+def scatter(src, dst, edits, seed=0):
+    # 在随机位置交替插入、删除几百字节到几十 KB，每处都会让后面的数据错位
+    rng = random.Random(seed)
+    with open(src, 'rb') as f:
+        data = bytearray(f.read())
+    for i in range(edits):
+        at = rng.randrange(len(data))
+        length = rng.randrange(100, 64 * 1024)
+        if i % 2:
+            del data[at:at + length]
+        else:
+            data[at:at] = os.urandom(length)
+    with open(dst, 'wb') as f:
+        f.write(data)
+
+
+def serve(path, hasher):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(transfer.MAX_STREAMS)
+    t = threading.Thread(target=transfer.serve_file, args=(listener, path),
+                         kwargs={'hasher': hasher}, daemon=True)
+    t.start()
+    return listener, t
+
+
+def main():
+    parser = argparse.ArgumentParser(description='增量传输与完整传输的对比（1%/10%/50% 修改，分散的插入/删除）')
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--fractions', default='0.01,0.1,0.5')
+    parser.add_argument('--edits', type=int, default=16)
+    args = parser.parse_args()
+
+    size = args.size_mb * MB
+    workdir = tempfile.mkdtemp(prefix='erevent-bench-delta-')
+    basis = make_test_file(size, workdir)
+    rows = []
+    try:
+        new = os.path.join(workdir, 'new.bin')
+        cases = [(f'{fraction:.0%}', modify, fraction) for fraction in (float(x) for x in args.fractions.split(','))]
+        cases.append((f'{args.edits} edits', scatter, args.edits))
+        for label, make, amount in cases:
+            make(basis, new, amount)
+            new_size = os.path.getsize(new)
+            hasher = integrity.ChunkHasher()
+            with open(new, 'rb') as f:
+                while data := f.read(MB):
+                    hasher.update(data)
+            hasher.finish()
+
+            listener, t = serve(new, hasher)
+            start = time.perf_counter()
+            transfer.receive_file('127.0.0.1', listener.getsockname()[1], os.path.join(workdir, 'full.bin'),
+                                  new_size, streams=1, checksum=hasher.describe())
+            full_elapsed = time.perf_counter() - start
+            t.join()
+            listener.close()
+
+            listener, t = serve(new, hasher)
+            start = time.perf_counter()
+            sig_start = time.perf_counter()
+            delta.signature(basis)
+            sig_elapsed = time.perf_counter() - sig_start
+            result = delta.receive_delta('127.0.0.1', listener.getsockname()[1], basis,
+                                         os.path.join(workdir, 'delta.bin'), new_size,
+                                         checksum=hasher.describe())
+            delta_elapsed = time.perf_counter() - start - sig_elapsed
+            t.join()
+            listener.close()
+
+            rows.append({
+                'modified': label,
+                'literal_MB': f"{result['literal_bytes'] / MB:.1f}",
+                'wire_saved': f"{1 - (result['literal_bytes'] + result['signature_bytes']) / new_size:.1%}",
+                'signature_s': f"{sig_elapsed:.2f}",
+                'delta_s': f"{delta_elapsed:.2f}",
+                'full_s': f"{full_elapsed:.2f}",
+                'delta_MB/s': f"{throughput(new_size, delta_elapsed):.1f}",
+                'verified': result['verified'],
+            })
+    finally:
+        shutil.rmtree(workdir)
+    print_table(f'delta sync {args.size_mb} MB', rows,
+                ['modified', 'literal_MB', 'wire_saved', 'signature_s', 'delta_s', 'full_s', 'delta_MB/s', 'verified'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from zeroconf import ServiceBrowser, ServiceInfo, ServiceListener, Zeroconf
+
+from common import print_table
+import discovery
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b'{"status": "success"}'
+        self.send_response(200 if self.path == discovery.HEALTH_PATH else 404)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServer:
+    # 只实现 /api/health 的协调服务器，并在 mDNS 上通告
+    def __init__(self, zc, name):
+        self.zc = zc
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), HealthHandler)
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.info = ServiceInfo(discovery.SERVICE_TYPE, f'{name}.{discovery.SERVICE_TYPE}',
+                                addresses=[socket.inet_aton('127.0.0.1')], port=self.port)
+        zc.register_service(self.info)
+
+    def stop(self):
+        # 模拟服务器崩溃：先停止响应，mDNS 的注销稍后才会到达（或根本不会到达）
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def legacy_ready(timeout):
+    # 旧实现：浏览线程里阻塞调用 get_service_info，只取第一个地址
+    zc = Zeroconf()
+    found = threading.Event()
+
+    class Listener(ServiceListener):
+        def add_service(self, zc, type_, name):
+            if zc.get_service_info(type_, name):
+                found.set()
+
+        def remove_service(self, zc, type_, name):
+            pass
+
+        def update_service(self, zc, type_, name):
+            pass
+
+    start = time.perf_counter()
+    browser = ServiceBrowser(zc, discovery.SERVICE_TYPE, Listener())
+    ok = found.wait(timeout)
+    elapsed = time.perf_counter() - start
+    browser.cancel()
+    zc.close()
+    return elapsed if ok else None
+
+
+def discovery_ready(cache_path, timeout):
+    start = time.perf_counter()
+    d = discovery.Discovery(cache_path=cache_path).start()
+    ok = d.wait(timeout)
+    elapsed = time.perf_counter() - start
+    return d, (elapsed if ok else None)
+
+
+def failover(cache_path, servers, timeout, report):
+    # 停掉选中的服务器，测量切换到另一台所需的时间；report 为 True 时模拟请求失败后立即通知
+    d, _ = discovery_ready(cache_path, timeout)
+    try:
+        # 等 mDNS 应答到达、两台服务器都成为候选
+        time.sleep(discovery.RESOLVE_TIMEOUT)
+        current = d.current()
+        victim = next(s for s in servers if s.port == current.port)
+        switched = threading.Event()
+        d.on_change = lambda server: server is not None and server.port != victim.port and switched.set()
+        victim.stop()
+        start = time.perf_counter()
+        if report:
+            d.report_failure()
+        ok = switched.wait(timeout)
+        return time.perf_counter() - start if ok else None
+    finally:
+        d.close()
+
+
+def fmt(seconds):
+    return f'{seconds * 1000:.1f}' if seconds is not None else 'timeout'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='找到可用协调服务器所需的时间和故障切换时间')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=15)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='erevent-bench-discovery-')
+    cache_path = os.path.join(workdir, 'discovery.json')
+    zc = Zeroconf()
+    servers = [FakeServer(zc, f'Bench Server {i}') for i in range(2)]
+    rows = []
+    try:
+        for i in range(args.rounds):
+            rows.append({'mode': 'legacy (blocking mDNS)', 'round': i + 1, 'ms': fmt(legacy_ready(args.timeout))})
+        for i in range(args.rounds):
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            d, elapsed = discovery_ready(cache_path, args.timeout)
+            # 等缓存写入后再关闭，下面的热启动会用到
+            time.sleep(0.2)
+            d.close()
+            rows.append({'mode': 'discovery, cold cache', 'round': i + 1, 'ms': fmt(elapsed)})
+        for i in range(args.rounds):
+            d, elapsed = discovery_ready(cache_path, args.timeout)
+            d.close()
+            rows.append({'mode': 'discovery, warm cache', 'round': i + 1, 'ms': fmt(elapsed)})
+        rows.append({'mode': 'failover, periodic probe', 'round': 1,
+                     'ms': fmt(failover(cache_path, servers, args.timeout, report=False))})
+        servers.append(FakeServer(zc, 'Bench Server 2'))
+        rows.append({'mode': 'failover, request failure', 'round': 1,
+                     'ms': fmt(failover(cache_path, servers, args.timeout, report=True))})
+    finally:
+        zc.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    print_table('time to ready / failover over loopback mDNS', rows, ['mode', 'round', 'ms'])
+
+
+if __name__ == '__main__':
+    main()
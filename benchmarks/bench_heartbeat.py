@@ -0,0 +1,60 @@
+import argparse
+import threading
+import time
+
+from common import print_table
+import registry
+
+
+def run(device_count, rounds, threads):
+    devices = registry.DeviceRegistry()
+    ids = [f'device-{i}' for i in range(device_count)]
+    for device_id in ids:
+        devices.register(device_id, device_id, '127.0.0.1')
+
+    # 多个线程同时发送心跳（模拟多线程服务器处理请求），主线程每秒合并一次
+    def sender(part):
+        for _ in range(rounds):
+            for device_id in part:
+                devices.heartbeat(device_id)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=sender, args=(ids[i::threads],)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    while any(t.is_alive() for t in workers):
+        devices.flush()
+        time.sleep(0.05)
+    devices.flush()
+    elapsed = time.perf_counter() - start
+
+    expire_start = time.perf_counter()
+    devices.expire()
+    expire_elapsed = time.perf_counter() - expire_start
+    metrics = devices.metrics()
+    total = device_count * rounds
+    return {
+        'devices': device_count,
+        'heartbeats': total,
+        'per_1k_ms': f'{elapsed / total * 1000 * 1000:.2f}',
+        'flush_per_1k_ms': f"{metrics['flush_ms_per_1k']:.2f}",
+        'coalesced': metrics['coalesced'],
+        'expire_ms': f'{expire_elapsed * 1000:.2f}',
+        'interval_s': f"{metrics['heartbeat_interval']:.0f}",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='设备注册表的心跳处理开销')
+    parser.add_argument('--devices', default='1000,10000,100000')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    rows = [run(int(n), args.rounds, args.threads) for n in args.devices.split(',')]
+    print_table('heartbeat processing', rows,
+                ['devices', 'heartbeats', 'per_1k_ms', 'flush_per_1k_ms', 'coalesced', 'expire_ms', 'interval_s'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import http.client
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from common import MB, make_test_file, print_table
+import bench_coordinator
+import media_cache
+from run_suite import start_app, upload
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# 在文件列表中浏览一页图片需要传输的数据量和时间：旧页面只能下载原文件预览，
+# 现在请求 /meta 和 /thumb。cold 为上传完成后立即请求（后台可能还在计算），
+# warm 为结果已在缓存中，revalidate 为浏览器带 If-None-Match 重新验证（304）。
+# 安装了 Pillow 时上传的是真实的 JPEG 照片，否则是随机数据，只比较 /meta
+
+
+def make_photo(size, directory):
+    # 尺寸接近手机照片、大小约为 size 的 JPEG（噪声图片压缩率低）
+    if Image is None:
+        return make_test_file(size, directory=directory)
+    side = 1024
+    while True:
+        image = Image.frombytes('RGB', (side * 4 // 3, side), os.urandom(side * 4 // 3 * side * 3))
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=90)
+        if buffer.tell() >= size or side >= 4096:
+            break
+        side *= 2
+    fd, path = tempfile.mkstemp(prefix='erevent-bench-', suffix='.jpg', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(buffer.getvalue())
+    return path
+
+
+def fetch_page(port, paths, etags=None):
+    # 在一个保持连接上依次请求，返回 (请求数, 响应体字节数, 秒, 各响应的 ETag)；202 时按 Retry-After 重试
+    seen = {}
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    requests = received = 0
+    start = time.perf_counter()
+    for path in paths:
+        while True:
+            headers = {'If-None-Match': etags[path]} if etags else {}
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+            requests += 1
+            received += len(body)
+            if response.status != 202:
+                break
+            time.sleep(float(response.headers.get('Retry-After', 1)))
+        if response.status not in (200, 304):
+            raise RuntimeError(f'{path}: HTTP {response.status}')
+        if response.headers.get('ETag'):
+            seen[path] = response.headers['ETag']
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return requests, received, elapsed, seen
+
+
+def main():
+    parser = argparse.ArgumentParser(description='浏览一页图片：下载原文件预览与 /meta + /thumb 的对比')
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--size-mb', type=float, default=4)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='erevent-bench-media-')
+    source = make_photo(int(args.size_mb * MB), workdir)
+    size = os.path.getsize(source)
+    names = [f'photo-{i}.jpg' for i in range(args.files)]
+    port = bench_coordinator.free_port()
+    proc = start_app(workdir, port, dedup=True)
+    rows = []
+    try:
+        for name in names:
+            upload(port, source, name)
+        preview = [f'/meta/{name}' for name in names]
+        if media_cache.MediaCache.thumbnails_enabled():
+            preview += [f'/thumb/{name}' for name in names]
+        passes = [
+            ('meta + thumb, cold', preview, False),
+            ('meta + thumb, warm', preview, False),
+            ('meta + thumb, revalidate', preview, True),
+            ('download originals', [f'/download/{name}' for name in names], False),
+        ]
+        etags = {}
+        for mode, paths, revalidate in passes:
+            requests, received, elapsed, seen = fetch_page(port, paths, etags if revalidate else None)
+            etags.update(seen)
+            rows.append({
+                'mode': mode,
+                'requests': requests,
+                'KB': f'{received / 1024:.0f}',
+                'KB/file': f'{received / 1024 / len(names):.1f}',
+                'ms': f'{elapsed * 1000:.0f}',
+            })
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+    print_table(f'{args.files} files of {size / MB:.1f} MB, thumbnails '
+                f'{"on" if media_cache.MediaCache.thumbnails_enabled() else "off (Pillow not installed)"}', rows,
+                ['mode', 'requests', 'KB', 'KB/file', 'ms'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from common import MB, make_test_file, throughput, print_table
+import transfer
+
+
+def run_once(path, size, streams, dest):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    transfer.tune_socket(listener)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(transfer.MAX_STREAMS)
+    port = listener.getsockname()[1]
+
+    t = threading.Thread(target=transfer.serve_file, args=(listener, path), daemon=True)
+    t.start()
+    start = time.perf_counter()
+    transfer.receive_file('127.0.0.1', port, dest, size, streams=streams)
+    elapsed = time.perf_counter() - start
+    t.join()
+    listener.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='多连接并行传输在回环地址上的扩展性')
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--streams', default='1,2,4,8')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size_mb * MB
+    path = make_test_file(size)
+    dest = tempfile.mktemp(prefix='erevent-bench-recv-')
+    rows = []
+    try:
+        for streams in (int(n) for n in args.streams.split(',')):
+            elapsed = min(run_once(path, size, streams, dest) for _ in range(args.repeat))
+            rows.append({
+                'streams': streams,
+                'effective_streams': len(transfer.plan_ranges(size, streams)),
+                'MB/s': f"{throughput(size, elapsed):.1f}",
+                'seconds': f"{elapsed:.3f}",
+            })
+    finally:
+        os.remove(path)
+        if os.path.exists(dest):
+            os.remove(dest)
+    print_table(f'loopback {args.size_mb} MB', rows, ['streams', 'effective_streams', 'MB/s', 'seconds'])
+
+
+if __name__ == '__main__':
+    main()
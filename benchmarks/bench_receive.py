@@ -0,0 +1,141 @@
+import argparse
+import os
+import re
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+from common import MB, make_test_file, throughput, print_table
+import transfer
+
+# 旧的接收方式每次 s.recv(8192) 都返回一个新的 bytes 对象，allocs 即 recv 次数；
+# FileSink 的 allocs 为缓冲区池实际分配的缓冲区个数（mmap 模式直接收进映射区，不需要缓冲区）
+
+
+def legacy_receive(port, dest, size):
+    # 旧实现：以 wb 打开目标文件，不预分配，逐个 recv(8192) 追加写入
+    allocs = 0
+    with socket.create_connection(('127.0.0.1', port)) as s, open(dest, 'wb') as f:
+        transfer.send_header(s, {'op': 'range', 'offset': 0, 'length': size})
+        received = 0
+        while received < size:
+            data = s.recv(8192)
+            if not data:
+                break
+            allocs += 1
+            f.write(data)
+            received += len(data)
+    transfer.notify_done('127.0.0.1', port, received == size)
+    return allocs
+
+
+def sink_receive(port, dest, size, streams, mode, reverse):
+    # 与 transfer.receive_file 相同的分段并行接收；reverse 时倒序发起各段，让后面的数据先到
+    ranges = transfer.plan_ranges(size, streams)
+    if reverse:
+        ranges.reverse()
+    errors = []
+    with transfer.FileSink(dest, size, mode) as sink:
+        def fetch(offset, length):
+            try:
+                with socket.create_connection(('127.0.0.1', port)) as s:
+                    transfer.tune_socket(s)
+                    transfer.send_header(s, {'op': 'range', 'offset': offset, 'length': length})
+                    sink.recv_range(s, offset, length)
+            except (OSError, transfer.TransferError) as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch, args=r, daemon=True) for r in ranges]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if not errors:
+            sink.commit()
+    transfer.notify_done('127.0.0.1', port, not errors)
+    if errors:
+        raise errors[0]
+    return sink.buffers.allocated
+
+
+def extents(path):
+    # 目标文件在磁盘上的区段数，文件系统不支持时返回 n/a
+    try:
+        output = subprocess.run(['filefrag', path], capture_output=True, text=True, timeout=30).stdout
+    except (OSError, subprocess.SubprocessError):
+        return 'n/a'
+    match = re.search(r'(\d+) extents? found', output)
+    return match.group(1) if match else 'n/a'
+
+
+def run_once(path, size, receiver):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    transfer.tune_socket(listener)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(transfer.MAX_STREAMS)
+    t = threading.Thread(target=transfer.serve_file, args=(listener, path), daemon=True)
+    t.start()
+    start = time.perf_counter()
+    allocs = receiver(listener.getsockname()[1])
+    elapsed = time.perf_counter() - start
+    t.join()
+    listener.close()
+    return elapsed, allocs
+
+
+def same_content(a, b):
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            x, y = fa.read(MB), fb.read(MB)
+            if x != y:
+                return False
+            if not x:
+                return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='接收端写文件方式对比：recv(8192) 追加写入与 FileSink（pwrite / mmap）')
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--streams', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--dir', default=None, help='目标文件所在目录（默认系统临时目录）')
+    args = parser.parse_args()
+
+    size = args.size_mb * MB
+    workdir = tempfile.mkdtemp(prefix='erevent-bench-receive-', dir=args.dir)
+    source = make_test_file(size, directory=workdir)
+    dest = os.path.join(workdir, 'received.bin')
+    receivers = [
+        ('recv(8192) + append', lambda port: legacy_receive(port, dest, size)),
+        ('FileSink pwrite', lambda port: sink_receive(port, dest, size, args.streams, 'pwrite', False)),
+        ('FileSink pwrite, reversed', lambda port: sink_receive(port, dest, size, args.streams, 'pwrite', True)),
+        ('FileSink mmap', lambda port: sink_receive(port, dest, size, args.streams, 'mmap', False)),
+        ('FileSink mmap, reversed', lambda port: sink_receive(port, dest, size, args.streams, 'mmap', True)),
+    ]
+    rows = []
+    try:
+        for name, receiver in receivers:
+            for i in range(args.rounds):
+                if os.path.exists(dest):
+                    os.remove(dest)
+                elapsed, allocs = run_once(source, size, receiver)
+                if not same_content(source, dest):
+                    raise SystemExit(f'{name}: 接收到的文件与源文件不一致')
+                rows.append({
+                    'mode': name,
+                    'round': i + 1,
+                    'MB/s': f'{throughput(size, elapsed):.1f}',
+                    'allocs': allocs,
+                    'extents': extents(dest),
+                })
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print_table(f'{args.size_mb} MB over loopback, {args.streams} streams for FileSink', rows,
+                ['mode', 'round', 'MB/s', 'allocs', 'extents'])
+
+
+if __name__ == '__main__':
+    main()
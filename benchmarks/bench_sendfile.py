@@ -0,0 +1,94 @@
+import argparse
+import os
+import socket
+import threading
+import time
+
+from common import MB, make_test_file, throughput, print_table
+import transfer
+
+
+# 旧实现：f.read(8192) + conn.send(chunk)，send 的返回值被忽略
+def legacy_send(conn, path):
+    with open(path, 'rb') as f:
+        while chunk := f.read(8192):
+            conn.send(chunk)
+
+
+def legacy_recv(sock, out):
+    while chunk := sock.recv(8192):
+        out.write(chunk)
+
+
+def engine_send(conn, path):
+    with open(path, 'rb') as f:
+        transfer.send_file(conn, f)
+
+
+def engine_recv(sock, out, size):
+    transfer.recv_to_file(sock, out, size)
+
+
+def run_once(path, size, sender, receiver, tuned):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if tuned:
+        transfer.tune_socket(listener)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+
+    def serve():
+        conn, _ = listener.accept()
+        with conn:
+            sender(conn, path)
+        listener.close()
+
+    t = threading.Thread(target=serve, daemon=True)
+    t.start()
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if tuned:
+        transfer.tune_socket(s)
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    s.connect(('127.0.0.1', port))
+    with s, open(os.devnull, 'wb') as out:
+        receiver(s, out, size)
+    t.join()
+    return time.perf_counter() - start, time.process_time() - start_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description='旧 read/send 循环与 sendfile 引擎的回环吞吐对比')
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size_mb * MB
+    path = make_test_file(size)
+    modes = [
+        ('legacy read/send 8K', legacy_send, lambda s, out, size: legacy_recv(s, out), False),
+        ('sendfile + recv_into', engine_send, engine_recv, True),
+    ]
+    rows = []
+    try:
+        for name, sender, receiver, tuned in modes:
+            best = None
+            for _ in range(args.repeat):
+                result = run_once(path, size, sender, receiver, tuned)
+                if best is None or result[0] < best[0]:
+                    best = result
+            elapsed, cpu = best
+            rows.append({
+                'mode': name,
+                'MB/s': f"{throughput(size, elapsed):.1f}",
+                'seconds': f"{elapsed:.3f}",
+                'cpu_seconds': f"{cpu:.3f}",
+            })
+    finally:
+        os.remove(path)
+    print_table(f'loopback {args.size_mb} MB', rows, ['mode', 'MB/s', 'seconds', 'cpu_seconds'])
+
+
+if __name__ == '__main__':
+    main()
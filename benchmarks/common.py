@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+
+# 让基准测试脚本可以直接导入仓库根目录下的模块
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+MB = 1024 * 1024
+
+
+def make_test_file(size, directory=None, compressible=False):
+    fd, path = tempfile.mkstemp(prefix='erevent-bench-', dir=directory)
+    block = (b'ER-Event benchmark line 0123456789\n' * 30000)[:MB] if compressible else None
+    with os.fdopen(fd, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            n = min(MB, remaining)
+            f.write(block[:n] if block else os.urandom(n))
+            remaining -= n
+    return path
+
+
+def throughput(size, seconds):
+    return size / MB / seconds if seconds > 0 else float('inf')
+
+
+def print_table(title, rows, columns):
+    print(f"\n== {title} ==")
+    widths = [max(len(str(c)), *(len(str(r.get(c, ''))) for r in rows)) for c in columns]
+    print('  '.join(str(c).ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row.get(c, '')).ljust(w) for c, w in zip(columns, widths)))
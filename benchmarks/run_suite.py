@@ -0,0 +1,274 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from common import MB, ROOT, make_test_file, throughput, print_table
+import bench_coordinator
+import integrity
+import transfer
+
+# 完整的回环基准测试，结果写成 JSON，便于不同提交之间对比：
+#   python benchmarks/run_suite.py -o before.json
+#   python benchmarks/run_suite.py -o after.json --compare before.json
+#
+# 包含三组场景：
+#   coordinator  N 台设备注册、心跳，以及设备列表延迟随设备数的变化（server.py）
+#   transfer     客户端之间的套接字传输（transfer.serve_file / receive_file，含分块校验）
+#   app          app.py 的 /upload 和 /download，不同文件大小，去重存储开启和关闭
+#
+# 每条结果为 {"suite", "name", "params", "metrics"}，对比时按 suite + name 匹配
+
+SUITES = ('coordinator', 'transfer', 'app')
+DEFAULT_SIZES = '1,16,128'
+QUICK_SIZES = '1,8'
+DOWNLOAD_BUFFER = MB
+# 吞吐类指标越大越好，其余（延迟、耗时、错误数）越小越好
+HIGHER_IS_BETTER = ('MB/s', 'rps', 'requests')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def environment():
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def result(suite, name, params, metrics):
+    return {'suite': suite, 'name': name, 'params': params,
+            'metrics': {k: round(v, 3) if isinstance(v, float) else v for k, v in metrics.items()}}
+
+
+def run_coordinator(args):
+    results = []
+    for devices in (int(n) for n in args.devices.split(',')):
+        for target in args.targets.split(','):
+            row = bench_coordinator.run(target, devices, args.connections, args.duration,
+                                        args.workers, bench_coordinator.DEFAULT_LIST_RATIO)
+            params = {k: row.pop(k) for k in ('target', 'devices', 'connections')}
+            results.append(result('coordinator', f'{target}/{devices}', params, row))
+    return results
+
+
+def transfer_once(path, size, streams, dest):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    transfer.tune_socket(listener)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(transfer.MAX_STREAMS)
+    port = listener.getsockname()[1]
+
+    # 与客户端相同：发送端先算好分块摘要，接收端边收边校验
+    hasher = integrity.ChunkHasher()
+    with open(path, 'rb') as f:
+        while chunk := f.read(hasher.chunk_size):
+            hasher.update(chunk)
+    hasher.finish()
+    t = threading.Thread(target=transfer.serve_file, args=(listener, path),
+                         kwargs={'hasher': hasher}, daemon=True)
+    t.start()
+    start = time.perf_counter()
+    transfer.receive_file('127.0.0.1', port, dest, size, streams=streams, checksum=hasher.describe())
+    elapsed = time.perf_counter() - start
+    t.join()
+    listener.close()
+    return elapsed
+
+
+def run_transfer(args, files):
+    results = []
+    dest = os.path.join(args.workdir, 'received.bin')
+    for size_mb, path in files:
+        size = size_mb * MB
+        for streams in sorted({1, transfer.DEFAULT_STREAMS}):
+            elapsed = min(transfer_once(path, size, streams, dest) for _ in range(args.repeat))
+            results.append(result('transfer', f'{size_mb}MB/{streams}', {'size_mb': size_mb, 'streams': streams},
+                                  {'MB/s': throughput(size, elapsed), 'seconds': elapsed}))
+    if os.path.exists(dest):
+        os.remove(dest)
+    return results
+
+
+def start_app(workdir, port, dedup):
+    # 在独立的目录中运行，uploads/ 不会影响仓库；使用生产环境的 serve.py
+    env = dict(os.environ, EREVENT_DEDUP_STORE='1' if dedup else '0')
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'serve.py'), 'app', '--host', '127.0.0.1',
+                             '--port', str(port)], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('app.py 没有启动')
+
+
+def upload(port, path, filename):
+    boundary = uuid.uuid4().hex
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    size = os.path.getsize(path)
+
+    def body():
+        yield head
+        with open(path, 'rb') as f:
+            while chunk := f.read(MB):
+                yield chunk
+        yield tail
+
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    start = time.perf_counter()
+    conn.request('POST', '/upload', body=body(), headers={
+        'Content-Type': f'multipart/form-data; boundary={boundary}',
+        'Content-Length': str(len(head) + size + len(tail)),
+    })
+    response = conn.getresponse()
+    response.read()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError(f'上传失败: HTTP {response.status}')
+    return elapsed
+
+
+def download(port, filename, size):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    buffer = memoryview(bytearray(DOWNLOAD_BUFFER))
+    start = time.perf_counter()
+    conn.request('GET', f'/download/{filename}')
+    response = conn.getresponse()
+    received = 0
+    while n := response.readinto(buffer):
+        received += n
+    elapsed = time.perf_counter() - start
+    conn.close()
+    if response.status != 200 or received != size:
+        raise RuntimeError(f'下载失败: HTTP {response.status}, {received}/{size} 字节')
+    return elapsed
+
+
+def run_app(args, files):
+    results = []
+    for mode in args.app_modes.split(','):
+        workdir = tempfile.mkdtemp(prefix='erevent-bench-app-', dir=args.workdir)
+        port = bench_coordinator.free_port()
+        proc = start_app(workdir, port, mode == 'dedup')
+        try:
+            for size_mb, path in files:
+                size = size_mb * MB
+                # 每次用不同的文件名，去重模式下第二次起相同内容不再写入分块，这也是实际的使用场景
+                uploads = [upload(port, path, f'bench-{size_mb}-{i}.bin') for i in range(args.repeat)]
+                downloads = [download(port, f'bench-{size_mb}-{i}.bin', size) for i in range(args.repeat)]
+                results.append(result('app', f'{mode}/{size_mb}MB', {'mode': mode, 'size_mb': size_mb}, {
+                    'upload_MB/s': throughput(size, min(uploads)),
+                    'first_upload_MB/s': throughput(size, uploads[0]),
+                    'download_MB/s': throughput(size, min(downloads)),
+                }))
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline):
+    # 按 suite + name 匹配，打印每个指标的变化，正数表示变好
+    base = {(r['suite'], r['name']): r['metrics'] for r in baseline['results']}
+    rows = []
+    for r in results:
+        old = base.get((r['suite'], r['name']))
+        if old is None:
+            continue
+        for key, value in r['metrics'].items():
+            before = old.get(key)
+            if not isinstance(value, (int, float)) or not before:
+                continue
+            change = (value - before) / before * 100
+            if not key.endswith(HIGHER_IS_BETTER):
+                change = -change
+            rows.append({'suite': r['suite'], 'name': r['name'], 'metric': key,
+                         'before': before, 'after': value, 'change': f'{change:+.1f}%'})
+    print_table(f"compared with {baseline['environment'].get('commit')}", rows,
+                ['suite', 'name', 'metric', 'before', 'after', 'change'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='协调服务器、客户端传输和 app.py 上传下载的完整基准测试')
+    parser.add_argument('--suites', default=','.join(SUITES))
+    parser.add_argument('--sizes', help=f'文件大小（MB），默认 {DEFAULT_SIZES}')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--devices', default='100,1000,10000')
+    parser.add_argument('--targets', default='async', help='协调服务器：dev（Flask 开发服务器）和/或 async（serve.py）')
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--app-modes', default='dedup,plain')
+    parser.add_argument('--quick', action='store_true', help='缩小规模，用于快速检查')
+    parser.add_argument('-o', '--output', help='结果 JSON 文件，默认 bench-<提交>.json')
+    parser.add_argument('--compare', help='与之前的结果 JSON 对比')
+    args = parser.parse_args()
+    if args.quick:
+        args.sizes = args.sizes or QUICK_SIZES
+        args.devices = '100,1000'
+        args.duration = 3
+        args.repeat = 1
+    sizes = [int(n) for n in (args.sizes or DEFAULT_SIZES).split(',')]
+    suites = args.suites.split(',')
+    for suite in suites:
+        if suite not in SUITES:
+            parser.error(f'未知的测试组: {suite}')
+
+    env = environment()
+    results = []
+    args.workdir = tempfile.mkdtemp(prefix='erevent-bench-')
+    try:
+        files = [(size_mb, make_test_file(size_mb * MB, args.workdir)) for size_mb in sizes]
+        if 'coordinator' in suites:
+            results += run_coordinator(args)
+        if 'transfer' in suites:
+            results += run_transfer(args, files)
+        if 'app' in suites:
+            results += run_app(args, files)
+    finally:
+        shutil.rmtree(args.workdir, ignore_errors=True)
+
+    for suite in SUITES:
+        rows = [dict(r['metrics'], name=r['name']) for r in results if r['suite'] == suite]
+        if rows:
+            print_table(suite, rows, ['name'] + [k for k in rows[0] if k != 'name'])
+
+    output = args.output or f"bench-{env['commit'] or 'unknown'}.json"
+    with open(output, 'w') as f:
+        json.dump({'environment': env, 'results': results}, f, indent=2, ensure_ascii=False)
+    print(f'\n结果已写入 {output}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
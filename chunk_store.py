@@ -0,0 +1,389 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from werkzeug.utils import secure_filename
+
+from file_index import FileEntry
+
+# 按内容寻址的分块存储：文件按固定大小切块，每块以 SHA-256 命名保存一次，
+# 文件本身只是一份记录分块顺序的清单（manifest）。
+# 多台设备上传同一个文件时磁盘上只有一份数据；客户端先用 check 接口询问
+# 哪些分块服务器还没有，只上传缺少的部分，最后提交清单。
+#
+# 目录结构（位于上传目录下，以点开头不出现在文件列表中）：
+#   .store/chunks/<前两位>/<摘要>   分块数据
+#   .store/files/<文件名>.json       文件清单
+#
+# 使用 SHA-256 而不是 integrity 的默认算法，是为了让浏览器可以用 WebCrypto 计算同样的摘要
+
+CHUNK_SIZE = 4 * 1024 * 1024
+ALGORITHM = 'sha256'
+READ_SIZE = 1024 * 1024
+# 一次 check 请求最多询问的分块数
+MAX_CHECK = 10000
+# 上传了但没有被任何清单引用的分块，超过该时间后在启动时清理
+ORPHAN_TTL = 24 * 3600
+
+
+class StoreError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def chunk_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _valid_digest(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+class Manifest:
+    def __init__(self, name, size, mtime, chunks, chunk_size=CHUNK_SIZE):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'size': self.size,
+            'mtime': self.mtime,
+            'chunk_size': self.chunk_size,
+            'algorithm': ALGORITHM,
+            'chunks': self.chunks,
+        }
+
+
+class ManifestReader:
+    # 把清单中的分块拼接成一个只读、可 seek 的文件对象，供 http_range.send_ranges 使用
+    def __init__(self, store, manifest):
+        self.store = store
+        self.manifest = manifest
+        self.pos = 0
+        self._index = None
+        self._file = None
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.manifest.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        manifest = self.manifest
+        if size is None or size < 0:
+            size = manifest.size - self.pos
+        parts = []
+        while size > 0 and self.pos < manifest.size:
+            index, offset = divmod(self.pos, manifest.chunk_size)
+            if index != self._index:
+                self._close_chunk()
+                self._file = open(self.store.chunk_path(manifest.chunks[index]), 'rb')
+                self._index = index
+            self._file.seek(offset)
+            data = self._file.read(min(size, manifest.chunk_length(index) - offset))
+            if not data:
+                raise OSError(f'分块数据缺失: {manifest.chunks[index]}')
+            parts.append(data)
+            self.pos += len(data)
+            size -= len(data)
+        return b''.join(parts)
+
+    def _close_chunk(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._index = None
+
+    def close(self):
+        self._close_chunk()
+
+
+class StoreWriter:
+    # 把顺序到达的数据切块写入存储，已存在的分块不再写盘。
+    # 写入的分块在 commit 或 abort 之前一直被本 writer 占用，不会被其他上传的 abort 删除
+    def __init__(self, store):
+        self.store = store
+        self.chunks = []
+        self.size = 0
+        self.created = []
+        self._buffer = bytearray()
+        self._held = True
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.store.chunk_size:
+            self._flush(bytes(self._buffer[:self.store.chunk_size]))
+            del self._buffer[:self.store.chunk_size]
+
+    def _flush(self, data):
+        digest = chunk_digest(data)
+        if self.store.put_chunk_bytes(digest, data):
+            self.created.append(digest)
+        self.chunks.append(digest)
+
+    def commit(self, name, mtime=None):
+        if self._buffer:
+            self._flush(bytes(self._buffer))
+            self._buffer.clear()
+        manifest = self.store.commit(name, self.size, self.chunks, mtime)
+        self._release()
+        return manifest
+
+    def abort(self):
+        # 删除本次新写入且没有被引用的分块；已经提交或放弃过的 writer 什么也不做
+        if self._held:
+            self._release()
+            self.store.discard(self.created)
+
+    def _release(self):
+        self._held = False
+        self.store.release(self.chunks)
+
+
+class ChunkStore:
+    def __init__(self, root, chunk_size=CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.chunks_folder = os.path.join(root, 'chunks')
+        self.files_folder = os.path.join(root, 'files')
+        os.makedirs(self.chunks_folder, exist_ok=True)
+        os.makedirs(self.files_folder, exist_ok=True)
+        self.lock = threading.RLock()
+        self.manifests = {}
+        # 分块摘要 -> 长度 / 被清单引用的次数
+        self.chunk_sizes = {}
+        self.refs = {}
+        # 分块摘要 -> 还没有提交的上传（StoreWriter、分块上传会话）占用的次数，
+        # 与 refs 都为 0 的分块才能删除
+        self.pending = {}
+        self.logical_bytes = 0
+        self.load()
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunks_folder, digest[:2], digest)
+
+    def _manifest_path(self, name):
+        return os.path.join(self.files_folder, name + '.json')
+
+    def load(self):
+        manifests = {}
+        for entry in os.scandir(self.files_folder):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    data = json.load(f)
+                manifests[data['name']] = Manifest(
+                    data['name'], data['size'], data['mtime'], data['chunks'], data['chunk_size'])
+            except (OSError, ValueError, KeyError):
+                continue
+        chunk_sizes = {}
+        mtimes = {}
+        now = time.time()
+        for bucket in os.scandir(self.chunks_folder):
+            if not bucket.is_dir():
+                continue
+            for entry in os.scandir(bucket.path):
+                st = entry.stat()
+                if not _valid_digest(entry.name):
+                    # 写入中断留下的临时文件
+                    if now - st.st_mtime > ORPHAN_TTL:
+                        os.remove(entry.path)
+                    continue
+                chunk_sizes[entry.name] = st.st_size
+                mtimes[entry.name] = st.st_mtime
+        refs = {}
+        for manifest in manifests.values():
+            for digest in manifest.chunks:
+                refs[digest] = refs.get(digest, 0) + 1
+        for digest in list(chunk_sizes):
+            if digest not in refs and now - mtimes[digest] > ORPHAN_TTL:
+                os.remove(self.chunk_path(digest))
+                del chunk_sizes[digest]
+        with self.lock:
+            self.manifests = manifests
+            self.chunk_sizes = chunk_sizes
+            self.refs = refs
+            self.logical_bytes = sum(m.size for m in manifests.values())
+
+    def missing(self, digests):
+        with self.lock:
+            return [d for d in dict.fromkeys(digests) if d not in self.chunk_sizes]
+
+    def hold(self, digests):
+        with self.lock:
+            for digest in digests:
+                self.pending[digest] = self.pending.get(digest, 0) + 1
+
+    def release(self, digests):
+        # 与 hold / put_chunk_bytes 配对；不删除分块，需要时调用方再 discard
+        with self.lock:
+            for digest in digests:
+                count = self.pending.get(digest, 0) - 1
+                if count > 0:
+                    self.pending[digest] = count
+                else:
+                    self.pending.pop(digest, None)
+
+    def put_chunk_bytes(self, digest, data):
+        # 返回 True 表示新写入，False 表示已经存在。无论哪种情况都为调用方占用一次该分块
+        # （与检查是否存在在同一把锁里，避免刚确认存在就被别的上传删掉），用完后调用 release
+        with self.lock:
+            self.pending[digest] = self.pending.get(digest, 0) + 1
+            if digest in self.chunk_sizes:
+                return False
+        try:
+            path = self.chunk_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            self.release([digest])
+            raise
+        with self.lock:
+            self.chunk_sizes[digest] = len(data)
+        return True
+
+    def put_chunk(self, digest, stream):
+        # 从请求流中接收一个分块，摘要与 URL 中的不一致时拒绝
+        if not _valid_digest(digest):
+            raise StoreError('分块摘要无效')
+        with self.lock:
+            if digest in self.chunk_sizes:
+                return False
+        path = self.chunk_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        h = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    data = stream.read(READ_SIZE)
+                    if not data:
+                        break
+                    size += len(data)
+                    if size > self.chunk_size:
+                        raise StoreError('分块数据超出长度')
+                    h.update(data)
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            if h.hexdigest() != digest:
+                raise StoreError('分块校验失败，请重传', 422)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self.lock:
+            self.chunk_sizes[digest] = size
+        return True
+
+    def discard(self, digests):
+        with self.lock:
+            for digest in digests:
+                if not self.refs.get(digest) and not self.pending.get(digest) and digest in self.chunk_sizes:
+                    del self.chunk_sizes[digest]
+                    os.remove(self.chunk_path(digest))
+
+    def writer(self):
+        return StoreWriter(self)
+
+    def commit(self, name, size, digests, mtime=None):
+        name = secure_filename(name or '')
+        if not name:
+            raise StoreError('没有选择文件')
+        if not isinstance(size, int) or size < 0:
+            raise StoreError('文件大小无效')
+        if not isinstance(digests, list) or not all(_valid_digest(d) for d in digests):
+            raise StoreError('分块摘要无效')
+        if len(digests) != -(-size // self.chunk_size):
+            raise StoreError('分块数量与文件大小不符')
+        manifest = Manifest(name, size, mtime or time.time(), digests, self.chunk_size)
+        with self.lock:
+            for index, digest in enumerate(digests):
+                length = self.chunk_sizes.get(digest)
+                if length is None:
+                    raise StoreError(f'还有 {len(self.missing(digests))} 个分块未上传', 409)
+                if length != manifest.chunk_length(index):
+                    raise StoreError(f'第 {index} 个分块长度不符')
+            tmp_path = self._manifest_path(name) + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest.to_dict(), f)
+            os.replace(tmp_path, self._manifest_path(name))
+            for digest in digests:
+                self.refs[digest] = self.refs.get(digest, 0) + 1
+            old = self.manifests.get(name)
+            self.manifests[name] = manifest
+            self.logical_bytes += size
+            if old is not None:
+                self._release(old)
+        return manifest
+
+    def _release(self, manifest):
+        self.logical_bytes -= manifest.size
+        unused = []
+        for digest in manifest.chunks:
+            self.refs[digest] -= 1
+            if not self.refs[digest]:
+                del self.refs[digest]
+                unused.append(digest)
+        self.discard(unused)
+
+    def delete(self, name):
+        with self.lock:
+            manifest = self.manifests.pop(name, None)
+            if manifest is None:
+                return False
+            os.remove(self._manifest_path(name))
+            self._release(manifest)
+            return True
+
+    def get(self, name):
+        return self.manifests.get(name)
+
+    # 以下两个方法供 file_index.FileIndex 把存储中的文件合并进文件列表
+    def entry(self, name):
+        manifest = self.manifests.get(name)
+        return FileEntry(name, manifest.size, manifest.mtime) if manifest is not None else None
+
+    def entries(self):
+        with self.lock:
+            return [FileEntry(m.name, m.size, m.mtime) for m in self.manifests.values()]
+
+    def stats(self):
+        with self.lock:
+            physical = sum(self.chunk_sizes.values())
+            return {
+                'files': len(self.manifests),
+                'chunks': len(self.chunk_sizes),
+                'chunk_size': self.chunk_size,
+                'algorithm': ALGORITHM,
+                'logical_bytes': self.logical_bytes,
+                'physical_bytes': physical,
+                'saved_bytes': max(0, self.logical_bytes - physical),
+                'dedup_ratio': round(self.logical_bytes / physical, 3) if physical else 1.0,
+            }
@@ -1,13 +1,29 @@
-from flask import Flask, render_template, request, jsonify, send_file
-import requests
+from flask import Flask, Response, render_template, request, jsonify, send_file
 import uuid
 import json
+from collections import OrderedDict
+import contextlib
 import socket
 import threading
 import time
 from datetime import datetime
 import os
-from zeroconf import ServiceBrowser, ServiceListener, Zeroconf
+from werkzeug.utils import secure_filename
+import atransfer
+import batch
+import compression
+import coordinator
+import delta
+import discovery
+import events
+import heartbeat
+import integrity
+import metrics
+import multipart_stream
+import netio
+import rendezvous
+import scheduler
+import transfer
 
 app = Flask(__name__)
 
@@ -20,41 +36,63 @@ class GlobalState:
         self.server_port = None
         self.is_registered = False
         self.transfer_tasks = {}
+        # 由服务器推送的增量维护的设备列表，页面从这里取，不再每次转发到服务器
+        self.devices = {}
+        self.devices_synced = False
+        self.devices_lock = threading.Lock()
+        # 转发给页面的设备事件，沿用服务器的序号
+        self.device_events = events.EventLog()
+        # 已经接受的传输请求（transfer_id），按接受顺序淘汰
+        self.accepted_offers = OrderedDict()
+        self.offers_lock = threading.Lock()
 
 state = GlobalState()
 
-class ServiceDiscoveryListener(ServiceListener):
-    def add_service(self, zc, type_, name):
-        info = zc.get_service_info(type_, name)
-        if info:
-            state.server_ip = socket.inet_ntoa(info.addresses[0])
-            state.server_port = info.port
-            print(f"Found server at {state.server_ip}:{state.server_port}")
+def on_server_change(server):
+    # 服务发现选中的服务器变化（首次找到、故障切换、延迟更低的地址）
+    if server is None:
+        state.server_ip, state.server_port = None, None
+        print("No coordinator server available")
+        return
+    state.server_ip, state.server_port = server.host, server.port
+    print(f"Using server at {server.url()}")
+    # 换了服务器后设备列表缓存作废；新服务器不认识本设备时心跳会自动重新注册
+    coordinator_client.invalidate()
 
-    def remove_service(self, zc, type_, name):
-        pass
+# 缓存上次的服务器并探测所有通告的实例，见 discovery.py
+discovery_service = discovery.Discovery(on_change=on_server_change)
 
-    def update_service(self, zc, type_, name):
-        pass
+def server_url():
+    return discovery_service.base_url()
 
-def start_service_discovery():
-    print("Starting service discovery...")
-    zeroconf = Zeroconf()
-    listener = ServiceDiscoveryListener()
-    browser = ServiceBrowser(zeroconf, "_erevent._tcp.local.", listener)
-    return zeroconf
+# 访问协调服务器的请求共用一个连接池
+coordinator_client = coordinator.CoordinatorClient(server_url, on_unreachable=discovery_service.report_failure)
+# 传输进度在后台合并后上报给服务器，发送端和接收端各报一份
+progress_reporter = coordinator.ProgressReporter(coordinator_client)
+
+def report_progress(job):
+    if not job['transfer_id']:
+        return
+    progress_reporter.update(job['transfer_id'], {
+        'device_id': state.device_id,
+        'role': 'sender' if job['kind'] == 'send' else 'receiver',
+        'state': job['state'],
+        'transferred': job['transferred'],
+        'size': job['size'],
+        'rate': job['rate'],
+        'avg_rate': job['avg_rate'],
+        'eta': job['eta'],
+        'error': job['error']
+    })
+
+# 设备间的文件收发在一个事件循环上进行，见 atransfer.py
+transfer_core = atransfer.TransferCore()
+# 所有发送和接收都经过调度器排队，限制并发数和带宽；进度同时推送给页面
+transfer_scheduler = scheduler.TransferScheduler(on_update=report_progress, core=transfer_core)
 
 def heartbeat_thread():
-    while True:
-        if state.is_registered and state.server_ip:
-            try:
-                requests.post(
-                    f"http://{state.server_ip}:{state.server_port}/api/heartbeat",
-                    json={'device_id': state.device_id}
-                )
-            except:
-                print("Heartbeat failed")
-        time.sleep(30)
+    heartbeat.run(coordinator_client,
+                  lambda: (state.device_id, state.device_name) if state.is_registered else None)
 
 @app.route('/')
 def index():
@@ -78,30 +116,20 @@ def register_device():
         state.device_name = request.json.get('device_name')
         print(f"Attempting to register device: {state.device_name} to server: {state.server_ip}:{state.server_port}")
         
-        response = requests.post(
-            f"http://{state.server_ip}:{state.server_port}/api/register",
-            json={
-                'device_id': state.device_id,
-                'device_name': state.device_name
-            },
-            timeout=5  # 添加超时设置
-        )
-        print(f"Server response status: {response.status_code}")
-        print(f"Server response: {response.text}")
-        
-        if response.status_code == 200:
-            state.is_registered = True
-            return jsonify({'status': 'success'})
+        coordinator_client.register(state.device_id, state.device_name)
+        state.is_registered = True
+        return jsonify({'status': 'success'})
+    except coordinator.CoordinatorError as e:
+        print(f"Registration failed: {e.message}")
+        if e.status is None:
+            return jsonify({
+                'status': 'error',
+                'message': '无法连接到服务器，请确保服务器正在运行'
+            }), 500
         return jsonify({
             'status': 'error',
-            'message': f'注册失败: {response.text}'
+            'message': f'注册失败: {e.message}'
         }), 400
-    except requests.exceptions.ConnectionError as e:
-        print(f"Connection error: {str(e)}")
-        return jsonify({
-            'status': 'error',
-            'message': '无法连接到服务器，请确保服务器正在运行'
-        }), 500
     except Exception as e:
         print(f"Unexpected error during registration: {str(e)}")
         return jsonify({
@@ -109,137 +137,508 @@ def register_device():
             'message': f'注册过程中出现错误: {str(e)}'
         }), 500
 
+def on_devices_snapshot(devices, epoch, seq):
+    with state.devices_lock:
+        state.devices = devices
+        state.devices_synced = True
+        # 页面上的订阅全部收到 reset，重新取一次列表
+        state.device_events.reset(seq)
+
+def on_device_event(event):
+    with state.devices_lock:
+        events.apply_event(state.devices, event)
+        state.device_events.append(event, seq=event['seq'])
+
+def presence_thread():
+    events.follow(server_url, on_devices_snapshot, on_device_event, session=coordinator_client.session)
+
 @app.route('/api/devices')
 def get_devices():
-    if not state.server_ip:
-        return jsonify({'devices': []})
-    
+    with state.devices_lock:
+        synced = state.devices_synced
+        devices = dict(state.devices)
+        epoch, seq = state.device_events.cursor()
+    if not synced:
+        # 还没有收到推送的快照时直接向服务器查询，短时间内的多次查询共用一次结果；
+        # 快照到达后页面的事件流会收到 reset 并重新加载
+        try:
+            devices = coordinator_client.devices()['devices']
+        except coordinator.CoordinatorError as e:
+            return jsonify({'status': 'error', 'message': e.message}), 503
+    # 移除自己
+    devices = {k: v for k, v in devices.items() if k != state.device_id}
+    return jsonify({'devices': devices, 'epoch': epoch, 'seq': seq})
+
+@app.route('/api/devices/events')
+def device_events():
+    cursor = events.parse_cursor(
+        request.headers.get('Last-Event-ID') or request.args.get('epoch'),
+        request.args.get('since')
+    )
+    stream = events.sse_stream(state.device_events, cursor,
+                               include=lambda event: event['device_id'] != state.device_id)
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# 流水线发送时等待接收端连接的时间，超时后退回到临时文件方式
+PIPELINE_CONNECT_TIMEOUT = 5
+
+def init_transfer(target_device, file_info):
     try:
-        response = requests.get(
-            f"http://{state.server_ip}:{state.server_port}/api/devices"
-        )
-        if response.status_code == 200:
-            devices = response.json()['devices']
-            # 移除自己
-            if state.device_id in devices:
-                del devices[state.device_id]
-            return jsonify({'devices': devices})
-    except:
-        pass
-    return jsonify({'devices': []})
+        return coordinator_client.init_transfer(state.device_id, target_device, file_info)
+    except coordinator.CoordinatorError as e:
+        raise Exception(f'创建传输任务失败: {e.message}')
+
+def peer_addresses(target_device):
+    # 接收端可以用来连接本机的地址，通往该设备的网卡地址排在最前
+    with state.devices_lock:
+        peer_ip = (state.devices.get(target_device) or {}).get('ip')
+    return rendezvous.advertised_addresses(peer_ip)
+
+def spool_to_temp(filename, chunks, hasher):
+    # 临时文件方式：把上传的数据先写到 temp/，之后再由 serve_file 发送；
+    # 写盘的同时计算分块摘要，发送时不必再读一遍
+    temp_dir = os.path.join(os.path.dirname(__file__), 'temp')
+    os.makedirs(temp_dir, exist_ok=True)
+    temp_path = os.path.join(temp_dir, f"{uuid.uuid4().hex}-{secure_filename(filename) or 'file'}")
+    with open(temp_path, 'wb') as f:
+        for chunk in chunks:
+            hasher.update(chunk)
+            f.write(chunk)
+    hasher.finish()
+    return temp_path
+
+def temp_file_job(server_socket, temp_path, hasher, pending=None):
+    async def transfer_job(job):
+        try:
+            # 接收端可能用多个连接并行拉取不同区间
+            await transfer_core.serve_file(server_socket, temp_path, hasher=hasher, pending=pending,
+                                           throttle=job.athrottle)
+        except Exception as e:
+            print(f"发送文件失败: {e}")
+            raise
+        finally:
+            server_socket.close()
+            os.remove(temp_path)
+
+    return transfer_job
+
+def serve_temp_file(server_socket, temp_path, hasher, target_device, priority, filename, transfer_id):
+    return transfer_scheduler.submit(temp_file_job(server_socket, temp_path, hasher), 'send', target_device,
+                                     priority, filename, os.path.getsize(temp_path), transfer_id)
 
 @app.route('/api/transfer/send', methods=['POST'])
 def send_file():
-    if 'file' not in request.files:
+    # 表单字段需要放在文件之前：target_device、size（可选）、streams（可选）、
+    # priority（可选，interactive/normal/bulk）、file。
+    # 知道文件大小时先创建传输任务，接收端已连接就把请求体经环形缓冲区直接转发过去，
+    # 不落盘；接收端还没连上时才退回到先写临时文件的方式
+    start = time.perf_counter()
+    form = {}
+    filename = None
+    try:
+        parts = multipart_stream.iter_events(request.stream, request.content_type)
+        for event in parts:
+            if event[0] == 'field':
+                form[event[1]] = event[2]
+            elif event[0] == 'file' and event[1] == 'file':
+                filename = event[2]
+                break
+    except multipart_stream.MultipartError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+
+    if filename is None:
         return jsonify({
             'status': 'error',
             'message': '没有文件被上传'
         }), 400
 
-    target_device = request.form.get('target_device')
+    target_device = form.get('target_device')
     if not target_device:
         return jsonify({
             'status': 'error',
             'message': '未指定目标设备'
         }), 400
 
-    file = request.files['file']
-    if file.filename == '':
+    if filename == '':
         return jsonify({
             'status': 'error',
             'message': '没有选择文件'
         }), 400
 
-    # 保存文件到临时目录
-    temp_dir = os.path.join(os.path.dirname(__file__), 'temp')
-    os.makedirs(temp_dir, exist_ok=True)
-    temp_path = os.path.join(temp_dir, file.filename)
-    file.save(temp_path)
+    try:
+        streams = min(transfer.MAX_STREAMS, max(1, int(form.get('streams', transfer.DEFAULT_STREAMS))))
+        size = int(form['size']) if form.get('size') else None
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': '参数无效'
+        }), 400
+    priority = form.get('priority') or scheduler.DEFAULT_PRIORITY
+    if priority not in scheduler.PRIORITIES:
+        return jsonify({
+            'status': 'error',
+            'message': '参数无效'
+        }), 400
+
+    def file_chunks():
+        try:
+            for event in parts:
+                if event[0] == 'data':
+                    yield event[1]
+                elif event[0] == 'end':
+                    return
+        except multipart_stream.MultipartError as e:
+            raise transfer.TransferError(str(e))
 
     # 创建接收服务器
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    transfer.tune_socket(server_socket)
     server_socket.bind(('0.0.0.0', 0))
-    server_socket.listen(1)
+    server_socket.listen(transfer.MAX_STREAMS)
     _, port = server_socket.getsockname()
 
-    # 发送传输请求到服务器
+    hasher = integrity.ChunkHasher()
+    addresses = peer_addresses(target_device)
     try:
-        response = requests.post(
-            f"http://{state.server_ip}:{state.server_port}/api/transfer/init",
-            json={
-                'from_device': state.device_id,
-                'to_device': target_device,
-                'file_info': {
-                    'filename': file.filename,
+        # 流水线发送要在通知接收端之前就占到调度器中的位置：否则接收端连上后要空等到超时，
+        # 这个请求线程和连接也不受调度器的并发限制。没有空闲位置时退回临时文件方式排队
+        pipeline_slot = (transfer_scheduler.slot('send', target_device, priority, filename, size, wait=False)
+                         if size is not None else contextlib.nullcontext())
+        with pipeline_slot as job:
+            if job is None:
+                # 先落盘，此时整个文件的摘要也已算好
+                temp_path = spool_to_temp(filename, file_chunks(), hasher)
+                transfer_id = init_transfer(target_device, {
+                    'filename': filename,
                     'size': os.path.getsize(temp_path),
-                    'receive_port': port
-                }
-            }
-        )
-        
-        if response.status_code == 200:
-            transfer_id = response.json()['transfer_id']
-            
-            # 启动传输线程
-            def transfer_thread():
-                try:
-                    conn, addr = server_socket.accept()
-                    with open(temp_path, 'rb') as f:
-                        while chunk := f.read(8192):
-                            conn.send(chunk)
-                    conn.close()
-                finally:
-                    server_socket.close()
-                    os.remove(temp_path)
+                    'receive_port': port,
+                    'addresses': addresses,
+                    'streams': streams,
+                    'checksum': hasher.describe(),
+                    'delta': True,
+                    'compression': compression.offer(filename),
+                    'priority': priority
+                })
+                job = serve_temp_file(server_socket, temp_path, hasher, target_device, priority, filename,
+                                      transfer_id)
+                return jsonify({
+                    'status': 'success',
+                    'transfer_id': transfer_id,
+                    'job_id': job.id,
+                    'mode': 'temp_file'
+                })
 
-            threading.Thread(target=transfer_thread, daemon=True).start()
-            
-            return jsonify({
-                'status': 'success',
-                'transfer_id': transfer_id
+            # 流水线只能按顺序发送，所以只提供单连接；分块摘要随数据一起发送。
+            # 接收端已有旧版本时可以请求增量传输，这需要完整的源文件，因此会先落盘
+            transfer_id = init_transfer(target_device, {
+                'filename': filename,
+                'size': size,
+                'receive_port': port,
+                'addresses': addresses,
+                'streams': 1,
+                'checksum': {
+                    'algorithm': hasher.algorithm,
+                    'chunk_size': hasher.chunk_size
+                },
+                'delta': True,
+                'compression': compression.offer(filename),
+                'priority': priority
             })
+            job.transfer_id = transfer_id
+            pending = transfer.accept_request(server_socket, PIPELINE_CONNECT_TIMEOUT)
+            if pending is None or pending[1].get('op') == 'delta':
+                # 同一个任务转到后台发送临时文件，占用的位置不释放
+                temp_path = spool_to_temp(filename, file_chunks(), hasher)
+                transfer_scheduler.hand_off(job, temp_file_job(server_socket, temp_path, hasher, pending))
+                return jsonify({
+                    'status': 'success',
+                    'transfer_id': transfer_id,
+                    'job_id': job.id,
+                    'mode': 'delta' if pending else 'temp_file'
+                })
+
+            conn, header = pending
+            with conn:
+                if header.get('op') != 'range' or header.get('offset') != 0 or header.get('length') != size:
+                    # 流水线中的数据发送后不再保留，无法按区间重传
+                    raise transfer.TransferError('流水线模式下接收端必须请求完整文件')
+                transfer.tune_socket(conn)
+                if header.get('compression'):
+                    # 接收端选择了压缩：数据重新分块、自适应压缩成帧后再进入环形缓冲区
+                    level = int(header['level']) if header.get('level') is not None else None
+                    encoder = compression.AdaptiveEncoder(header['compression'], level)
+                    frames = compression.encode_chunks(file_chunks(), encoder, size, hasher)
+                    first_byte, _ = transfer.pipe_to_socket(frames, conn, None, throttle=job.throttle)
+                else:
+                    first_byte, _ = transfer.pipe_to_socket(file_chunks(), conn, size, hasher=hasher,
+                                                            throttle=job.throttle)
+                if header.get('checksums'):
+                    hasher.finish()
+                    transfer.send_trailer(conn, hasher.digests, 0, size, hasher.chunk_size)
+                # 等待接收端确认（接收端要先 fsync 并改名，等待时间与 serve_file 的空闲超时相同）。
+                # 没有确认、校验失败或要求重传（流水线中的数据已经不在了）都算失败：
+                # 在 slot 中抛出异常，调度器里的任务也记为失败，本次请求返回错误
+                done = transfer.accept_request(server_socket, transfer.IDLE_TIMEOUT)
+                if done is None:
+                    raise transfer.TransferError('等待接收端确认超时')
+                done[0].close()
+                if done[1].get('op') != 'done' or not done[1].get('ok', True):
+                    raise transfer.TransferError('接收端报告传输失败')
+        server_socket.close()
+        elapsed = time.perf_counter() - start
+        return jsonify({
+            'status': 'success',
+            'transfer_id': transfer_id,
+            'job_id': job.id,
+            'mode': 'pipelined',
+            'time_to_first_byte': round(first_byte, 3),
+            'elapsed': round(elapsed, 3)
+        })
     except Exception as e:
+        server_socket.close()
         return jsonify({
             'status': 'error',
             'message': str(e)
         }), 500
 
-@app.route('/api/transfer/receive', methods=['POST'])
-def receive_file():
-    data = request.json
-    file_info = data.get('file_info')
-    source_ip = data.get('source_ip')
-    receive_port = file_info.get('receive_port')
+@app.route('/api/transfer/send_dir', methods=['POST'])
+def send_directory():
+    # 发送本机上的整个目录：{"target_device", "path", "priority"（可选）}。
+    # 所有文件在一个连接上作为连续的数据流发送，只需要一次 /api/transfer/init
+    data = request.json or {}
+    target_device = data.get('target_device')
+    path = data.get('path')
+    priority = data.get('priority') or scheduler.DEFAULT_PRIORITY
+    if not target_device or not path or priority not in scheduler.PRIORITIES:
+        return jsonify({
+            'status': 'error',
+            'message': '参数无效'
+        }), 400
+    if not os.path.isdir(path):
+        return jsonify({
+            'status': 'error',
+            'message': '目录不存在'
+        }), 404
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    transfer.tune_socket(server_socket)
+    server_socket.bind(('0.0.0.0', 0))
+    server_socket.listen(1)
+    _, port = server_socket.getsockname()
+    try:
+        addresses = peer_addresses(target_device)
+        entries, count, size = batch.scan(path)
+        name = os.path.basename(os.path.normpath(path))
+        transfer_id = init_transfer(target_device, {
+            'filename': name,
+            'size': size,
+            'count': count,
+            'receive_port': port,
+            'addresses': addresses,
+            'batch': True,
+            'priority': priority
+        })
+    except Exception as e:
+        server_socket.close()
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
 
+    def transfer_job(job):
+        try:
+            batch.serve_batch(server_socket, entries, throttle=job.throttle)
+        except Exception as e:
+            print(f"发送目录失败: {e}")
+            raise
+        finally:
+            server_socket.close()
+
+    job = transfer_scheduler.submit(transfer_job, 'send', target_device, priority, name, size, transfer_id)
+    return jsonify({
+        'status': 'success',
+        'transfer_id': transfer_id,
+        'job_id': job.id,
+        'mode': 'batch'
+    })
+
+def download_name(filename):
+    # 请求来自其他设备，只取文件名部分，防止写到下载目录之外
+    name = os.path.basename(str(filename).replace('\\', '/'))
+    if name in ('', '.', '..'):
+        raise transfer.TransferError(f'无效的文件名: {filename!r}')
+    return name
+
+def start_receive(file_info, addresses, transfer_id=None):
+    # 在调度器中排队接收一个文件或目录，返回 Job；addresses 为发送端的候选地址，按顺序尝试，
+    # 连不上（双方还没有交换任何数据）时换下一个
+    if isinstance(addresses, str):
+        addresses = [addresses]
+    receive_port = file_info.get('receive_port')
     downloads_dir = os.path.expanduser('~/Downloads')
     os.makedirs(downloads_dir, exist_ok=True)
-    
-    def receive_thread():
+
+    priority = file_info.get('priority')
+    if priority not in scheduler.PRIORITIES:
+        priority = scheduler.DEFAULT_PRIORITY
+
+    async def receive_from(job, source_ip):
+        filepath = os.path.join(downloads_dir, download_name(file_info['filename']))
+        if file_info.get('batch'):
+            # 整个目录在一个连接上传输，边收边解包到同名目录（阻塞实现，在传输核心的线程池中执行）
+            result = await transfer_core.run_blocking(
+                lambda: batch.receive_batch(source_ip, receive_port, filepath, throttle=job.throttle))
+            print(f"批量接收完成: {result['count']} 个文件, {result['size']} 字节")
+            return
+        if file_info.get('delta') and os.path.isfile(filepath):
+            # 本地已有同名旧版本，只接收变化的部分
+            part_path = filepath + '.delta.part'
+
+            def receive_delta():
+                try:
+                    # receive_delta 已经 fsync 并按发送端给出的摘要校验过重建结果，没有摘要时不替换旧文件
+                    result = delta.receive_delta(
+                        source_ip, receive_port, filepath, part_path, file_info['size'],
+                        checksum=file_info.get('checksum')
+                    )
+                    if not result['verified']:
+                        raise transfer.TransferError('增量重建的文件无法校验')
+                    os.replace(part_path, filepath)
+                    return result
+                finally:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+
+            result = await transfer_core.run_blocking(receive_delta)
+            print(f"增量接收完成，复用了 {result['matched_bytes']} 字节")
+            return
+        result = await transfer_core.receive_file(
+            source_ip, receive_port, filepath, file_info['size'],
+            streams=min(transfer.DEFAULT_STREAMS, file_info.get('streams', 1)),
+            checksum=file_info.get('checksum'),
+            throttle=job.athrottle,
+            codecs=file_info.get('compression')
+        )
+        if result['retransmitted_chunks']:
+            print(f"重传了 {result['retransmitted_chunks']} 个校验失败的分块")
+
+    async def receive_job(job):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((source_ip, receive_port))
-            
-            filepath = os.path.join(downloads_dir, file_info['filename'])
-            with open(filepath, 'wb') as f:
-                while chunk := s.recv(8192):
-                    f.write(chunk)
-            s.close()
+            for i, source_ip in enumerate(addresses):
+                try:
+                    return await receive_from(job, source_ip)
+                except netio.ConnectError as e:
+                    if i == len(addresses) - 1:
+                        raise
+                    print(f"{e}，尝试下一个地址 {addresses[i + 1]}")
         except Exception as e:
             print(f"接收文件失败: {e}")
+            raise
+
+    return transfer_scheduler.submit(receive_job, 'receive', addresses[0], priority,
+                                     file_info.get('filename'), file_info.get('size'), transfer_id)
+
+@app.route('/api/transfer/receive', methods=['POST'])
+def receive_file():
+    # 手动接收（需要给出发送端地址）；通常由协调服务器推送的请求自动触发，见 accept_offer
+    data = request.json
+    # transfer_id 可选，带上时接收进度也会上报给服务器
+    job = start_receive(data.get('file_info'), data.get('source_ip'), data.get('transfer_id'))
+    return jsonify({'status': 'success', 'job_id': job.id})
+
+# 接收端：协调服务器把发给本机的传输请求推送过来，直接连接发送端接收，不需要轮询。
+# 重连后的快照会再次包含还没结束的请求，按 transfer_id 去重
+ACCEPTED_OFFERS = 1000
+
+def accept_offer(offer):
+    transfer_id = offer.get('transfer_id')
+    file_info = offer.get('file_info') or {}
+    with state.offers_lock:
+        if not transfer_id or transfer_id in state.accepted_offers:
+            return None
+        state.accepted_offers[transfer_id] = True
+        while len(state.accepted_offers) > ACCEPTED_OFFERS:
+            state.accepted_offers.popitem(last=False)
+    addresses = rendezvous.order_addresses((file_info.get('addresses') or []) + [offer.get('source_ip')])
+    if not addresses or not file_info.get('receive_port') or not file_info.get('filename'):
+        print(f"忽略无效的传输请求: {transfer_id}")
+        return None
+    print(f"收到传输请求 {transfer_id}: {file_info['filename']}，依次尝试 {', '.join(addresses)}")
+    return start_receive(file_info, addresses, transfer_id)
+
+def on_offers_snapshot(offers, epoch, seq):
+    for offer in offers:
+        accept_offer(offer)
+
+def on_offer_event(event):
+    accept_offer(dict(event['task'], transfer_id=event['transfer_id']))
+
+def offers_thread():
+    events.follow(lambda: server_url() if state.is_registered else None,
+                  on_offers_snapshot, on_offer_event, session=coordinator_client.session,
+                  snapshot_path='/api/transfer/offers', events_path='/api/transfer/events',
+                  event_type='transfer', snapshot_key='offers', params={'device_id': state.device_id})
 
-    threading.Thread(target=receive_thread, daemon=True).start()
+@app.route('/api/discovery')
+def discovery_status():
+    # 发现的所有协调服务器地址、探测到的延迟以及当前选用的一个
+    return jsonify({'status': 'success', 'servers': discovery_service.candidates()})
+
+@app.route('/api/transfer/status')
+def transfer_status():
+    # 调度器的队列：运行中和排队的任务、最近结束的任务以及当前的限制；
+    # epoch 和 seq 用于之后订阅 /api/transfer/events
+    epoch, seq = transfer_scheduler.events.cursor()
+    return jsonify(dict(transfer_scheduler.status(), status='success', epoch=epoch, seq=seq))
+
+@app.route('/api/transfer/cancel/<job_id>', methods=['POST'])
+def cancel_transfer(job_id):
+    # 取消排队中的任务或正在进行的文件收发；接收端删除未完成的 .part 文件
+    if not transfer_scheduler.cancel(job_id):
+        return jsonify({
+            'status': 'error',
+            'message': '任务不存在、已经结束或无法取消'
+        }), 404
     return jsonify({'status': 'success'})
 
+@app.route('/api/transfer/events')
+def transfer_events():
+    # SSE：任务的排队、开始、进度（每个任务约每 0.5 秒一次）和结束
+    cursor = events.parse_cursor(
+        request.headers.get('Last-Event-ID') or request.args.get('epoch'),
+        request.args.get('since')
+    )
+    return Response(events.sse_stream(transfer_scheduler.events, cursor, event_type='transfer'),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    with state.devices_lock:
+        known = len(state.devices)
+    families = transfer_scheduler.metric_families() + [
+        ('erevent_client_known_devices', 'gauge', '本机设备列表中的设备数', [({}, known)]),
+    ]
+    return Response(metrics.render(families), content_type=metrics.CONTENT_TYPE)
+
 def main():
     # 创建必要的目录
     os.makedirs('temp', exist_ok=True)
     
     print("Starting ER-Event client...")
     # 启动服务发现
-    zeroconf = start_service_discovery()
+    discovery_service.start()
     
     # 启动心跳线程
     threading.Thread(target=heartbeat_thread, daemon=True).start()
+    # 订阅设备列表的变化
+    threading.Thread(target=presence_thread, daemon=True).start()
+    # 订阅发给本机的传输请求
+    threading.Thread(target=offers_thread, daemon=True).start()
     
     try:
         # 启动Flask应用
@@ -253,7 +652,7 @@ def main():
         print(f"Client web interface available at http://localhost:{port}")
         app.run(host='localhost', port=port, debug=True)
     finally:
-        zeroconf.close()
+        discovery_service.close()
 
 if __name__ == '__main__':
     main()
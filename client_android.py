@@ -10,16 +10,18 @@ from kivy.core.window import Window
 from kivy.clock import Clock
 from kivy.utils import platform
 from kivy.lang import Builder
-import requests
 import threading
 import uuid
 import json
 import socket
 import time
 from datetime import datetime
-from zeroconf import ServiceBrowser, ServiceListener, Zeroconf
 import os
 from functools import partial
+import coordinator
+import discovery
+import events
+import heartbeat
 
 # 设置窗口大小（仅用于测试）
 if platform != 'android':
@@ -117,41 +119,65 @@ class RegisterScreen(MDScreen):
             return
 
         try:
-            response = requests.post(
-                f"http://{self.app.server_ip}:{self.app.server_port}/api/register",
-                json={
-                    'device_id': self.app.device_id,
-                    'device_name': device_name
-                }
-            )
-            if response.status_code == 200:
-                self.app.device_name = device_name
-                self.app.is_registered = True
-                self.manager.current = 'main'
-            else:
-                self.ids.server_status.text = "注册失败：" + response.json().get('message', '')
-        except Exception as e:
-            self.ids.server_status.text = f"注册失败：{str(e)}"
+            self.app.coordinator.register(self.app.device_id, device_name)
+            self.app.device_name = device_name
+            self.app.is_registered = True
+            self.manager.current = 'main'
+        except coordinator.CoordinatorError as e:
+            self.ids.server_status.text = f"注册失败：{e.message}"
 
 class MainScreen(MDScreen):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.app = MDApp.get_running_app()
-        Clock.schedule_interval(self.refresh_devices, 5)
+        # 设备列表由服务器推送的变化增量维护，不再定时拉取
+        self.devices = {}
+        self.devices_lock = threading.Lock()
+        self._redraw_scheduled = False
+        threading.Thread(target=self.presence_thread, daemon=True).start()
+
+    def server_url(self):
+        if not self.app.is_registered:
+            return None
+        return self.app.server_url()
+
+    def presence_thread(self):
+        events.follow(self.server_url, self.on_snapshot, self.on_event, session=self.app.coordinator.session)
+
+    def on_snapshot(self, devices, epoch, seq):
+        with self.devices_lock:
+            self.devices = devices
+        self.schedule_redraw()
+
+    def on_event(self, event):
+        with self.devices_lock:
+            events.apply_event(self.devices, event)
+        self.schedule_redraw()
+
+    def schedule_redraw(self):
+        # 控件只能在主线程修改；一帧内的多个事件合并为一次重绘
+        if not self._redraw_scheduled:
+            self._redraw_scheduled = True
+            Clock.schedule_once(self.redraw)
+
+    def redraw(self, *args):
+        self._redraw_scheduled = False
+        with self.devices_lock:
+            devices = dict(self.devices)
+        self.update_device_list(devices)
 
     def refresh_devices(self, *args):
         if not self.app.is_registered:
             return
         
         try:
-            response = requests.get(
-                f"http://{self.app.server_ip}:{self.app.server_port}/api/devices"
-            )
-            if response.status_code == 200:
-                devices = response.json()['devices']
-                self.update_device_list(devices)
-        except Exception as e:
-            self.ids.status_label.text = f"刷新设备列表失败：{str(e)}"
+            # 连续点击刷新时在缓存有效期内复用同一次请求的结果
+            devices = self.app.coordinator.devices()['devices']
+            with self.devices_lock:
+                self.devices = dict(devices)
+            self.update_device_list(devices)
+        except coordinator.CoordinatorError as e:
+            self.ids.status_label.text = f"刷新设备列表失败：{e.message}"
 
     def update_device_list(self, devices):
         self.ids.device_list.clear_widgets()
@@ -170,20 +196,6 @@ class MainScreen(MDScreen):
         # TODO: 实现文件选择和发送功能
         pass
 
-class ServiceDiscoveryListener(ServiceListener):
-    def add_service(self, zc, type_, name):
-        info = zc.get_service_info(type_, name)
-        if info:
-            app = MDApp.get_running_app()
-            app.server_ip = socket.inet_ntoa(info.addresses[0])
-            app.server_port = info.port
-
-    def remove_service(self, zc, type_, name):
-        pass
-
-    def update_service(self, zc, type_, name):
-        pass
-
 class EREventApp(MDApp):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -192,38 +204,43 @@ class EREventApp(MDApp):
         self.server_ip = None
         self.server_port = None
         self.is_registered = False
-        self.zeroconf = None
+        self.discovery = None
+        # 访问协调服务器的请求共用一个连接池
+        self.coordinator = coordinator.CoordinatorClient(self.server_url, on_unreachable=self.report_unreachable)
 
     def build(self):
         self.theme_cls.primary_palette = "Blue"
         return Builder.load_string(KV)
 
     def on_start(self):
-        # 启动服务发现
-        self.zeroconf = Zeroconf()
-        self.listener = ServiceDiscoveryListener()
-        self.browser = ServiceBrowser(
-            self.zeroconf, "_erevent._tcp.local.", self.listener
-        )
+        # 启动服务发现：上次使用的服务器缓存在应用数据目录中，启动时不必等 mDNS
+        self.discovery = discovery.Discovery(
+            on_change=self.on_server_change,
+            cache_path=os.path.join(self.user_data_dir, 'discovery.json')
+        ).start()
 
         # 启动心跳线程
         threading.Thread(target=self.heartbeat_thread, daemon=True).start()
 
+    def on_server_change(self, server):
+        # 在探测线程中调用，server 为 None 表示没有可用的服务器
+        self.server_ip, self.server_port = (server.host, server.port) if server else (None, None)
+        self.coordinator.invalidate()
+
+    def report_unreachable(self):
+        if self.discovery:
+            self.discovery.report_failure()
+
+    def server_url(self):
+        return self.discovery.base_url() if self.discovery else None
+
     def heartbeat_thread(self):
-        while True:
-            if self.is_registered and self.server_ip:
-                try:
-                    requests.post(
-                        f"http://{self.server_ip}:{self.server_port}/api/heartbeat",
-                        json={'device_id': self.device_id}
-                    )
-                except:
-                    pass
-            time.sleep(30)
+        heartbeat.run(self.coordinator, lambda: (self.device_id, self.device_name) if self.is_registered else None)
 
     def on_stop(self):
-        if self.zeroconf:
-            self.zeroconf.close()
+        if self.discovery:
+            self.discovery.close()
+        self.coordinator.close()
 
 if __name__ == '__main__':
     EREventApp().run()
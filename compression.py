@@ -0,0 +1,297 @@
+import os
+import struct
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+import netio
+
+# 传输压缩：发送端在 file_info 中列出支持的算法，接收端选一个双方都支持的，
+# 在区间请求的控制头中带上 {"compression": "zstd", "level": 3}（level 可省略）。
+# 之后该区间的数据按块分帧发送：
+#   R + 长度(I) + 长度(I) + 原始数据            不压缩（文件数据仍走 sendfile）
+#   Z + 压缩后长度(I) + 原始长度(I) + 压缩数据
+# 校验摘要始终按原始数据计算，与不压缩时相同。
+#
+# 是否压缩按块自适应：先试压一块，压缩率不够（已经压缩过的图片、视频、压缩包）时后续块直接发送，
+# 每 PROBE_INTERVAL 块再试一次；压缩率够时再实测两种方式的吞吐（见 AdaptiveEncoder），
+# 链路比压缩快（如有线局域网）时也不压缩
+
+BLOCK_SIZE = 1024 * 1024
+# 压缩后不大于原始大小的该比例才值得压缩
+MAX_RATIO = 0.9
+PROBE_INTERVAL = 32
+# 实测吞吐时每种方式至少测几块，之后每隔多少块重新测一次另一种方式
+PROBE_BLOCKS = 4
+REPROBE_INTERVAL = 256
+# 切换到直接发送后先填满套接字缓冲区，这部分不计入测速
+RAW_WARMUP = 2 * max(netio.SOCKET_BUFFER_SIZE, BLOCK_SIZE)
+# 环境变量 EREVENT_COMPRESSION：逗号分隔的算法列表（按优先顺序），off 表示不压缩
+PREFERENCE = [name.strip() for name in os.environ.get('EREVENT_COMPRESSION', 'zstd,lz4,zlib').split(',')
+              if name.strip() and name.strip() != 'off']
+LEVEL = int(os.environ['EREVENT_COMPRESSION_LEVEL']) if os.environ.get('EREVENT_COMPRESSION_LEVEL') else None
+DEFAULT_LEVELS = {'zstd': 3, 'lz4': 0, 'zlib': 1}
+# 这些类型的文件本身已经压缩过，不提供压缩
+COMPRESSED_SUFFIXES = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.aac', '.ogg', '.flac', '.m4a',
+    '.mp4', '.mkv', '.mov', '.avi', '.webm', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar',
+    '.apk', '.jar', '.docx', '.xlsx', '.pptx', '.pdf',
+}
+
+_FRAME = struct.Struct('!cII')
+_RAW = b'R'
+_COMPRESSED = b'Z'
+FRAME_SIZE = _FRAME.size
+
+
+def codecs():
+    names = []
+    if zstandard is not None:
+        names.append('zstd')
+    if lz4_frame is not None:
+        names.append('lz4')
+    names.append('zlib')
+    return names
+
+
+def offer(filename=None):
+    # 发送端写入 file_info 的候选算法，不值得压缩时返回 None
+    if filename and os.path.splitext(filename)[1].lower() in COMPRESSED_SUFFIXES:
+        return None
+    available = codecs()
+    return [name for name in PREFERENCE if name in available] or None
+
+
+def negotiate(offered):
+    # 接收端选择算法：按发送端的顺序取第一个本地也启用的，返回区间请求中的参数或 None
+    if not offered:
+        return None
+    available = set(codecs()) & set(PREFERENCE)
+    for name in offered:
+        if name in available:
+            params = {'compression': name}
+            if LEVEL is not None:
+                params['level'] = LEVEL
+            return params
+    return None
+
+
+def compressor(codec, level=None):
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress
+    if codec == 'lz4' and lz4_frame is not None:
+        return lambda data: lz4_frame.compress(data, compression_level=level)
+    if codec == 'zlib':
+        return lambda data: zlib.compress(data, level)
+    raise netio.TransferError(f'不支持的压缩算法: {codec}')
+
+
+def decompressor(codec):
+    # 返回 decompress(data, size)：帧来自对端，解压时最多产生 size + 1 字节，
+    # 超过 size 即拒绝，防止很小的帧解压出大量数据占满内存
+    if codec == 'zstd' and zstandard is not None:
+        d = zstandard.ZstdDecompressor()
+        decompress, errors = (lambda data, limit: _zstd_decompress(d, data, limit)), zstandard.ZstdError
+    elif codec == 'lz4' and lz4_frame is not None:
+        decompress = lambda data, limit: lz4_frame.LZ4FrameDecompressor().decompress(data, max_length=limit)
+        errors = RuntimeError
+    elif codec == 'zlib':
+        decompress, errors = (lambda data, limit: zlib.decompressobj().decompress(data, limit)), zlib.error
+    else:
+        raise netio.TransferError(f'不支持的压缩算法: {codec}')
+
+    def checked(data, size):
+        try:
+            out = decompress(data, size + 1)
+        except errors as e:
+            raise netio.TransferError(f'压缩帧无法解压: {e}')
+        if len(out) > size:
+            raise netio.TransferError('解压后的数据超出帧声明的长度')
+        return out
+
+    return checked
+
+
+def _zstd_decompress(d, data, limit):
+    # 帧头声明的长度超过 limit 时直接拒绝；没有声明时逐段读取，最多读 limit 字节
+    if zstandard.frame_content_size(data) > limit:
+        raise netio.TransferError('解压后的数据超出帧声明的长度')
+    parts = []
+    total = 0
+    with d.stream_reader(data) as reader:
+        while total < limit:
+            chunk = reader.read(limit - total)
+            if not chunk:
+                break
+            parts.append(chunk)
+            total += len(chunk)
+    return b''.join(parts)
+
+
+class AdaptiveEncoder:
+    # 按块决定是否压缩。压缩与发送同时进行（套接字有缓冲），压缩方式的吞吐约为
+    # min(压缩速度, 链路速度 / 压缩率)，只有压缩速度高于链路速度时才比直接发送快。
+    # 调用方通过 observe 提供每块的耗时时，两种方式轮流实测吞吐，取较快的一种，
+    # 每 REPROBE_INTERVAL 块再测一次另一种；不提供耗时时只按压缩率决定
+    def __init__(self, codec, level=None):
+        self.codec = codec
+        self.compress = compressor(codec, level)
+        self.mode = 'compress'
+        self.ratio = None
+        self.rates = {'compress': None, 'raw': None}
+        self.blocks = 0
+        self.samples = 0
+        self.warm = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def wants(self):
+        # 下一块是否压缩（否则调用方可以直接发送原始数据，不必先读出来）
+        return self.mode == 'compress'
+
+    def encode(self, block):
+        # 返回一帧（帧头 + 数据），压缩效果不好时仍发送原始数据
+        data = self.compress(block)
+        ratio = len(data) / max(1, len(block))
+        self.ratio = ratio if self.ratio is None else self.ratio * 0.5 + ratio * 0.5
+        self.raw_bytes += len(block)
+        if ratio > MAX_RATIO:
+            self.wire_bytes += _FRAME.size + len(block)
+            return _FRAME.pack(_RAW, len(block), len(block)) + block
+        self.wire_bytes += _FRAME.size + len(data)
+        return _FRAME.pack(_COMPRESSED, len(data), len(block)) + data
+
+    def raw_header(self, size):
+        self.raw_bytes += size
+        self.wire_bytes += _FRAME.size + size
+        return _FRAME.pack(_RAW, size, size)
+
+    def observe(self, nbytes, seconds=None):
+        # 每发送一块（nbytes 为原始字节数）调用一次，seconds 为读取、压缩和发送该块的总耗时
+        self.blocks += 1
+        if seconds is not None and seconds > 0:
+            self.warm += nbytes
+            # 刚切换到直接发送时数据先进入套接字缓冲区，测得的速度偏高，跳过这一段
+            if self.mode == 'compress' or self.warm > RAW_WARMUP:
+                rate = nbytes / seconds
+                old = self.rates[self.mode]
+                self.rates[self.mode] = rate if old is None or self.samples == 0 else old * 0.5 + rate * 0.5
+                self.samples += 1
+        self._decide(seconds is not None)
+
+    def _switch(self, mode):
+        if mode != self.mode:
+            self.mode = mode
+            self.blocks = 0
+            self.samples = 0
+            self.warm = 0
+
+    def _decide(self, timed):
+        if self.ratio is not None and self.ratio > MAX_RATIO:
+            # 压缩不了的数据直接发送，隔一段时间再试压一块
+            if self.mode == 'compress':
+                self._switch('raw')
+            elif self.blocks >= PROBE_INTERVAL:
+                self._switch('compress')
+            return
+        if not timed or self.samples < PROBE_BLOCKS:
+            return
+        other = 'raw' if self.mode == 'compress' else 'compress'
+        if self.rates[other] is None or self.blocks >= REPROBE_INTERVAL:
+            self._switch(other)
+        elif self.rates[other] > self.rates[self.mode]:
+            self._switch(other)
+
+
+def send_range(sock, f, offset, length, encoder, throttle=None):
+    # 文件区间的压缩发送；不压缩的块仍用 sendfile。throttle 按实际发送的字节数调用
+    fd = f.fileno()
+    end = offset + length
+    while offset < end:
+        n = min(BLOCK_SIZE, end - offset)
+        start = time.perf_counter()
+        if encoder.wants():
+            block = netio.pread(fd, n, offset)
+            if len(block) != n:
+                raise netio.TransferError('文件在发送过程中被截断')
+            frame = encoder.encode(block)
+            if throttle is not None:
+                throttle(len(frame))
+            sock.sendall(frame)
+        else:
+            header = encoder.raw_header(n)
+            if throttle is not None:
+                throttle(n + len(header))
+            sock.sendall(header)
+            netio.send_file(sock, f, offset, n)
+        encoder.observe(n, time.perf_counter() - start)
+        offset += n
+
+
+def encode_chunks(chunks, encoder, size, hasher=None):
+    # 流水线发送：把顺序到达的数据重新切成 BLOCK_SIZE 的块并逐块编码成帧；
+    # 数据总量必须等于 size，hasher 按原始数据计算。
+    # 这里的耗时主要取决于上游数据到达的速度，因此只按压缩率决定是否压缩
+    buf = bytearray()
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        if total > size:
+            raise netio.TransferError('数据超出声明的文件大小')
+        if hasher is not None:
+            hasher.update(chunk)
+        buf += chunk
+        while len(buf) >= BLOCK_SIZE:
+            yield _encode_block(encoder, bytes(buf[:BLOCK_SIZE]))
+            del buf[:BLOCK_SIZE]
+    if buf:
+        yield _encode_block(encoder, bytes(buf))
+    if total != size:
+        raise netio.TransferError(f'数据不完整: {total}/{size} 字节')
+
+
+def _encode_block(encoder, block):
+    frame = encoder.encode(block) if encoder.wants() else encoder.raw_header(len(block)) + block
+    encoder.observe(len(block))
+    return frame
+
+
+def parse_frame(data, remaining):
+    # 解析并检查帧头，返回 (是否压缩, 线路上的长度, 原始长度)；remaining 为区间内还未接收的原始字节数
+    kind, wire, size = _FRAME.unpack(data)
+    if size > BLOCK_SIZE or size > remaining or kind not in (_RAW, _COMPRESSED):
+        raise netio.TransferError('压缩帧无效')
+    if (kind == _RAW and wire != size) or wire > BLOCK_SIZE * 2:
+        raise netio.TransferError('压缩帧无效')
+    return kind == _COMPRESSED, wire, size
+
+
+def recv_range(sock, sink, offset, length, codec, hasher=None, throttle=None):
+    # 接收压缩区间并写到 sink（transfer.FileSink）的 offset 处；throttle 按实际接收的字节数调用
+    decompress = decompressor(codec)
+    received = 0
+    while received < length:
+        compressed, wire, size = parse_frame(netio.recv_exact(sock, FRAME_SIZE), length - received)
+        if not compressed:
+            sink.recv_range(sock, offset + received, size, hasher, throttle)
+        else:
+            data = decompress(netio.recv_exact(sock, wire), size)
+            if len(data) != size:
+                raise netio.TransferError('解压后的长度不一致')
+            sink.write(data, offset + received)
+            if hasher is not None:
+                hasher.update(data)
+            if throttle is not None:
+                throttle(wire)
+        received += size
+    return received
@@ -0,0 +1,180 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 客户端访问协调服务器（server.py）的公共层，client.py 和 client_android.py 共用：
+# 所有请求复用同一个 Session 的 keep-alive 连接池，每个请求都有超时，
+# 失败时按指数退避重试；设备列表在 DEVICE_CACHE_TTL 内复用同一次请求的结果，
+# 同时到达的多个请求也只向服务器请求一次。
+# 传输进度由 ProgressReporter 在后台线程中合并后定期上报
+
+# (连接超时, 读取超时)
+TIMEOUT = (3.05, 10)
+RETRIES = 2
+BACKOFF = 0.5
+MAX_BACKOFF = 5
+POOL_SIZE = 8
+DEVICE_CACHE_TTL = 2
+# 这些状态码表示服务器暂时不可用，可以重试
+RETRY_STATUS = (502, 503, 504)
+# 向服务器上报同一传输进度的最短间隔（秒），期间的多次更新只发送最后一次；结束状态立即发送
+PROGRESS_INTERVAL = 1
+FINAL_STATES = ('done', 'failed', 'cancelled')
+
+
+class CoordinatorError(Exception):
+    # status 为服务器返回的状态码，无法连接到服务器时为 None
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _connect_failed(e):
+    # 连接没有建立时请求一定没有发出，非幂等的请求也可以安全重试
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if not isinstance(e, requests.ConnectionError):
+        return False
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return 'NewConnectionError' in type(reason).__name__ or isinstance(reason, ConnectionRefusedError)
+
+
+def _error_message(response):
+    try:
+        return response.json().get('message') or response.text
+    except ValueError:
+        return response.text
+
+
+class CoordinatorClient:
+    def __init__(self, get_base_url, timeout=TIMEOUT, retries=RETRIES, device_ttl=DEVICE_CACHE_TTL,
+                 on_unreachable=None):
+        # get_base_url 返回当前服务器地址（如 http://192.168.1.2:5000），还没找到时返回 None；
+        # 连接不上服务器时调用 on_unreachable()（例如让服务发现立即重新探测），重试时会重新取地址
+        self.get_base_url = get_base_url
+        self.on_unreachable = on_unreachable
+        self.timeout = timeout
+        self.retries = retries
+        self.device_ttl = device_ttl
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._devices = None
+        self._devices_key = None
+        self._devices_at = 0
+        self._devices_lock = threading.Lock()
+
+    def base_url(self):
+        return self.get_base_url()
+
+    def request(self, method, path, json=None, params=None, timeout=None, retries=None, idempotent=True):
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            base_url = self.get_base_url()
+            if not base_url:
+                raise CoordinatorError('正在搜索服务器，请稍后再试')
+            try:
+                response = self.session.request(method, f'{base_url}{path}', json=json, params=params,
+                                                timeout=timeout or self.timeout)
+                if response.status_code not in RETRY_STATUS or not idempotent or attempt >= retries:
+                    break
+            except requests.RequestException as e:
+                if self.on_unreachable is not None and _connect_failed(e):
+                    self.on_unreachable()
+                if attempt >= retries or not (idempotent or _connect_failed(e)):
+                    raise CoordinatorError(f'无法连接到服务器: {e}') from e
+            attempt += 1
+            time.sleep(min(MAX_BACKOFF, BACKOFF * 2 ** (attempt - 1)) * random.uniform(0.5, 1))
+        if response.status_code != 200:
+            raise CoordinatorError(_error_message(response), response.status_code)
+        try:
+            return response.json()
+        except ValueError as e:
+            raise CoordinatorError('服务器返回了无效的数据', response.status_code) from e
+
+    def register(self, device_id, device_name):
+        # 重复注册只会覆盖原有记录，可以重试
+        result = self.request('POST', '/api/register', json={
+            'device_id': device_id,
+            'device_name': device_name
+        })
+        self.invalidate()
+        return result
+
+    def heartbeat(self, device_id, retries=0):
+        # 心跳自己会按间隔重发，默认不重试
+        return self.request('POST', '/api/heartbeat', json={'device_id': device_id}, retries=retries)
+
+    def init_transfer(self, from_device, to_device, file_info):
+        # 每次调用都会创建新任务，只在连接没有建立时重试
+        data = self.request('POST', '/api/transfer/init', json={
+            'from_device': from_device,
+            'to_device': to_device,
+            'file_info': file_info
+        }, idempotent=False)
+        return data['transfer_id']
+
+    def report_progress(self, transfer_id, report):
+        # 进度很快会被下一次上报覆盖，失败不重试
+        return self.request('POST', f'/api/transfer/progress/{transfer_id}', json=report, retries=0)
+
+    def devices(self, max_age=None):
+        # 返回 {'devices', 'epoch', 'seq'}；max_age=0 时强制重新获取
+        max_age = self.device_ttl if max_age is None else max_age
+        key = self.get_base_url()
+        with self._devices_lock:
+            # 持锁请求：缓存过期时同时到达的调用等待同一次请求的结果
+            if (self._devices is None or self._devices_key != key
+                    or time.monotonic() - self._devices_at >= max_age):
+                self._devices = self.request('GET', '/api/devices')
+                self._devices_key = key
+                self._devices_at = time.monotonic()
+            return self._devices
+
+    def invalidate(self):
+        with self._devices_lock:
+            self._devices = None
+
+    def close(self):
+        self.session.close()
+
+
+class ProgressReporter:
+    # update 只记下每个传输的最新进度，不阻塞传输线程；后台线程负责发送
+    def __init__(self, client, interval=PROGRESS_INTERVAL):
+        self.client = client
+        self.interval = interval
+        self._latest = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def update(self, transfer_id, report):
+        with self._cond:
+            self._latest[transfer_id] = report
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            if report.get('state') in FINAL_STATES:
+                self._cond.notify()
+
+    def _final_pending(self):
+        return any(report.get('state') in FINAL_STATES for report in self._latest.values())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._latest)
+                batch, self._latest = self._latest, {}
+            for transfer_id, report in batch.items():
+                try:
+                    self.client.report_progress(transfer_id, report)
+                except CoordinatorError:
+                    pass
+            with self._cond:
+                self._cond.wait_for(self._final_pending, self.interval)
@@ -0,0 +1,307 @@
+import hashlib
+import mmap
+import os
+import struct
+from itertools import accumulate, compress, repeat
+from operator import and_, lshift, mul, or_, sub
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import integrity
+import netio
+
+# rsync 式增量传输：接收端对已有的旧文件按块计算签名（弱滚动校验 + 强摘要），
+# 发送端在新文件里查找这些块，只把对不上的部分作为原始数据发送，
+# 其余部分让接收端从旧文件复制。
+#
+# 发送端的查找分两步：先检查当前位置是否正好是某个旧块，不是的话一次算出其后
+# block_size 个偏移上的全部弱校验（用前缀和代替逐字节滚动），按顺序核对强摘要，
+# 因此任意长度的插入/删除之后，下一个旧块一出现就能重新对齐。
+# 安装了 numpy 时这一步是向量化的，每次未命中都完整查找；否则在 C 层用
+# itertools/operator 计算，开销较大，连续未命中时只在第 1、2 块和之后每 SCAN_INTERVAL 块
+# 查找一次，大段改动的文件不会因此慢太多
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+# 没有 numpy 时，连续未命中期间每隔多少块完整查找一次
+SCAN_INTERVAL = 8
+# numpy 粗筛弱校验用的位图大小
+_BITMAP_BITS = 20
+# 原始数据帧的最大长度
+MAX_LITERAL = 1024 * 1024
+# 签名大小上限（64KB 块时约对应 200GB 的旧文件）
+MAX_SIGNATURE_SIZE = 64 * 1024 * 1024
+
+_STRONG_SIZE = 16
+_SIG_ENTRY = struct.Struct(f'!I{_STRONG_SIZE}s')
+_COPY = struct.Struct('!cQI')
+_DATA = struct.Struct('!cI')
+_END = b'E'
+
+
+def choose_block_size(size):
+    # 与 rsync 一样取文件大小的平方根附近，限制在合理范围内并对齐到 4KB
+    block = int(size ** 0.5) // MIN_BLOCK_SIZE * MIN_BLOCK_SIZE
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, max(block, DEFAULT_BLOCK_SIZE)))
+
+
+def weak_checksum(block):
+    # rsync 弱校验：a = Σx，b = Σ(L - i)·x = 前缀和之和，两者各取低 16 位
+    a = sum(block) & 0xffff
+    b = sum(accumulate(block)) & 0xffff
+    return a, b
+
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=_STRONG_SIZE).digest()
+
+
+def signature(path, block_size=None):
+    # 返回打包好的签名，每块 20 字节：弱校验 + 强摘要
+    size = os.path.getsize(path)
+    block_size = block_size or choose_block_size(size)
+    entries = []
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            a, b = weak_checksum(block)
+            entries.append(_SIG_ENTRY.pack(a | (b << 16), strong_checksum(block)))
+    return block_size, b''.join(entries)
+
+
+def _parse_signature(data, block_size, basis_size):
+    table = {}
+    count = len(data) // _SIG_ENTRY.size
+    for index in range(count):
+        weak, strong = _SIG_ENTRY.unpack_from(data, index * _SIG_ENTRY.size)
+        length = min(block_size, basis_size - index * block_size)
+        table.setdefault(weak, []).append((index, strong, length))
+    return table
+
+
+def weak_checksums(data, L):
+    # data 中每个长度为 L 的窗口的弱校验，与 weak_checksum 打包后的值相同；
+    # 安装了 numpy 时返回 numpy 数组，否则返回列表。
+    # 窗口 r 的 a = S[r+L] - S[r]，b = Σ(r+L-j)·x_j = (r+L)·a - (T[r+L] - T[r])，
+    # 其中 S、T 分别是 x_j 与 j·x_j 的前缀和
+    n = max(0, len(data) - L + 1)
+    if numpy is not None:
+        x = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+        s = numpy.concatenate(([0], numpy.cumsum(x)))
+        t = numpy.concatenate(([0], numpy.cumsum(x * numpy.arange(len(x), dtype=numpy.int64))))
+        a = s[L:] - s[:-L]
+        b = numpy.arange(L, L + n, dtype=numpy.int64) * a - (t[L:] - t[:-L])
+        return (a & 0xffff) | ((b & 0xffff) << 16)
+    s = list(accumulate(data, initial=0))
+    t = list(accumulate(map(mul, data, range(len(data))), initial=0))
+    a = list(map(sub, s[L:], s[:-L]))
+    b = map(sub, map(mul, range(L, L + n), a), map(sub, t[L:], t[:-L]))
+    return list(map(or_, map(and_, a, repeat(0xffff)), map(lshift, map(and_, b, repeat(0xffff)), repeat(16))))
+
+
+def compute_delta(path, sig_data, block_size, basis_size):
+    # 生成操作序列：('copy', 起始块, 块数) 或 ('data', bytes)
+    table = _parse_signature(sig_data, block_size, basis_size)
+    size = os.path.getsize(path)
+    L = block_size
+    if size == 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        def lookup(offset, weak, length=L):
+            candidates = table.get(weak)
+            if not candidates:
+                return None
+            strong = strong_checksum(mm[offset:offset + length])
+            for index, expected, block_length in candidates:
+                if block_length == length and expected == strong:
+                    return index
+            return None
+
+        bitmap = None
+        if numpy is not None:
+            bitmap = numpy.zeros(1 << _BITMAP_BITS, dtype=bool)
+            bitmap[numpy.fromiter(table, dtype=numpy.int64, count=len(table)) & ((1 << _BITMAP_BITS) - 1)] = True
+
+        def scan(start, end):
+            # 按顺序给出 [start, end) 内弱校验命中的 (偏移, 弱校验)
+            weaks = weak_checksums(mm[start:end + L - 1], L)
+            if bitmap is None:
+                return ((o, weaks[o - start]) for o in compress(range(start, end), map(table.__contains__, weaks)))
+            hits = numpy.flatnonzero(bitmap[weaks & ((1 << _BITMAP_BITS) - 1)])
+            return ((start + r, w) for r, w in zip(hits.tolist(), weaks[hits].tolist()) if w in table)
+
+        copy_start = None
+        copy_count = 0
+        literal_start = 0
+        pos = 0
+        misses = 0
+
+        def flush(end):
+            nonlocal copy_start, copy_count
+            ops = []
+            if copy_count:
+                ops.append(('copy', copy_start, copy_count))
+                copy_start, copy_count = None, 0
+            for start in range(literal_start, end, MAX_LITERAL):
+                ops.append(('data', mm[start:min(end, start + MAX_LITERAL)]))
+            return ops
+
+        def add_copy(index):
+            nonlocal copy_start, copy_count
+            if copy_count and copy_start + copy_count == index:
+                copy_count += 1
+                return []
+            ops = []
+            if copy_count:
+                ops.append(('copy', copy_start, copy_count))
+            copy_start, copy_count = index, 1
+            return ops
+
+        while size - pos >= L:
+            a, b = weak_checksum(mm[pos:pos + L])
+            index = lookup(pos, a | (b << 16))
+            if index is None:
+                # 核对 (pos, pos + L) 内所有弱校验命中的偏移，取第一个强摘要也相同的；
+                # 都没有时前进整块，保持与旧块对齐
+                start = pos + 1
+                end = min(pos + L, size - L + 1)
+                if bitmap is not None or misses < 2 or not misses % SCAN_INTERVAL:
+                    for o, weak in scan(start, end):
+                        index = lookup(o, weak)
+                        if index is not None:
+                            pos = o
+                            break
+                if index is None:
+                    misses += 1
+                    pos = end
+                    if pos - literal_start >= MAX_LITERAL:
+                        yield from flush(pos)
+                        literal_start = pos
+                    continue
+
+            if pos > literal_start:
+                yield from flush(pos)
+            yield from add_copy(index)
+            misses = 0
+            pos += L
+            literal_start = pos
+
+        # 末尾不足一块的部分可能与旧文件的最后一块相同
+        tail = size - pos
+        if tail and (basis_size % L) == tail:
+            a, b = weak_checksum(mm[pos:size])
+            index = lookup(pos, a | (b << 16), tail)
+            if index is not None:
+                if pos > literal_start:
+                    yield from flush(pos)
+                yield from add_copy(index)
+                pos = literal_start = size
+        yield from flush(size)
+        if copy_count:
+            yield ('copy', copy_start, copy_count)
+
+
+def serve_delta(conn, f, header, hasher=None):
+    # 发送端：读取接收端的签名，回送增量数据流。结束帧之后跟一个控制头，
+    # 带上 hasher（整个文件已经算好的分块摘要）得出的文件摘要，接收端用它校验重建结果
+    block_size = int(header['block_size'])
+    if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+        raise netio.TransferError('增量块大小无效')
+    if not 0 <= int(header['signature_length']) <= MAX_SIGNATURE_SIZE:
+        raise netio.TransferError('增量签名过大')
+    sig_data = netio.recv_exact(conn, int(header['signature_length']))
+    literal = 0
+    for op in compute_delta(f.name, sig_data, block_size, int(header['basis_size'])):
+        if op[0] == 'copy':
+            conn.sendall(_COPY.pack(b'C', op[1], op[2]))
+        else:
+            conn.sendall(_DATA.pack(b'D', len(op[1])))
+            conn.sendall(op[1])
+            literal += len(op[1])
+    conn.sendall(_END)
+    netio.send_header(conn, {'digest': hasher.file_digest() if hasher is not None else None})
+    return literal
+
+
+def receive_delta(host, port, basis_path, path, size, checksum=None, block_size=None):
+    # 接收端：以 basis_path 为旧版本，把重建的新文件写到 path（写完 fsync）。
+    # checksum 中没有 digest 时（流水线发送的请求）使用发送端在结束帧后给出的文件摘要
+    checksum = integrity.negotiate(checksum)
+    block_size, sig_data = signature(basis_path, block_size)
+    basis_size = os.path.getsize(basis_path)
+    hasher = integrity.ChunkHasher(checksum['algorithm'], checksum['chunk_size']) if checksum else None
+    digest = checksum.get('digest') if checksum else None
+    written = 0
+    literal = 0
+    # 连接失败时抛出 netio.ConnectError，发送端没有收到任何请求，不需要通知
+    s = netio.connect(host, port)
+    ok = False
+    try:
+        with s, open(basis_path, 'rb') as basis, open(path, 'wb') as out:
+            netio.tune_socket(s)
+            netio.send_header(s, {
+                'op': 'delta',
+                'block_size': block_size,
+                'basis_size': basis_size,
+                'signature_length': len(sig_data)
+            })
+            s.sendall(sig_data)
+            while True:
+                kind = netio.recv_exact(s, 1)
+                if kind == _END:
+                    digest = digest or netio.recv_header(s).get('digest')
+                    break
+                if kind == b'C':
+                    _, start, count = _COPY.unpack(kind + netio.recv_exact(s, _COPY.size - 1))
+                    # 复制的块必须完整落在旧文件内（最后一块可以不满）
+                    if count == 0 or (start + count - 1) * block_size >= basis_size:
+                        raise netio.TransferError('增量复制的范围超出旧文件')
+                    basis.seek(start * block_size)
+                    remaining = min(count * block_size, basis_size - start * block_size)
+                    if written + remaining > size:
+                        raise netio.TransferError('增量数据超出声明的文件大小')
+                    while remaining > 0:
+                        data = basis.read(min(netio.BUFFER_SIZE, remaining))
+                        if not data:
+                            raise netio.TransferError('旧文件比签名短')
+                        out.write(data)
+                        if hasher is not None:
+                            hasher.update(data)
+                        remaining -= len(data)
+                        written += len(data)
+                elif kind == b'D':
+                    _, length = _DATA.unpack(kind + netio.recv_exact(s, _DATA.size - 1))
+                    if length > MAX_LITERAL:
+                        raise netio.TransferError('增量数据帧过长')
+                    if written + length > size:
+                        raise netio.TransferError('增量数据超出声明的文件大小')
+                    data = netio.recv_exact(s, length)
+                    out.write(data)
+                    if hasher is not None:
+                        hasher.update(data)
+                    written += length
+                    literal += length
+                else:
+                    raise netio.TransferError('增量数据格式错误')
+            out.flush()
+            os.fsync(out.fileno())
+        if written != size:
+            raise netio.TransferError(f'增量重建后大小不符: {written}/{size} 字节')
+        if hasher is not None and digest:
+            hasher.finish()
+            if hasher.file_digest() != digest:
+                raise netio.TransferError('增量重建后的文件校验失败')
+        ok = True
+    finally:
+        netio.notify_done(host, port, ok)
+    return {
+        'size': size,
+        'literal_bytes': literal,
+        'matched_bytes': size - literal,
+        'signature_bytes': len(sig_data),
+        'verified': bool(hasher is not None and digest),
+    }
+
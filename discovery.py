@@ -0,0 +1,290 @@
+import asyncio
+import http.client
+import ipaddress
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from zeroconf import IPVersion, ServiceBrowser, ServiceListener, Zeroconf
+from zeroconf.asyncio import AsyncServiceInfo
+
+# 查找协调服务器。
+#
+# - 启动时先读取磁盘上缓存的服务器地址并立即探测，可用就直接使用，不必等 mDNS 应答
+# - mDNS 浏览到的每个 _erevent._tcp 实例的每个地址都作为候选，解析在 zeroconf 的事件循环里异步完成，
+#   不阻塞浏览线程；实例下线（remove_service）或地址变化（update_service）时更新候选
+# - 后台线程定期用 GET /api/health 探测所有候选，记录往返时间，选用可用且延迟最低的一个；
+#   当前服务器连续 FAILURES_BEFORE_DOWN 次探测失败（或请求报告连接失败后复查失败）时自动切换
+# - 选中的服务器变化时写回缓存并调用 on_change(candidate)，candidate 为 None 表示当前没有可用的服务器
+
+SERVICE_TYPE = '_erevent._tcp.local.'
+CACHE_PATH = os.environ.get('EREVENT_DISCOVERY_CACHE') or os.path.join(
+    os.path.expanduser('~'), '.erevent', 'discovery.json')
+HEALTH_PATH = '/api/health'
+PROBE_TIMEOUT = 1.0
+PROBE_INTERVAL = 10
+# 当前服务器探测失败后尽快复查
+RETRY_INTERVAL = 0.5
+# 有候选但都不可用时的探测间隔
+SEARCH_INTERVAL = 2
+FAILURES_BEFORE_DOWN = 2
+# 其他候选的延迟至少低这么多（秒）才切换过去，避免来回切换
+SWITCH_MARGIN = 0.005
+RESOLVE_TIMEOUT = 3
+PROBE_WORKERS = 8
+# 往返时间的平滑系数
+RTT_SMOOTHING = 0.3
+
+
+class Candidate:
+    __slots__ = ('host', 'port', 'names', 'rtt', 'failures', 'checked')
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        # 通告该地址的 mDNS 实例名；为空表示只来自缓存或实例已下线
+        self.names = set()
+        self.rtt = None
+        self.failures = 0
+        self.checked = None
+
+    @property
+    def key(self):
+        return self.host, self.port
+
+    @property
+    def healthy(self):
+        return self.rtt is not None and self.failures < FAILURES_BEFORE_DOWN
+
+    def url(self):
+        host = f'[{self.host}]' if ':' in self.host else self.host
+        return f'http://{host}:{self.port}'
+
+    def to_dict(self):
+        return {
+            'host': self.host,
+            'port': self.port,
+            'names': sorted(self.names),
+            'rtt_ms': round(self.rtt * 1000, 2) if self.rtt is not None else None,
+            'healthy': self.healthy,
+        }
+
+
+def probe(host, port, timeout=PROBE_TIMEOUT):
+    # 返回往返时间（秒），不可用时返回 None
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request('GET', HEALTH_PATH)
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            return None
+        return time.perf_counter() - start
+    except (OSError, http.client.HTTPException):
+        return None
+    finally:
+        conn.close()
+
+
+def _usable(address):
+    # 链路本地的 IPv6 地址需要带网卡编号，不便拼进 URL，跳过
+    try:
+        return not ipaddress.ip_address(address).is_link_local
+    except ValueError:
+        return False
+
+
+class _Listener(ServiceListener):
+    def __init__(self, discovery):
+        self.discovery = discovery
+
+    def add_service(self, zc, type_, name):
+        self.discovery._resolve(zc, type_, name)
+
+    def update_service(self, zc, type_, name):
+        self.discovery._resolve(zc, type_, name)
+
+    def remove_service(self, zc, type_, name):
+        self.discovery._withdraw(name)
+
+
+class Discovery:
+    def __init__(self, on_change=None, cache_path=CACHE_PATH, service_type=SERVICE_TYPE,
+                 interval=PROBE_INTERVAL, zeroconf=None):
+        # zeroconf 为 None 时自己创建一个并在 close 时关闭
+        self.on_change = on_change
+        self.cache_path = cache_path
+        self.service_type = service_type
+        self.interval = interval
+        self._zeroconf = zeroconf
+        self._own_zeroconf = zeroconf is None
+        self._browser = None
+        self._candidates = {}
+        self._current = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pool = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix='discovery-probe')
+
+    def start(self):
+        self._load_cache()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        if self._zeroconf is None:
+            self._zeroconf = Zeroconf()
+        self._browser = ServiceBrowser(self._zeroconf, self.service_type, _Listener(self))
+        return self
+
+    def current(self):
+        return self._current
+
+    def base_url(self):
+        current = self._current
+        return current.url() if current is not None else None
+
+    def wait(self, timeout=None):
+        # 等到选出一个可用的服务器，返回是否成功
+        return self._ready.wait(timeout)
+
+    def report_failure(self):
+        # 请求服务器时连接失败：立即重新探测，不等下一个周期
+        self._wake.set()
+
+    def candidates(self):
+        with self._lock:
+            current = self._current
+            return [dict(c.to_dict(), selected=c is current) for c in self._candidates.values()]
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._browser is not None:
+            self._browser.cancel()
+        if self._own_zeroconf and self._zeroconf is not None:
+            self._zeroconf.close()
+        self._pool.shutdown(wait=False)
+
+    # mDNS 回调，在 zeroconf 的线程中调用，不能阻塞
+
+    def _resolve(self, zc, type_, name):
+        asyncio.run_coroutine_threadsafe(self._resolve_async(zc, type_, name), zc.loop)
+
+    async def _resolve_async(self, zc, type_, name):
+        info = AsyncServiceInfo(type_, name)
+        if not await info.async_request(zc, RESOLVE_TIMEOUT * 1000) or not info.port:
+            return
+        keys = {(address, info.port) for address in info.parsed_addresses(IPVersion.All) if _usable(address)}
+        with self._lock:
+            for candidate in self._candidates.values():
+                if candidate.key not in keys:
+                    candidate.names.discard(name)
+            for key in keys:
+                candidate = self._candidates.get(key)
+                if candidate is None:
+                    candidate = self._candidates[key] = Candidate(*key)
+                candidate.names.add(name)
+        self._wake.set()
+
+    def _withdraw(self, name):
+        with self._lock:
+            for candidate in self._candidates.values():
+                candidate.names.discard(name)
+        self._wake.set()
+
+    # 探测和选择
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._probe_all()
+            current = self._current
+            if current is not None and current.failures:
+                timeout = RETRY_INTERVAL
+            elif current is None and self._candidates:
+                timeout = SEARCH_INTERVAL
+            else:
+                timeout = self.interval
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def _probe_all(self):
+        with self._lock:
+            candidates = list(self._candidates.values())
+        if not candidates:
+            return
+        results = list(self._pool.map(lambda c: probe(c.host, c.port), candidates))
+        now = time.monotonic()
+        with self._lock:
+            for candidate, rtt in zip(candidates, results):
+                candidate.checked = now
+                if rtt is None:
+                    candidate.failures += 1
+                    # 不再被通告、也连不上的候选（如缓存中的旧地址）直接丢弃
+                    if not candidate.names and candidate is not self._current:
+                        self._candidates.pop(candidate.key, None)
+                    continue
+                candidate.failures = 0
+                candidate.rtt = rtt if candidate.rtt is None else (
+                    candidate.rtt * (1 - RTT_SMOOTHING) + rtt * RTT_SMOOTHING)
+            changed = self._choose()
+            current = self._current
+        if changed:
+            self._save_cache()
+            if current is not None:
+                self._ready.set()
+            else:
+                self._ready.clear()
+            if self.on_change is not None:
+                self.on_change(current)
+
+    def _choose(self):
+        # 持有 self._lock 时调用，返回选中的服务器是否变化
+        current = self._current
+        if current is not None and (current.key not in self._candidates or not current.healthy):
+            current = None
+        healthy = sorted((c for c in self._candidates.values() if c.healthy), key=lambda c: c.rtt)
+        if healthy and (current is None or healthy[0].rtt + SWITCH_MARGIN < current.rtt):
+            current = healthy[0]
+        changed = current is not self._current
+        self._current = current
+        return changed
+
+    # 磁盘缓存
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                data = json.load(f)
+            entries = data.get('servers', [])
+        except (OSError, ValueError, AttributeError):
+            return
+        with self._lock:
+            for entry in entries:
+                try:
+                    key = (str(entry['host']), int(entry['port']))
+                except (KeyError, TypeError, ValueError):
+                    continue
+                self._candidates.setdefault(key, Candidate(*key))
+
+    def _save_cache(self):
+        # 选中的服务器排在最前，其余可用的候选在后
+        with self._lock:
+            current = self._current
+            servers = [c for c in self._candidates.values() if c is not current and c.healthy]
+            if current is not None:
+                servers.insert(0, current)
+            data = {'servers': [{'host': c.host, 'port': c.port} for c in servers], 'saved_at': time.time()}
+        if not data['servers']:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+            tmp = f'{self.cache_path}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.cache_path)
+        except OSError:
+            pass
@@ -0,0 +1,174 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+import requests
+
+import transfer
+
+# 分段并行下载：按 Range 把文件切成多段，多个连接同时下载并写到各自偏移。
+# 下载进度记录在 <目标文件>.part.json 中，中断后重新运行会从已下载的位置继续，
+# 服务器端文件发生变化时（If-Range 不匹配）会从头开始
+
+DEFAULT_SEGMENTS = 4
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+class _State:
+    def __init__(self, path, etag, size, segments):
+        self.path = path
+        self.etag = etag
+        self.size = size
+        # 每段为 [起始偏移, 已写到的位置, 结束偏移]
+        self.segments = segments
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, etag, size):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not etag or data.get('etag') != etag or data.get('size') != size:
+            return None
+        return cls(path, etag, size, data['segments'])
+
+    def save(self):
+        with self.lock:
+            data = {'etag': self.etag, 'size': self.size, 'segments': self.segments}
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+    @property
+    def downloaded(self):
+        return sum(pos - start for start, pos, _ in self.segments)
+
+
+def _plan(size, segments):
+    count = max(1, min(segments, -(-size // MIN_SEGMENT_SIZE)))
+    step = -(-size // count) if size else 0
+    return [[i * step, i * step, min(size, (i + 1) * step)] for i in range(count)] or [[0, 0, 0]]
+
+
+def _fetch_segment(session, url, state, segment, fd, timeout, retries):
+    for attempt in range(1, retries + 1):
+        start, pos, stop = segment
+        if pos >= stop:
+            return
+        headers = {'Range': f'bytes={pos}-{stop - 1}'}
+        if state.etag:
+            headers['If-Range'] = state.etag
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 200:
+                    raise DownloadError('服务器上的文件已变化，请重新下载')
+                if response.status_code != 206:
+                    raise DownloadError(f'分段下载失败: HTTP {response.status_code}')
+                for data in response.iter_content(READ_SIZE):
+                    data = data[:stop - segment[1]]
+                    transfer.pwrite(fd, data, segment[1])
+                    segment[1] += len(data)
+                    if segment[1] >= stop:
+                        break
+            if segment[1] >= stop:
+                return
+        except requests.RequestException:
+            if attempt == retries:
+                raise
+            time.sleep(0.5 * attempt)
+        finally:
+            state.save()
+    raise DownloadError(f'分段 {start}-{stop - 1} 下载不完整')
+
+
+def segmented_download(url, dest, segments=DEFAULT_SEGMENTS, session=None, timeout=30, retries=3):
+    session = session or requests.Session()
+    head = session.head(url, timeout=timeout, allow_redirects=True)
+    head.raise_for_status()
+    size = int(head.headers.get('Content-Length', 0))
+    etag = head.headers.get('ETag')
+    if head.headers.get('Accept-Ranges') != 'bytes':
+        # 服务器不支持 Range 时只能单连接顺序下载
+        segments = 1
+
+    part_path = dest + '.part'
+    state_path = dest + '.part.json'
+    state = _State.load(state_path, etag, size) if os.path.exists(part_path) else None
+    if state is None:
+        state = _State(state_path, etag, size, _plan(size, segments))
+        with open(part_path, 'wb') as f:
+            f.truncate(size)
+        state.save()
+
+    start_time = time.perf_counter()
+    resumed = state.downloaded
+    errors = []
+    fd = os.open(part_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if len(state.segments) == 1 and head.headers.get('Accept-Ranges') != 'bytes':
+            segment = state.segments[0]
+            segment[1] = 0
+            with session.get(url, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                for data in response.iter_content(READ_SIZE):
+                    transfer.pwrite(fd, data, segment[1])
+                    segment[1] += len(data)
+        else:
+            def worker(segment):
+                try:
+                    _fetch_segment(session, url, state, segment, fd, timeout, retries)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=worker, args=(segment,), daemon=True)
+                       for segment in state.segments if segment[1] < segment[2]]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        state.save()
+    if errors:
+        raise errors[0]
+    if state.downloaded != size:
+        raise DownloadError(f'下载不完整: {state.downloaded}/{size} 字节')
+
+    os.replace(part_path, dest)
+    os.remove(state_path)
+    elapsed = time.perf_counter() - start_time
+    return {
+        'size': size,
+        'resumed_bytes': resumed,
+        'segments': len(state.segments),
+        'elapsed': elapsed,
+        'bytes_per_second': int((size - resumed) / elapsed) if elapsed > 0 else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ER-Event 分段并行下载')
+    parser.add_argument('url')
+    parser.add_argument('-o', '--output')
+    parser.add_argument('-n', '--segments', type=int, default=DEFAULT_SEGMENTS)
+    args = parser.parse_args()
+
+    dest = args.output or os.path.basename(requests.utils.urlparse(args.url).path) or 'download'
+    result = segmented_download(args.url, dest, segments=args.segments)
+    print(f"下载完成: {dest} {result['size']} 字节, "
+          f"{result['bytes_per_second'] / 1024 / 1024:.1f} MB/s, {result['segments']} 段")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import threading
+import uuid
+from collections import deque
+
+import requests
+
+# 设备状态的增量推送（Server-Sent Events）。
+#
+# 服务器把每次变化（join/status/leave）记为一个带递增序号的事件，保存最近的一部分；
+# 客户端先取一次完整快照（带 epoch 和 seq），之后用 SSE 只接收 seq 之后的事件。
+# 断线重连时从上次的 seq 继续，EventSource 会自动带上 Last-Event-ID；
+# 服务器重启（epoch 变化）或落后太多（事件已被丢弃）时收到 reset，需要重新取快照。
+#
+# 事件内容是设备的完整状态，重复应用同一个事件没有副作用
+
+EVENT_BACKLOG = 10000
+# 没有事件时发送注释行保持连接，也让服务器及时发现断开的连接
+KEEPALIVE = 15
+RETRY_DELAY = 2
+MAX_RETRY_DELAY = 30
+
+
+class EventLog:
+    def __init__(self, maxlen=EVENT_BACKLOG):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self._events = deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+        # 协程订阅者：(事件循环, future)，有新事件时在各自的事件循环里唤醒
+        self._async_waiters = set()
+
+    def cursor(self):
+        with self._cond:
+            return self.epoch, self.seq
+
+    def append(self, event, seq=None):
+        # seq 为 None 时使用下一个序号；转发上游事件时可以沿用上游的序号
+        with self._cond:
+            self.seq = self.seq + 1 if seq is None else seq
+            event = dict(event, seq=self.seq)
+            self._events.append(event)
+            self._notify()
+        return event
+
+    def _notify(self):
+        self._cond.notify_all()
+        for loop, future in self._async_waiters:
+            loop.call_soon_threadsafe(_wake, future)
+        self._async_waiters.clear()
+
+    def reset(self, seq=0):
+        # 之前的游标全部失效，订阅者会收到 reset
+        with self._cond:
+            self.epoch = uuid.uuid4().hex[:12]
+            self.seq = seq
+            self._events.clear()
+            self._notify()
+
+    def _since(self, epoch, seq):
+        if epoch != self.epoch or seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        oldest = self._events[0]['seq'] if self._events else self.seq + 1
+        if seq < oldest - 1:
+            return None
+        result = []
+        for event in reversed(self._events):
+            if event['seq'] <= seq:
+                break
+            result.append(event)
+        result.reverse()
+        return result
+
+    def since(self, epoch, seq):
+        # 返回 seq 之后的事件；None 表示无法续传，需要重新取快照
+        with self._cond:
+            return self._since(epoch, seq)
+
+    def wait(self, epoch, seq, timeout):
+        with self._cond:
+            self._cond.wait_for(lambda: self.epoch != epoch or self.seq != seq, timeout)
+            return self._since(epoch, seq)
+
+    async def wait_async(self, epoch, seq, timeout):
+        # 与 wait 相同，但不占用线程
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self.epoch != epoch or self.seq != seq:
+                return self._since(epoch, seq)
+            waiter = (loop, loop.create_future())
+            self._async_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._async_waiters.discard(waiter)
+        return self.since(epoch, seq)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def parse_cursor(value, seq=None):
+    # 游标格式为 "<epoch>:<seq>"，也接受分开传的 epoch 和 seq
+    if value and ':' in value:
+        value, _, seq = value.partition(':')
+    try:
+        return value or '', int(seq)
+    except (TypeError, ValueError):
+        return '', -1
+
+
+def format_event(event_type, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event_type}')
+    lines.append(f'data: {json.dumps(data, ensure_ascii=False)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def _frames(log, epoch, events, include, event_type):
+    if events is None:
+        return [format_event('reset', dict(zip(('epoch', 'seq'), log.cursor())))]
+    if not events:
+        return [': keepalive\n\n']
+    return [format_event(event_type, event, f"{epoch}:{event['seq']}")
+            for event in events if include is None or include(event)]
+
+
+def sse_stream(log, cursor, keepalive=KEEPALIVE, include=None, event_type='device'):
+    # include(event) 返回 False 的事件不发送（例如客户端自己）；event_type 为 SSE 的事件名
+    epoch, seq = cursor
+    yield 'retry: 3000\n\n'
+    while True:
+        events = log.wait(epoch, seq, keepalive)
+        yield from _frames(log, epoch, events, include, event_type)
+        if events is None:
+            return
+        if events:
+            seq = events[-1]['seq']
+
+
+async def sse_stream_async(log, cursor, keepalive=KEEPALIVE, include=None, event_type='device'):
+    epoch, seq = cursor
+    yield 'retry: 3000\n\n'
+    while True:
+        events = await log.wait_async(epoch, seq, keepalive)
+        for frame in _frames(log, epoch, events, include, event_type):
+            yield frame
+        if events is None:
+            return
+        if events:
+            seq = events[-1]['seq']
+
+
+def iter_sse(response):
+    # 解析 SSE 响应，逐个返回 (事件类型, 数据)
+    event_type = 'message'
+    data = []
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if not line:
+            if data:
+                yield event_type, json.loads('\n'.join(data))
+            event_type = 'message'
+            data = []
+        elif line.startswith(':'):
+            continue
+        else:
+            field, _, value = line.partition(':')
+            value = value[1:] if value.startswith(' ') else value
+            if field == 'event':
+                event_type = value
+            elif field == 'data':
+                data.append(value)
+
+
+def apply_event(devices, event):
+    if event['type'] == 'leave':
+        devices.pop(event['device_id'], None)
+    else:
+        devices[event['device_id']] = event['device']
+
+
+def follow(get_base_url, on_snapshot, on_event, stop=None, session=None, keepalive=KEEPALIVE,
+           snapshot_path='/api/devices', events_path='/api/devices/events', event_type='device',
+           snapshot_key='devices', params=None):
+    # 客户端订阅服务器的变化：先取快照（响应中的 snapshot_key 字段），再持续接收增量；
+    # get_base_url 返回 None 时表示还没有找到服务器。默认订阅设备列表，params 为附加的查询参数
+    session = session or requests.Session()
+    stop = stop or threading.Event()
+    cursor = None
+    delay = RETRY_DELAY
+    while not stop.is_set():
+        base_url = get_base_url()
+        if not base_url:
+            stop.wait(RETRY_DELAY)
+            continue
+        try:
+            if cursor is None:
+                response = session.get(f'{base_url}{snapshot_path}', params=params, timeout=10)
+                response.raise_for_status()
+                data = response.json()
+                on_snapshot(data[snapshot_key], data.get('epoch'), data.get('seq', 0))
+                cursor = (data.get('epoch'), data.get('seq', 0))
+            with session.get(f'{base_url}{events_path}',
+                             params=dict(params or {}, epoch=cursor[0], since=cursor[1]),
+                             stream=True, timeout=(5, keepalive * 2)) as response:
+                response.raise_for_status()
+                delay = RETRY_DELAY
+                for received, data in iter_sse(response):
+                    if stop.is_set():
+                        return
+                    if received == 'reset':
+                        cursor = None
+                        break
+                    if received == event_type:
+                        on_event(data)
+                        cursor = (cursor[0], data['seq'])
+        except (requests.RequestException, ValueError, KeyError):
+            stop.wait(delay)
+            delay = min(MAX_RETRY_DELAY, delay * 2)
@@ -0,0 +1,217 @@
+import bisect
+import ctypes
+import ctypes.util
+import logging
+import os
+import stat
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+
+# 上传目录的内存索引：启动时用 os.scandir 建立一次，之后由上传/删除接口增量维护，
+# 应用外部对目录的修改由 inotify（Linux）或定时轮询同步进来。
+# 三种排序各维护一个有序列表，分页只需切片，页面加载与目录大小无关。
+# extra 为不以普通文件形式存在的其他来源（如 chunk_store.ChunkStore），
+# 需要提供 entries() 和 entry(name)
+
+FileEntry = namedtuple('FileEntry', ['name', 'size', 'mtime'])
+
+SORT_KEYS = ('name', 'size', 'mtime')
+POLL_INTERVAL = 5
+
+# inotify 常量，见 <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class FileIndex:
+    def __init__(self, folder, extra=None):
+        self.folder = folder
+        self.extra = extra
+        self.lock = threading.RLock()
+        self.entries = {}
+        self._sorted = {key: [] for key in SORT_KEYS}
+        self._watcher = None
+        self.seed()
+
+    @staticmethod
+    def _visible(name):
+        # 以点开头的是内部目录/文件（如 .partial），不出现在列表中
+        return not name.startswith('.')
+
+    @staticmethod
+    def _sort_key(entry, key):
+        if key == 'name':
+            return (entry.name.lower(), entry.name)
+        return (getattr(entry, key), entry.name.lower(), entry.name)
+
+    def seed(self):
+        entries = {}
+        with os.scandir(self.folder) as it:
+            for dir_entry in it:
+                if not self._visible(dir_entry.name):
+                    continue
+                try:
+                    if dir_entry.is_file():
+                        st = dir_entry.stat()
+                        entries[dir_entry.name] = FileEntry(dir_entry.name, st.st_size, st.st_mtime)
+                except OSError:
+                    pass
+        if self.extra is not None:
+            for entry in self.extra.entries():
+                entries.setdefault(entry.name, entry)
+        with self.lock:
+            self.entries = entries
+            self._sorted = {
+                key: sorted(self._sort_key(e, key) for e in entries.values())
+                for key in SORT_KEYS
+            }
+
+    def _insert(self, entry):
+        old = self.entries.get(entry.name)
+        if old == entry:
+            return
+        if old is not None:
+            self._delete(old)
+        self.entries[entry.name] = entry
+        for key in SORT_KEYS:
+            bisect.insort(self._sorted[key], self._sort_key(entry, key))
+
+    def _delete(self, entry):
+        del self.entries[entry.name]
+        for key in SORT_KEYS:
+            items = self._sorted[key]
+            sort_key = self._sort_key(entry, key)
+            i = bisect.bisect_left(items, sort_key)
+            if i < len(items) and items[i] == sort_key:
+                del items[i]
+
+    def add(self, name, size=None, mtime=None):
+        # 不传 size/mtime 时重新 stat 一次
+        if not self._visible(name):
+            return
+        if size is None or mtime is None:
+            try:
+                st = os.stat(os.path.join(self.folder, name))
+            except OSError:
+                entry = self.extra.entry(name) if self.extra is not None else None
+                if entry is None:
+                    self.remove(name)
+                else:
+                    with self.lock:
+                        self._insert(entry)
+                return
+            if not stat.S_ISREG(st.st_mode):
+                return
+            size, mtime = st.st_size, st.st_mtime
+        with self.lock:
+            self._insert(FileEntry(name, size, mtime))
+
+    def remove(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                self._delete(entry)
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def page(self, page=1, per_page=50, sort='name', reverse=False):
+        if sort not in SORT_KEYS:
+            sort = 'name'
+        with self.lock:
+            items = self._sorted[sort]
+            total = len(items)
+            start = max(0, (page - 1) * per_page)
+            if reverse:
+                keys = items[max(0, total - start - per_page):total - start][::-1]
+            else:
+                keys = items[start:start + per_page]
+            files = [self.entries[key[-1]] for key in keys]
+        return files, total
+
+    def start_watcher(self, poll_interval=POLL_INTERVAL):
+        if self._watcher is not None:
+            return
+        target = self._watch_inotify if _inotify_available() else self._watch_poll
+        self._watcher = threading.Thread(target=target, args=(poll_interval,), daemon=True)
+        self._watcher.start()
+
+    def _watch_poll(self, poll_interval):
+        # 轮询兜底：在后台线程里对比目录，不影响页面加载
+        while True:
+            time.sleep(poll_interval)
+            try:
+                seen = set()
+                with os.scandir(self.folder) as it:
+                    for dir_entry in it:
+                        if not self._visible(dir_entry.name) or not dir_entry.is_file():
+                            continue
+                        seen.add(dir_entry.name)
+                        st = dir_entry.stat()
+                        entry = self.entries.get(dir_entry.name)
+                        if entry is None or entry.size != st.st_size or entry.mtime != st.st_mtime:
+                            self.add(dir_entry.name, st.st_size, st.st_mtime)
+                if self.extra is not None:
+                    seen.update(entry.name for entry in self.extra.entries())
+                for name in list(self.entries):
+                    if name not in seen:
+                        self.remove(name)
+            except OSError as e:
+                logging.warning(f"File index polling failed: {e}")
+
+    def _watch_inotify(self, poll_interval):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        # 不监听 IN_MODIFY：上传过程中每次 write 都会触发，文件写完时的 IN_CLOSE_WRITE 已足够
+        mask = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                IN_DELETE | IN_ATTRIB | IN_DELETE_SELF)
+        if fd < 0 or libc.inotify_add_watch(fd, os.fsencode(self.folder), mask) < 0:
+            if fd >= 0:
+                os.close(fd)
+            self._watch_poll(poll_interval)
+            return
+        # 建立监听后再同步一次，避免遗漏 seed 与监听之间的变化
+        self.seed()
+        try:
+            while True:
+                data = os.read(fd, 64 * 1024)
+                offset = 0
+                while offset < len(data):
+                    _, event_mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                    offset += _EVENT_HEADER.size
+                    name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                    offset += length
+                    if event_mask & IN_Q_OVERFLOW:
+                        self.seed()
+                    elif event_mask & IN_DELETE_SELF:
+                        return
+                    elif name:
+                        # 删除事件也走 add：文件不在了会从索引移除，
+                        # 同名文件仍在 extra 中时保留
+                        self.add(name)
+        finally:
+            os.close(fd)
+
+
+def _inotify_available():
+    if not sys.platform.startswith('linux'):
+        return False
+    name = ctypes.util.find_library('c')
+    try:
+        return name is not None and hasattr(ctypes.CDLL(name), 'inotify_init1')
+    except OSError:
+        return False
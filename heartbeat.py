@@ -0,0 +1,42 @@
+import random
+import threading
+
+from coordinator import CoordinatorError
+
+# 客户端心跳：间隔由服务器在每次响应中给出（设备越多间隔越长），
+# 每次再加上 ±JITTER 的随机抖动，第一次心跳也随机推迟，避免大量设备同时发送。
+# 请求经 coordinator.CoordinatorClient 发送，复用它的 keep-alive 连接池。
+# 服务器重启后不认识本设备时会自动重新注册
+
+DEFAULT_INTERVAL = 30
+JITTER = 0.2
+MAX_BACKOFF = 120
+
+
+def jittered(interval):
+    return interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+def run(client, get_device, stop=None):
+    # client 为 CoordinatorClient；get_device 返回 (device_id, device_name)，未注册时返回 None
+    stop = stop or threading.Event()
+    interval = DEFAULT_INTERVAL
+    failures = 0
+    stop.wait(random.uniform(0, interval))
+    while not stop.is_set():
+        device = get_device()
+        if client.base_url() and device:
+            device_id, device_name = device
+            try:
+                data = client.heartbeat(device_id)
+                interval = data.get('interval', interval)
+                if data.get('registered') is False and device_name:
+                    client.register(device_id, device_name)
+                failures = 0
+            except CoordinatorError:
+                # 失败后按指数退避重试，但不超过正常间隔太多
+                failures += 1
+                print("Heartbeat failed")
+                stop.wait(jittered(min(MAX_BACKOFF, interval, 2 ** failures)))
+                continue
+        stop.wait(jittered(interval))
@@ -0,0 +1,182 @@
+import os
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from flask import Response, request
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag, unquote_etag
+from werkzeug.wsgi import wrap_file
+
+# 支持断点续传和分段并行下载的文件响应：
+# 单区间/多区间 Range（206，多区间为 multipart/byteranges）、If-Range、
+# ETag/Last-Modified 条件请求（304/412）
+
+READ_SIZE = 1024 * 1024
+# 多区间请求最多返回的区间数，防止被大量小区间拖垮
+MAX_RANGES = 64
+
+
+def make_etag(size, mtime):
+    return f'{size:x}-{int(mtime * 1000000):x}'
+
+
+def _resolve_ranges(range_header, size):
+    # 返回 None 表示忽略 Range 头（发送完整文件），空列表表示无可满足的区间
+    # 自行解析而不用 parse_range_header，后者会拒绝乱序或重叠的多区间请求
+    units, _, spec = range_header.partition('=')
+    if units.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    items = spec.split(',')
+    if len(items) > MAX_RANGES:
+        return None
+    ranges = []
+    for item in items:
+        first, sep, last = item.strip().partition('-')
+        if not sep or not (first.isdigit() or last.isdigit()):
+            return None
+        if not first:
+            start, stop = max(0, size - int(last)), size
+        else:
+            if last and not last.isdigit():
+                return None
+            start = int(first)
+            stop = min(int(last) + 1, size) if last else size
+            if last and int(last) < start:
+                return None
+        if start < stop:
+            ranges.append((start, stop))
+    # 合并重叠或相邻的区间
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _if_range_matches(etag, last_modified):
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith('W/'):
+        # If-Range 只能用强校验
+        tag, weak = unquote_etag(value)
+        return not weak and tag == etag
+    date = parse_date(value)
+    return date is not None and int(last_modified.timestamp()) <= int(date.timestamp())
+
+
+def _precondition_failed(etag, last_modified):
+    if_match = request.headers.get('If-Match')
+    if if_match and not parse_etags(if_match).contains(etag):
+        return True
+    unmodified_since = parse_date(request.headers.get('If-Unmodified-Since'))
+    if unmodified_since is not None and int(last_modified.timestamp()) > int(unmodified_since.timestamp()):
+        return True
+    return False
+
+
+def _not_modified(etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return parse_etags(if_none_match).contains_weak(etag)
+    modified_since = parse_date(request.headers.get('If-Modified-Since'))
+    if modified_since is not None:
+        return int(last_modified.timestamp()) <= int(modified_since.timestamp())
+    return False
+
+
+def _read_range(f, start, stop):
+    f.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        data = f.read(min(READ_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def send_ranges(f, size, mtime, download_name=None, mimetype='application/octet-stream', as_attachment=True):
+    # f 需要支持 seek/read；响应结束后由本函数负责关闭
+    etag = make_etag(size, mtime)
+    last_modified = datetime.fromtimestamp(int(mtime), timezone.utc)
+    headers = {
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(last_modified),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'no-cache',
+    }
+    if download_name:
+        disposition = 'attachment' if as_attachment else 'inline'
+        headers['Content-Disposition'] = f"{disposition}; filename*=UTF-8''{quote(download_name, safe='')}"
+
+    if _precondition_failed(etag, last_modified):
+        f.close()
+        return Response(status=412, headers=headers)
+    if request.method in ('GET', 'HEAD') and _not_modified(etag, last_modified):
+        f.close()
+        return Response(status=304, headers=headers)
+
+    ranges = None
+    if request.headers.get('Range') and _if_range_matches(etag, last_modified):
+        ranges = _resolve_ranges(request.headers['Range'], size)
+        if ranges == []:
+            f.close()
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+
+    if not ranges:
+        # 完整文件交给 wsgi.file_wrapper，服务器支持时可以走 sendfile
+        headers['Content-Length'] = str(size)
+        f.seek(0)
+        return Response(wrap_file(request.environ, f, READ_SIZE), status=200,
+                        mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        headers['Content-Length'] = str(stop - start)
+        return Response(_closing(f, _read_range(f, start, stop)), status=206,
+                        mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    length = 0
+    for start, stop in ranges:
+        part_header = (
+            f'\r\n--{boundary}\r\n'
+            f'Content-Type: {mimetype}\r\n'
+            f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n'
+        ).encode('latin-1')
+        parts.append((part_header, start, stop))
+        length += len(part_header) + stop - start
+    closing = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+    length += len(closing)
+
+    def generate():
+        for part_header, start, stop in parts:
+            yield part_header
+            yield from _read_range(f, start, stop)
+        yield closing
+
+    headers['Content-Length'] = str(length)
+    return Response(_closing(f, generate()), status=206,
+                    content_type=f'multipart/byteranges; boundary={boundary}',
+                    headers=headers, direct_passthrough=True)
+
+
+def send_path(path, download_name=None, **kwargs):
+    f = open(path, 'rb')
+    st = os.fstat(f.fileno())
+    return send_ranges(f, st.st_size, st.st_mtime, download_name or os.path.basename(path), **kwargs)
+
+
+def _closing(f, iterable):
+    try:
+        yield from iterable
+    finally:
+        f.close()
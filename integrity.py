@@ -0,0 +1,108 @@
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# 端到端校验：数据按固定大小分块，在传输过程中边收发边计算每块摘要，
+# 整个文件的摘要为各分块摘要依次拼接后的摘要，因此接收端不需要再读一遍文件
+
+CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_ALGORITHM = 'blake2b'
+
+
+def algorithms():
+    names = ['blake2b', 'sha256']
+    if xxhash is not None:
+        names.append('xxh3_128')
+    return names
+
+
+def new_hash(algorithm=DEFAULT_ALGORITHM):
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=16)
+    if algorithm == 'sha256':
+        return hashlib.sha256()
+    if algorithm == 'xxh3_128' and xxhash is not None:
+        return xxhash.xxh3_128()
+    raise ValueError(f'不支持的校验算法: {algorithm}')
+
+
+def digest(data, algorithm=DEFAULT_ALGORITHM):
+    h = new_hash(algorithm)
+    h.update(data)
+    return h.hexdigest()
+
+
+def combine(digests, algorithm=DEFAULT_ALGORITHM):
+    # digests 按分块顺序排列
+    h = new_hash(algorithm)
+    for d in digests:
+        h.update(bytes.fromhex(d))
+    return h.hexdigest()
+
+
+class ChunkHasher:
+    # 从第 start_index 块开始按顺序喂入数据，每凑满一块记录一个摘要
+    def __init__(self, algorithm=DEFAULT_ALGORITHM, chunk_size=CHUNK_SIZE, start_index=0):
+        new_hash(algorithm)
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.index = start_index
+        self.digests = {}
+        self._hash = None
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            if self._hash is None:
+                self._hash = new_hash(self.algorithm)
+            n = min(len(view), self.chunk_size - self._filled)
+            self._hash.update(view[:n])
+            self._filled += n
+            view = view[n:]
+            if self._filled == self.chunk_size:
+                self._finish_chunk()
+
+    def _finish_chunk(self):
+        self.digests[self.index] = self._hash.hexdigest()
+        self.index += 1
+        self._hash = None
+        self._filled = 0
+
+    def finish(self):
+        # 结束最后一个不满的分块
+        if self._hash is not None:
+            self._finish_chunk()
+        return self.digests
+
+    def file_digest(self):
+        return combine((self.digests[i] for i in sorted(self.digests)), self.algorithm)
+
+    def describe(self):
+        # 放进 file_info 的校验信息
+        return {
+            'algorithm': self.algorithm,
+            'chunk_size': self.chunk_size,
+            'digest': self.file_digest(),
+        }
+
+
+def parse_header(value):
+    # 解析形如 "blake2b:<hex>" 或只有 "<hex>"（默认算法）的校验头
+    if not value:
+        return None
+    algorithm, sep, hexdigest = value.strip().rpartition(':')
+    algorithm = algorithm if sep else DEFAULT_ALGORITHM
+    if algorithm not in algorithms():
+        raise ValueError(f'不支持的校验算法: {algorithm}')
+    return algorithm, hexdigest.lower()
+
+
+def negotiate(checksum):
+    # 返回接收端可用的校验参数，对方的算法不受支持时返回 None
+    if not checksum or checksum.get('algorithm') not in algorithms():
+        return None
+    return checksum
@@ -0,0 +1,321 @@
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import http_range
+import integrity
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# 文件浏览用的元数据与缩略图缓存：上传完成后由后台线程池读一遍文件，算出 MIME 类型、
+# 校验和（与上传、设备间传输相同的 integrity 分块摘要）、图片尺寸和缩略图，
+# 保存在 uploads/.meta 下。缓存以 文件名 + 大小 + 修改时间 为键，文件被覆盖后旧结果自然失效，
+# 总大小超过上限时按最近使用时间淘汰（使用时间记在 .json 的 mtime 上，重启后仍然有效）。
+# 缩略图需要安装 Pillow，没有时只提供元数据
+
+CACHE_DIR = '.meta'
+CACHE_LIMIT = int(os.environ.get('EREVENT_MEDIA_CACHE_SIZE', 256 * 1024 * 1024))
+WORKERS = int(os.environ.get('EREVENT_MEDIA_WORKERS', 2))
+THUMB_SIZE = 256
+THUMB_QUALITY = 80
+# 超过这个大小的图片不生成缩略图，避免一次解码占用过多内存
+THUMB_MAX_SOURCE = 64 * 1024 * 1024
+THUMB_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff'}
+# 用于识别类型和图片尺寸的文件头长度
+SNIFF_SIZE = 64 * 1024
+READ_SIZE = 1024 * 1024
+
+_MAGIC = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'%PDF-', 'application/pdf'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'\x1f\x8b', 'application/gzip'),
+    (b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (b'ID3', 'audio/mpeg'),
+    (b'OggS', 'audio/ogg'),
+    (b'fLaC', 'audio/flac'),
+]
+
+
+def sniff_type(head):
+    for magic, mime in _MAGIC:
+        if head.startswith(magic):
+            return mime
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        return 'audio/wav'
+    if head[4:8] == b'ftyp':
+        return 'video/quicktime' if head[8:10] == b'qt' else 'video/mp4'
+    if head[:4] == b'\x1a\x45\xdf\xa3':
+        return 'video/webm'
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'image/tiff'
+    return None
+
+
+def guess_type(name, head=b''):
+    # 优先按扩展名判断，扩展名无法识别时看文件头
+    mime = mimetypes.guess_type(name)[0]
+    return mime or sniff_type(head) or 'application/octet-stream'
+
+
+def image_size(head):
+    # 从文件头解析常见图片格式的宽高，不依赖 Pillow；无法识别时返回 None
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and len(head) >= 24:
+        return struct.unpack('>II', head[16:24])
+    if head[:6] in (b'GIF87a', b'GIF89a') and len(head) >= 10:
+        return struct.unpack('<HH', head[6:10])
+    if head[:2] == b'BM' and len(head) >= 26:
+        width, height = struct.unpack('<ii', head[18:26])
+        return width, abs(height)
+    if head[:3] == b'\xff\xd8\xff':
+        # 逐个跳过 JPEG 段，直到帧头（SOF0-SOF15，除去 DHT/JPG/DAC）
+        i = 2
+        while i + 9 <= len(head):
+            if head[i] != 0xFF:
+                return None
+            marker = head[i + 1]
+            if marker == 0xFF:
+                i += 1
+                continue
+            length = struct.unpack('>H', head[i + 2:i + 4])[0]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack('>HH', head[i + 5:i + 9])
+                return width, height
+            i += 2 + length
+    return None
+
+
+def cache_key(entry):
+    # entry 为 file_index.FileEntry
+    tag = f'{entry.name}\0{http_range.make_etag(entry.size, entry.mtime)}'
+    return hashlib.blake2b(tag.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class MediaCache:
+    # opener(name) 返回可 seek/read 的文件对象（普通文件或 chunk_store.ManifestReader），
+    # lookup(name) 返回文件当前的 FileEntry，文件不存在时返回 None
+    def __init__(self, folder, opener, lookup, limit=CACHE_LIMIT, workers=WORKERS):
+        self.root = os.path.join(folder, CACHE_DIR)
+        self.opener = opener
+        self.lookup = lookup
+        self.limit = limit
+        self.lock = threading.Lock()
+        # 键 -> 占用字节数，按最近使用排序
+        self.entries = OrderedDict()
+        self.total = 0
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='media-cache')
+        os.makedirs(self.root, exist_ok=True)
+        self.load()
+
+    @staticmethod
+    def thumbnails_enabled():
+        return Image is not None
+
+    @staticmethod
+    def thumbnail_candidate(name):
+        # 只看扩展名，供文件列表决定是否显示缩略图
+        return Image is not None and mimetypes.guess_type(name)[0] in THUMB_TYPES
+
+    def _path(self, key, suffix):
+        return os.path.join(self.root, key[:2], key + suffix)
+
+    def load(self):
+        found = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                key, ext = os.path.splitext(filename)
+                path = os.path.join(dirpath, filename)
+                if ext not in ('.json', '.jpg'):
+                    # 写到一半的临时文件
+                    os.remove(path)
+                    continue
+                st = os.stat(path)
+                used, size = found.get(key, (0, 0))
+                found[key] = (max(used, st.st_mtime), size + st.st_size)
+        with self.lock:
+            self.entries = OrderedDict((key, size) for key, (_, size) in sorted(found.items(), key=lambda i: i[1][0]))
+            self.total = sum(self.entries.values())
+        self._evict()
+
+    def get(self, name, wait=0):
+        # 返回 (entry, meta)：文件不存在时 entry 为 None；还没算好时 meta 为 None，
+        # 并确保已经提交计算，wait 秒内算完则直接返回结果
+        entry = self.lookup(name)
+        if entry is None:
+            return None, None
+        key = cache_key(entry)
+        meta = self._read(key)
+        if meta is not None:
+            return entry, meta
+        future = self.schedule(name)
+        if future is not None and wait > 0:
+            try:
+                future.result(wait)
+            except TimeoutError:
+                return entry, None
+            except Exception:
+                pass
+            return entry, self._read(key)
+        return entry, None
+
+    def thumb_path(self, entry, meta):
+        if not meta.get('thumbnail'):
+            return None
+        return self._path(cache_key(entry), '.jpg')
+
+    def schedule(self, name, checksum=None):
+        # 上传完成后调用；checksum 为上传时已经算好的 integrity 校验信息，给出时不再重读整个文件
+        entry = self.lookup(name)
+        if entry is None:
+            return None
+        key = cache_key(entry)
+        with self.lock:
+            if key in self.entries:
+                return None
+            future = self.pending.get(key)
+            if future is None:
+                future = self.executor.submit(self._compute, entry, key, checksum)
+                self.pending[key] = future
+            return future
+
+    def discard(self, entry):
+        # 文件删除后立即释放它的缓存
+        if entry is None:
+            return
+        key = cache_key(entry)
+        with self.lock:
+            size = self.entries.pop(key, None)
+            if size is not None:
+                self.total -= size
+        self._remove(key)
+
+    def _read(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        path = self._path(key, '.json')
+        try:
+            with open(path, encoding='utf-8') as f:
+                meta = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return meta
+
+    def _remove(self, key):
+        for suffix in ('.json', '.jpg'):
+            try:
+                os.remove(self._path(key, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        while True:
+            with self.lock:
+                if self.total <= self.limit or not self.entries:
+                    return
+                key, size = self.entries.popitem(last=False)
+                self.total -= size
+            self._remove(key)
+
+    def _compute(self, entry, key, checksum):
+        try:
+            return self._store(entry, key, checksum)
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def _store(self, entry, key, checksum):
+        try:
+            meta = self._describe(entry, key, checksum)
+        except OSError as e:
+            # 文件在计算过程中被删除或替换
+            logging.warning(f"Media cache failed for {entry.name}: {e}")
+            return None
+        if self.lookup(entry.name) != entry:
+            self._remove(key)
+            return None
+        path = self._path(key, '.json')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+        if meta['thumbnail']:
+            size += os.path.getsize(self._path(key, '.jpg'))
+        with self.lock:
+            self.total += size - self.entries.get(key, 0)
+            self.entries[key] = size
+        self._evict()
+        return meta
+
+    def _describe(self, entry, key, checksum):
+        f = self.opener(entry.name)
+        try:
+            head = f.read(SNIFF_SIZE)
+            if checksum is None:
+                hasher = integrity.ChunkHasher()
+                hasher.update(head)
+                while True:
+                    data = f.read(READ_SIZE)
+                    if not data:
+                        break
+                    hasher.update(data)
+                hasher.finish()
+                checksum = hasher.describe()
+            mime = guess_type(entry.name, head)
+            meta = {
+                'name': entry.name,
+                'size': entry.size,
+                'mtime': entry.mtime,
+                'mime': mime,
+                'checksum': checksum,
+                'thumbnail': False,
+            }
+            dimensions = image_size(head) if mime.startswith('image/') else None
+            if Image is not None and mime in THUMB_TYPES and entry.size <= THUMB_MAX_SOURCE:
+                f.seek(0)
+                dimensions = self._thumbnail(f, key) or dimensions
+                meta['thumbnail'] = dimensions is not None
+        finally:
+            f.close()
+        if dimensions is not None:
+            meta['width'], meta['height'] = dimensions
+        return meta
+
+    def _thumbnail(self, f, key):
+        # 返回原图尺寸，图片无法解码时返回 None
+        path = self._path(key, '.jpg')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with Image.open(f) as image:
+                dimensions = image.size
+                # JPEG 可以直接按缩小的尺寸解码
+                image.draft('RGB', (THUMB_SIZE, THUMB_SIZE))
+                thumb = ImageOps.exif_transpose(image).convert('RGB')
+                thumb.thumbnail((THUMB_SIZE, THUMB_SIZE))
+                tmp = path + '.tmp'
+                thumb.save(tmp, 'JPEG', quality=THUMB_QUALITY)
+            os.replace(tmp, path)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            logging.warning(f"Thumbnail failed for {key}: {e}")
+            return None
+        return dimensions
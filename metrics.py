@@ -0,0 +1,91 @@
+import threading
+import time
+
+# 传输进度和 Prometheus 指标。
+#
+# Meter 挂在传输的数据通路上（每次 throttle 都会调用 add），因此 add 只做一次加法和一次时间比较，
+# 每隔 REPORT_INTERVAL 才返回 True 让调用方上报一次；速度、ETA 等只在上报时计算。
+# 当前速度是按上报间隔计算的指数平均，平均速度从第一个字节开始算
+
+REPORT_INTERVAL = 0.5
+# 当前速度的平滑系数，越大越贴近最近一个间隔
+RATE_SMOOTHING = 0.5
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Meter:
+    def __init__(self, size=None, interval=REPORT_INTERVAL):
+        self.size = size
+        self.interval = interval
+        self.total = 0
+        self.started = None
+        self.rate = 0.0
+        self._last_time = None
+        self._last_total = 0
+        self._next_report = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, n):
+        # 可以在多个连接线程中同时调用；返回 True 表示该上报进度了
+        now = time.monotonic()
+        with self._lock:
+            self.total += n
+            if self.started is None:
+                self.started = self._last_time = now
+                self._next_report = now + self.interval
+                return True
+            if now < self._next_report:
+                return False
+            self._next_report = now + self.interval
+            rate = (self.total - self._last_total) / max(now - self._last_time, 1e-6)
+            self.rate = rate if not self.rate else self.rate * (1 - RATE_SMOOTHING) + rate * RATE_SMOOTHING
+            self._last_time = now
+            self._last_total = self.total
+            return True
+
+    def snapshot(self, finished=None):
+        # finished 为结束时间时平均速度按实际耗时计算，当前速度归零
+        now = finished or time.monotonic()
+        with self._lock:
+            total = self.total
+            rate = 0.0 if finished else self.rate
+            elapsed = now - self.started if self.started is not None else 0.0
+        average = total / elapsed if elapsed > 0 else 0.0
+        result = {
+            'transferred': total,
+            'size': self.size,
+            'rate': round(rate),
+            'avg_rate': round(average),
+            'progress': None,
+            'eta': None,
+        }
+        if self.size:
+            result['progress'] = round(min(100.0, total * 100 / self.size), 1)
+            speed = rate or average
+            if not finished and speed > 0:
+                result['eta'] = round(max(0, self.size - total) / speed, 1)
+        return result
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _sample(name, labels, value):
+    if labels:
+        label_text = ','.join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+        name = f'{name}{{{label_text}}}'
+    if isinstance(value, float):
+        value = repr(round(value, 6))
+    return f'{name} {value}'
+
+
+def render(families):
+    # families: [(名称, 类型, 说明, [(标签 dict, 值), ...])]，输出 Prometheus 文本格式
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            lines.append(_sample(name, labels, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,65 @@
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+# 增量解析 multipart/form-data 请求体，不经过 Werkzeug 的临时文件缓存，
+# 调用方拿到文件数据后可以直接写到目标位置
+
+READ_SIZE = 1024 * 1024
+# 普通表单字段只在内存中累积，限制其大小
+MAX_FIELD_SIZE = 64 * 1024
+
+
+class MultipartError(Exception):
+    pass
+
+
+def get_boundary(content_type):
+    mimetype, options = parse_options_header(content_type or '')
+    if mimetype != 'multipart/form-data' or not options.get('boundary'):
+        raise MultipartError('请求不是 multipart/form-data')
+    return options['boundary'].encode('latin-1')
+
+
+def iter_events(stream, content_type, read_size=READ_SIZE):
+    # 产生的事件：
+    #   ('field', 字段名, 字符串值)
+    #   ('file', 字段名, 文件名)
+    #   ('data', bytes)     —— 属于最近一个 'file' 事件
+    #   ('end',)            —— 当前文件结束
+    decoder = MultipartDecoder(get_boundary(content_type))
+    current = None
+    field_name = None
+    field_value = bytearray()
+
+    while True:
+        try:
+            event = decoder.next_event()
+        except ValueError as e:
+            # 请求体被截断或格式错误
+            raise MultipartError(f'请求体格式错误: {e}')
+        if isinstance(event, NeedData):
+            decoder.receive_data(stream.read(read_size) or None)
+            continue
+        if isinstance(event, Field):
+            current = 'field'
+            field_name = event.name
+            field_value.clear()
+        elif isinstance(event, File):
+            current = 'file'
+            yield ('file', event.name, event.filename)
+        elif isinstance(event, Data):
+            if current == 'file':
+                if event.data:
+                    yield ('data', event.data)
+                if not event.more_data:
+                    current = None
+                    yield ('end',)
+            elif current == 'field':
+                field_value += event.data
+                if len(field_value) > MAX_FIELD_SIZE:
+                    raise MultipartError('表单字段过大')
+                if not event.more_data:
+                    current = None
+                    yield ('field', field_name, field_value.decode('utf-8', 'replace'))
+        elif isinstance(event, Epilogue):
+            return
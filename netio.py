@@ -0,0 +1,164 @@
+import json
+import os
+import socket
+import struct
+import threading
+
+# 数据连接的底层读写：控制头、按偏移读写文件、sendfile 和连接。
+# transfer、compression、delta 都建立在这一层之上（transfer 只导入自己用到的名字，其余模块需要时直接导入 netio），
+# compression 和 delta 只依赖本模块，transfer 可以在模块级导入它们而不形成循环
+
+# 接收缓冲区大小，可通过环境变量调整
+BUFFER_SIZE = int(os.environ.get('EREVENT_BUFFER_SIZE', 1024 * 1024))
+# 套接字内核缓冲区大小，0 表示保持系统默认
+SOCKET_BUFFER_SIZE = int(os.environ.get('EREVENT_SOCKET_BUFFER_SIZE', 4 * 1024 * 1024))
+# 限速时 sendfile 每次发送的大小，每发送一段取一次令牌
+THROTTLE_SLICE = 4 * 1024 * 1024
+# 接收端连接发送端的超时时间（只限制建立连接，之后的收发不超时）
+CONNECT_TIMEOUT = 10
+
+# 每条数据连接开头由接收端发送一个控制头：4 字节长度 + JSON，
+# 例如 {"op": "range", "offset": 0, "length": 1048576}，发送端随后回送该区间的原始数据；
+# 全部接收完成后接收端发送 {"op": "done"} 通知发送端结束监听
+_HEADER_LENGTH = struct.Struct('!I')
+HEADER_PREFIX_SIZE = _HEADER_LENGTH.size
+MAX_HEADER_SIZE = 1024 * 1024
+
+
+class TransferError(Exception):
+    pass
+
+
+class ConnectError(TransferError):
+    # 没能连上发送端，双方还没有交换任何数据，接收端可以换一个地址重试
+    pass
+
+
+_seek_lock = threading.Lock()
+
+
+def pread(fd, size, offset):
+    # 按偏移读取，不改变文件指针；没有 os.pread 的平台（Windows）退化为加锁的 seek + read。
+    # 读到文件末尾时返回的数据少于 size
+    if hasattr(os, 'pread'):
+        parts = []
+        while size > 0:
+            data = os.pread(fd, size, offset)
+            if not data:
+                break
+            parts.append(data)
+            size -= len(data)
+            offset += len(data)
+        return b''.join(parts)
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        parts = []
+        while size > 0:
+            data = os.read(fd, size)
+            if not data:
+                break
+            parts.append(data)
+            size -= len(data)
+        return b''.join(parts)
+
+
+def pwrite(fd, data, offset):
+    # 按偏移写入，不改变文件指针；没有 os.pwrite 的平台（Windows）退化为加锁的 seek + write
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(fd, view, offset)
+            view = view[n:]
+            offset += n
+        return len(data)
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    return len(data)
+
+
+def tune_socket(sock, buffer_size=SOCKET_BUFFER_SIZE):
+    # 放大收发缓冲区，让大文件传输能跑满链路
+    if buffer_size:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        except OSError:
+            pass
+    return sock
+
+
+def recv_exact(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise TransferError('连接在控制头传输过程中关闭')
+        received += n
+    return bytes(buf)
+
+
+def encode_header(header):
+    data = json.dumps(header).encode('utf-8')
+    return _HEADER_LENGTH.pack(len(data)) + data
+
+
+def header_length(data):
+    # 控制头的长度前缀，过大时报错
+    (length,) = _HEADER_LENGTH.unpack(data)
+    if length > MAX_HEADER_SIZE:
+        raise TransferError('控制头过大')
+    return length
+
+
+def send_header(sock, header):
+    sock.sendall(encode_header(header))
+
+
+def recv_header(sock):
+    length = header_length(recv_exact(sock, HEADER_PREFIX_SIZE))
+    return json.loads(recv_exact(sock, length))
+
+
+def send_file(sock, f, offset=0, count=None, throttle=None):
+    # socket.sendfile 会循环直到全部发送完毕，不会出现静默的部分发送。
+    # throttle(n) 在发送 n 字节前调用（限速、进度），此时按 THROTTLE_SLICE 分段发送
+    if count is None:
+        count = os.fstat(f.fileno()).st_size - offset
+    if count <= 0:
+        return 0
+    if throttle is None:
+        sent = sock.sendfile(f, offset, count)
+    else:
+        sent = 0
+        while sent < count:
+            n = min(THROTTLE_SLICE, count - sent)
+            throttle(n)
+            done = sock.sendfile(f, offset + sent, n)
+            sent += done
+            if done != n:
+                break
+    if sent != count:
+        raise TransferError(f'发送不完整: {sent}/{count} 字节')
+    return sent
+
+
+def connect(host, port, timeout=CONNECT_TIMEOUT):
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    except OSError as e:
+        raise ConnectError(f'无法连接发送端 {host}:{port}: {e}') from e
+    sock.settimeout(None)
+    return sock
+
+
+def notify_done(host, port, ok):
+    try:
+        with socket.create_connection((host, port), timeout=10) as s:
+            send_header(s, {'op': 'done', 'ok': ok})
+    except OSError:
+        pass
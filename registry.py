@@ -0,0 +1,382 @@
+import heapq
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+
+import events
+
+# 协调服务器的内存状态：在线设备表和传输任务表。
+#
+# 设备表按 device_id 分片，每片一把锁，注册/心跳只锁住自己所在的分片；
+# 时间一律用 time.monotonic()，不受系统时间调整影响，输出时才换算成 ISO 时间。
+# 每次心跳把新的超时时间压入最小堆，过期检查只弹出堆顶已到期的条目，
+# 不再每次查询都遍历全部设备。堆中的旧条目（之后又有心跳）在弹出时按 deadline 识别并丢弃。
+#
+# 设备上线、离线、移除时记录一个事件（见 events.py），客户端据此增量更新设备列表；
+# 心跳只更新 last_seen，不产生事件。
+#
+# 心跳请求只把 (device_id, 收到的时间) 放进待处理表，由后台线程每秒批量写入：
+# 同一设备在一批内的多次心跳合并为一次，每个分片一批只加一次锁。
+# 建议的心跳间隔随设备数增长，使整个服务器每秒处理的心跳数不超过 TARGET_HEARTBEAT_RATE，
+# 离线判定时间跟着间隔变化
+#
+# 状态只在本进程内，服务器需要以单进程多线程方式运行
+
+DEVICE_TIMEOUT = 60
+HEARTBEAT_INTERVAL = 30
+MAX_HEARTBEAT_INTERVAL = 300
+TARGET_HEARTBEAT_RATE = 100
+# 超过 心跳间隔 * TIMEOUT_FACTOR 未收到心跳视为离线
+TIMEOUT_FACTOR = 2
+# 离线设备保留多久后从列表中移除
+OFFLINE_RETENTION = 24 * 3600
+SHARDS = 16
+# 后台过期检查的最长间隔
+EXPIRE_INTERVAL = 1
+
+MAX_TRANSFER_TASKS = 10000
+TRANSFER_TASK_TTL = 3600
+# 客户端上报的任务状态与 status 字段的对应关系
+TRANSFER_STATUS = {
+    'queued': 'queued',
+    'running': 'running',
+    'done': 'completed',
+    'failed': 'failed',
+    'cancelled': 'cancelled',
+}
+# 已经结束的任务状态，其余状态的任务接收端重连后仍需要看到
+FINISHED_STATUS = ('completed', 'failed', 'cancelled')
+# 接收端在这段时间内仍可以接受传输请求（与发送端等待连接的时间 transfer.ACCEPT_TIMEOUT 相同）
+OFFER_TTL = 600
+PROGRESS_FIELDS = ('state', 'transferred', 'size', 'rate', 'avg_rate', 'eta', 'error')
+
+
+class Device:
+    __slots__ = ('device_id', 'name', 'ip', 'last_seen', 'deadline', 'online')
+
+    def __init__(self, device_id, name, ip, now, timeout):
+        self.device_id = device_id
+        self.name = name
+        self.ip = ip
+        self.last_seen = now
+        self.deadline = now + timeout
+        self.online = True
+
+    def to_dict(self, now, wall_now):
+        return {
+            'name': self.name,
+            'ip': self.ip,
+            'last_seen': datetime.fromtimestamp(wall_now - (now - self.last_seen)).isoformat(),
+            'status': 'online' if self.online else 'offline'
+        }
+
+
+class _Shard:
+    __slots__ = ('lock', 'devices')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = {}
+
+
+class DeviceRegistry:
+    def __init__(self, timeout=DEVICE_TIMEOUT, retention=OFFLINE_RETENTION, shards=SHARDS,
+                 interval=HEARTBEAT_INTERVAL):
+        self.timeout = timeout
+        self.interval = interval
+        self.retention = retention
+        self._shards = [_Shard() for _ in range(shards)]
+        # (deadline, device_id)
+        self._heap = []
+        self._heap_lock = threading.Lock()
+        self.events = events.EventLog()
+        self._expiry_thread = None
+        # device_id -> (收到心跳的时间, ip)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._stats = {
+            'heartbeats': 0,
+            'batches': 0,
+            'batched': 0,
+            'applied': 0,
+            'flush_seconds': 0.0,
+            'last_batch_size': 0,
+        }
+
+    def _shard(self, device_id):
+        return self._shards[zlib.crc32(device_id.encode()) % len(self._shards)]
+
+    def _emit(self, event_type, device):
+        # 在分片锁内调用，保证同一设备的事件顺序与状态变化一致
+        self.events.append({
+            'type': event_type,
+            'device_id': device.device_id,
+            'device': device.to_dict(time.monotonic(), time.time()) if event_type != 'leave' else None
+        })
+
+    def _schedule(self, deadline, device_id):
+        with self._heap_lock:
+            heapq.heappush(self._heap, (deadline, device_id))
+
+    def register(self, device_id, name, ip):
+        now = time.monotonic()
+        shard = self._shard(device_id)
+        with shard.lock:
+            device = Device(device_id, name, ip, now, self.device_timeout())
+            shard.devices[device_id] = device
+            self._emit('join', device)
+        self._schedule(device.deadline, device_id)
+        return device
+
+    def heartbeat_interval(self):
+        # 建议客户端使用的心跳间隔（秒）
+        interval = len(self) / TARGET_HEARTBEAT_RATE
+        return min(MAX_HEARTBEAT_INTERVAL, max(self.interval, interval))
+
+    def device_timeout(self):
+        return max(self.timeout, self.heartbeat_interval() * TIMEOUT_FACTOR)
+
+    def heartbeat(self, device_id, ip=None):
+        # 返回 False 表示设备未注册（或已被移除），需要重新注册；
+        # 实际的更新由 flush 批量完成
+        if device_id not in self:
+            return False
+        with self._pending_lock:
+            self._pending[device_id] = (time.monotonic(), ip)
+            self._stats['heartbeats'] += 1
+        return True
+
+    def flush(self):
+        with self._pending_lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+        start = time.perf_counter()
+        timeout = self.device_timeout()
+        by_shard = {}
+        for device_id, item in pending.items():
+            shard = self._shard(device_id)
+            by_shard.setdefault(id(shard), (shard, []))[1].append((device_id, item))
+        scheduled = []
+        for shard, items in by_shard.values():
+            with shard.lock:
+                for device_id, (received, ip) in items:
+                    device = shard.devices.get(device_id)
+                    if device is None:
+                        continue
+                    device.last_seen = max(device.last_seen, received)
+                    device.deadline = device.last_seen + timeout
+                    if ip:
+                        device.ip = ip
+                    if not device.online:
+                        device.online = True
+                        self._emit('status', device)
+                    scheduled.append((device.deadline, device_id))
+        with self._heap_lock:
+            for item in scheduled:
+                heapq.heappush(self._heap, item)
+        elapsed = time.perf_counter() - start
+        with self._pending_lock:
+            self._stats['batches'] += 1
+            self._stats['batched'] += len(pending)
+            self._stats['applied'] += len(scheduled)
+            self._stats['flush_seconds'] += elapsed
+            self._stats['last_batch_size'] = len(pending)
+        return len(pending)
+
+    def metrics(self):
+        with self._pending_lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        with self._heap_lock:
+            stats['heap_size'] = len(self._heap)
+        stats['devices'] = len(self)
+        stats['heartbeat_interval'] = self.heartbeat_interval()
+        stats['device_timeout'] = self.device_timeout()
+        # 每处理 1000 次心跳花费的时间（毫秒），不含 HTTP 本身
+        stats['flush_ms_per_1k'] = (
+            round(stats['flush_seconds'] * 1000 / stats['applied'] * 1000, 3) if stats['applied'] else 0.0
+        )
+        # 同一批内被合并掉的心跳数
+        stats['coalesced'] = stats['heartbeats'] - stats['batched'] - stats['pending']
+        return stats
+
+    def expire(self):
+        # 处理所有已到期的条目：超时的设备标记为离线，离线过久的移除。
+        # 先写入待处理的心跳，避免把刚发过心跳的设备判为离线
+        self.flush()
+        now = time.monotonic()
+        while True:
+            with self._heap_lock:
+                if not self._heap or self._heap[0][0] > now:
+                    return
+                deadline, device_id = heapq.heappop(self._heap)
+            shard = self._shard(device_id)
+            reschedule = None
+            with shard.lock:
+                device = shard.devices.get(device_id)
+                if device is None or device.deadline != deadline:
+                    continue
+                if device.online:
+                    device.online = False
+                    device.deadline = deadline + self.retention
+                    reschedule = device.deadline
+                    self._emit('status', device)
+                else:
+                    del shard.devices[device_id]
+                    self._emit('leave', device)
+            if reschedule is not None:
+                self._schedule(reschedule, device_id)
+
+    def _next_deadline(self):
+        with self._heap_lock:
+            return self._heap[0][0] if self._heap else None
+
+    def start_expiry(self, interval=EXPIRE_INTERVAL):
+        # 没有人查询设备列表时也要按时推送离线事件
+        if self._expiry_thread is not None:
+            return
+
+        def run():
+            while True:
+                self.expire()
+                deadline = self._next_deadline()
+                wait = interval if deadline is None else deadline - time.monotonic()
+                time.sleep(min(interval, max(0.01, wait)))
+
+        self._expiry_thread = threading.Thread(target=run, daemon=True)
+        self._expiry_thread.start()
+
+    def get(self, device_id):
+        shard = self._shard(device_id)
+        with shard.lock:
+            return shard.devices.get(device_id)
+
+    def snapshot(self):
+        # 返回 (设备表, epoch, seq)。先取游标再复制设备表，复制期间发生的变化
+        # 既在设备表里也会在 seq 之后重放一次，重放是幂等的
+        self.expire()
+        epoch, seq = self.events.cursor()
+        now = time.monotonic()
+        wall_now = time.time()
+        result = {}
+        for shard in self._shards:
+            with shard.lock:
+                for device_id, device in shard.devices.items():
+                    result[device_id] = device.to_dict(now, wall_now)
+        return result, epoch, seq
+
+    def counts(self):
+        # (在线数, 离线数)
+        online = offline = 0
+        for shard in self._shards:
+            with shard.lock:
+                for device in shard.devices.values():
+                    if device.online:
+                        online += 1
+                    else:
+                        offline += 1
+        return online, offline
+
+    def __contains__(self, device_id):
+        return self.get(device_id) is not None
+
+    def __len__(self):
+        return sum(len(shard.devices) for shard in self._shards)
+
+
+class TransferTasks:
+    # 有上限、按创建时间过期的任务表。所有任务的 TTL 相同，
+    # 插入顺序就是过期顺序，淘汰时只需从 OrderedDict 头部弹出
+    def __init__(self, max_tasks=MAX_TRANSFER_TASKS, ttl=TRANSFER_TASK_TTL):
+        self.max_tasks = max_tasks
+        self.ttl = ttl
+        self._tasks = OrderedDict()
+        self._lock = threading.Lock()
+        # 任务创建的推送（/api/transfer/events，接收端据此接受传输请求）；
+        # 两端上报的进度更新频繁，单独记录（/api/transfer/progress），不占用请求流的积压
+        self.events = events.EventLog()
+        self.progress = events.EventLog()
+
+    def _evict(self, now):
+        while self._tasks:
+            created, _ = next(iter(self._tasks.values()))
+            if len(self._tasks) <= self.max_tasks and now - created < self.ttl:
+                return
+            self._tasks.popitem(last=False)
+
+    def add(self, transfer_id, task):
+        now = time.monotonic()
+        with self._lock:
+            self._tasks.pop(transfer_id, None)
+            self._tasks[transfer_id] = (now, task)
+            self._evict(now)
+            self.events.append({'type': 'init', 'transfer_id': transfer_id, 'task': dict(task)})
+
+    def get(self, transfer_id):
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            item = self._tasks.get(transfer_id)
+            return dict(item[1]) if item is not None else None
+
+    def update(self, transfer_id, **fields):
+        with self._lock:
+            item = self._tasks.get(transfer_id)
+            if item is None:
+                return False
+            item[1].update(fields)
+            return True
+
+    def report(self, transfer_id, role, progress):
+        # 发送端（sender）或接收端（receiver）上报的进度，两端分开保存。
+        # 任务状态以接收端为准（接收端没有上报时用发送端的），任一端失败即为失败；
+        # 返回更新后的任务，任务不存在时返回 None
+        progress = {key: progress.get(key) for key in PROGRESS_FIELDS}
+        with self._lock:
+            item = self._tasks.get(transfer_id)
+            if item is None:
+                return None
+            task = item[1]
+            task[role] = progress
+            sides = [task[r] for r in ('receiver', 'sender') if r in task]
+            failed = [side for side in sides if side['state'] == 'failed']
+            if failed:
+                task['status'] = 'failed'
+                task['error'] = failed[0]['error']
+            else:
+                task['status'] = TRANSFER_STATUS.get(sides[0]['state'], task['status'])
+            size = max((side['size'] or 0 for side in sides), default=0)
+            transferred = max(side['transferred'] or 0 for side in sides)
+            if task['status'] == 'completed':
+                task['progress'] = 100
+            elif size:
+                task['progress'] = round(min(100.0, transferred * 100 / size), 1)
+            task = dict(task)
+            self.progress.append({'type': 'progress', 'transfer_id': transfer_id, 'task': task})
+            return task
+
+    def offers(self, device_id, max_age=OFFER_TTL):
+        # 发给 device_id、还没有结束的传输请求（发送端可能已经上报 queued/running），按创建顺序
+        now = time.monotonic()
+        with self._lock:
+            return [dict(task, transfer_id=transfer_id) for transfer_id, (created, task) in self._tasks.items()
+                    if task.get('to_device') == device_id and task.get('status') not in FINISHED_STATUS
+                    and now - created < max_age]
+
+    def summary(self):
+        # 各状态的任务数和运行中任务的总速度（取每个任务两端中较快的一端）
+        counts = {}
+        rate = 0
+        with self._lock:
+            for _, task in self._tasks.values():
+                status = task.get('status')
+                counts[status] = counts.get(status, 0) + 1
+                if status == 'running':
+                    rate += max((task[r]['rate'] or 0 for r in ('sender', 'receiver') if r in task), default=0)
+        return {'counts': counts, 'rate': rate}
+
+    def __len__(self):
+        return len(self._tasks)
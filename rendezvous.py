@@ -0,0 +1,77 @@
+import ipaddress
+import socket
+
+# 设备间直连时的地址选择。
+#
+# 发送端在 file_info['addresses'] 中列出本机可以被连接的地址，其中通往接收端的那块网卡的地址排在最前；
+# 协调服务器另外附上它看到的发送端地址（task['source_ip']）。接收端从这些地址中挑一个：
+# 优先与本机某块网卡在同一子网的地址（直连，不经过路由器），其次保持发送端给出的顺序。
+# 选路只用 UDP connect 询问内核路由表，不发送任何数据
+
+# IPv4 按 /24 判断是否同一子网（没有办法不依赖第三方库读取网卡掩码）
+IPV4_PREFIX = 24
+IPV6_PREFIX = 64
+
+
+def local_ip_for(peer_ip):
+    # 发往 peer_ip 时内核会使用的本机地址，没有路由时返回 None
+    try:
+        family = socket.AF_INET6 if ':' in peer_ip else socket.AF_INET
+        with socket.socket(family, socket.SOCK_DGRAM) as s:
+            s.connect((peer_ip, 9))
+            return s.getsockname()[0]
+    except (OSError, ValueError):
+        return None
+
+
+def local_addresses():
+    # 本机的非回环 IPv4 地址（主机名解析结果加上默认路由使用的地址）
+    addresses = []
+    candidates = [local_ip_for('8.8.8.8')]
+    try:
+        candidates += [info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET)]
+    except OSError:
+        pass
+    for address in candidates:
+        if address and not address.startswith('127.') and address not in addresses:
+            addresses.append(address)
+    return addresses
+
+
+def advertised_addresses(peer_ip=None):
+    # 发送端写入 file_info 的地址列表
+    addresses = local_addresses()
+    preferred = local_ip_for(peer_ip) if peer_ip else None
+    if preferred:
+        addresses = [preferred] + [a for a in addresses if a != preferred]
+    return addresses
+
+
+def same_subnet(a, b):
+    try:
+        a, b = ipaddress.ip_address(a), ipaddress.ip_address(b)
+    except ValueError:
+        return False
+    if a.version != b.version:
+        return False
+    prefix = IPV4_PREFIX if a.version == 4 else IPV6_PREFIX
+    return b in ipaddress.ip_network(f'{a}/{prefix}', strict=False)
+
+
+def order_addresses(addresses):
+    # 接收端：按可达性排序并去重，最好的在最前
+    unique = []
+    for address in addresses:
+        if address and address not in unique:
+            unique.append(address)
+
+    def score(item):
+        index, address = item
+        local = local_ip_for(address)
+        if local is None:
+            return 2, index
+        if address == local or same_subnet(local, address):
+            return 0, index
+        return 1, index
+
+    return [address for _, address in sorted(enumerate(unique), key=score)]
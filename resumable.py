@@ -0,0 +1,336 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+from werkzeug.utils import secure_filename
+
+import chunk_store
+import integrity
+import transfer
+
+# 可断点续传的分块上传：
+#   init     -> 返回 upload_id（相同 key 的未完成上传会被复用）
+#   PUT 分块 -> 按序号写入 .part 文件的对应偏移，可乱序、可并行
+#   finalize -> 所有分块到齐后 fsync 并原子重命名到上传目录
+#
+# 给出去重存储（chunk_store.ChunkStore）时，完整落在一个上传分块内的存储分块边收边算摘要，
+# 直接写进存储；只有跨两个上传分块的存储分块先写到 .part，finalize 时再读出来。
+# finalize 只提交清单，不再把拼好的文件整个读一遍、重写一遍
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+# 超过该时间未活动的上传会被清理
+SESSION_TTL = 24 * 3600
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class UploadSession:
+    def __init__(self, upload_id, filename, size, chunk_size, key=None, received=None, updated_at=None,
+                 chunks=None, created=None):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.key = key
+        self.received = set(received or [])
+        self.updated_at = updated_at or time.time()
+        # 去重存储模式下：存储分块序号 -> 摘要，以及本次上传新写入存储的分块
+        self.chunks = {int(k): v for k, v in (chunks or {}).items()}
+        self.created = list(created or [])
+        self.lock = threading.Lock()
+
+    @property
+    def total_chunks(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    @property
+    def confirmed_offset(self):
+        # 从头开始连续收到的字节数，客户端可以从这里继续
+        index = 0
+        while index in self.received:
+            index += 1
+        return min(self.size, index * self.chunk_size)
+
+    def to_dict(self):
+        return {
+            'upload_id': self.upload_id,
+            'filename': self.filename,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'total_chunks': self.total_chunks,
+            'received': sorted(self.received),
+            'offset': self.confirmed_offset,
+        }
+
+
+class ResumableUploads:
+    def __init__(self, upload_folder, store=None):
+        self.upload_folder = upload_folder
+        self.store = store
+        self.partial_folder = os.path.join(upload_folder, '.partial')
+        os.makedirs(self.partial_folder, exist_ok=True)
+        self.sessions = {}
+        self.lock = threading.Lock()
+        if store is not None:
+            # 未完成的上传已经写进存储的分块在重启后继续占用，不能被其他上传的放弃或清理删掉
+            for name in os.listdir(self.partial_folder):
+                if name.endswith('.json'):
+                    session = self._load(name[:-len('.json')])
+                    if session is not None:
+                        self.sessions[session.upload_id] = session
+                        store.hold(session.chunks.values())
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.partial_folder, f'{upload_id}.part')
+
+    def _state_path(self, upload_id):
+        return os.path.join(self.partial_folder, f'{upload_id}.json')
+
+    def _save(self, session):
+        state = {
+            'filename': session.filename,
+            'size': session.size,
+            'chunk_size': session.chunk_size,
+            'key': session.key,
+            'received': sorted(session.received),
+            'updated_at': session.updated_at,
+            'chunks': session.chunks,
+            'created': session.created,
+        }
+        tmp_path = self._state_path(session.upload_id) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._state_path(session.upload_id))
+
+    def _load(self, upload_id):
+        try:
+            with open(self._state_path(upload_id)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return UploadSession(upload_id, **state)
+
+    def get(self, upload_id):
+        if not upload_id or any(c not in '0123456789abcdef' for c in upload_id):
+            raise UploadError('上传不存在', 404)
+        with self.lock:
+            session = self.sessions.get(upload_id)
+            if session is None:
+                # 服务重启后从磁盘恢复未完成的上传
+                session = self._load(upload_id)
+                if session is None:
+                    raise UploadError('上传不存在', 404)
+                self.sessions[upload_id] = session
+            return session
+
+    def _find_by_key(self, key):
+        for name in os.listdir(self.partial_folder):
+            if name.endswith('.json'):
+                upload_id = name[:-len('.json')]
+                session = self.sessions.get(upload_id) or self._load(upload_id)
+                if session is not None and session.key == key:
+                    self.sessions[upload_id] = session
+                    return session
+        return None
+
+    def init(self, filename, size, chunk_size=None, key=None):
+        filename = secure_filename(filename or '')
+        if not filename:
+            raise UploadError('没有选择文件')
+        if not isinstance(size, int) or size < 0:
+            raise UploadError('文件大小无效')
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        if not isinstance(chunk_size, int) or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise UploadError('分块大小无效')
+
+        self.cleanup()
+        with self.lock:
+            if key:
+                session = self._find_by_key(key)
+                if session is not None and session.size == size and session.filename == filename:
+                    return session
+            upload_id = uuid.uuid4().hex
+            session = UploadSession(upload_id, filename, size, chunk_size, key=key)
+            # 预先分配完整大小，乱序分块直接写到各自偏移
+            with open(self._part_path(upload_id), 'wb') as f:
+                f.truncate(size)
+            self._save(session)
+            self.sessions[upload_id] = session
+            return session
+
+    def _store_range(self, session, k):
+        # 第 k 个存储分块在文件中的范围
+        start = k * self.store.chunk_size
+        return start, min(start + self.store.chunk_size, session.size)
+
+    def _store_chunk_count(self, session):
+        return -(-session.size // self.store.chunk_size)
+
+    def write_chunk(self, upload_id, index, stream, expected=None):
+        # expected 为 (算法, 摘要)，校验失败的分块不会被标记为已收到，客户端只需重传这一块
+        session = self.get(upload_id)
+        if not 0 <= index < session.total_chunks:
+            raise UploadError('分块序号无效')
+        length = session.chunk_length(index)
+        offset = index * session.chunk_size
+        chunk_hash = integrity.new_hash(expected[0] if expected else integrity.DEFAULT_ALGORITHM)
+        written = 0
+        # 完整落在本分块内的存储分块直接写进存储，其余部分写到 .part
+        digests = {}
+        created = []
+        buffer = bytearray()
+        fd = os.open(self._part_path(upload_id), os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            while True:
+                data = stream.read(READ_SIZE)
+                if not data:
+                    break
+                if written + len(data) > length:
+                    raise UploadError('分块数据超出长度')
+                chunk_hash.update(data)
+                if self.store is None:
+                    transfer.pwrite(fd, data, offset + written)
+                    written += len(data)
+                    continue
+                view = memoryview(data)
+                while view:
+                    pos = offset + written
+                    k = pos // self.store.chunk_size
+                    start, end = self._store_range(session, k)
+                    take = min(len(view), end - pos)
+                    if start < offset or end > offset + length:
+                        transfer.pwrite(fd, view[:take], pos)
+                    else:
+                        buffer += view[:take]
+                        if pos + take == end:
+                            digest = chunk_store.chunk_digest(buffer)
+                            if self.store.put_chunk_bytes(digest, bytes(buffer)):
+                                created.append(digest)
+                            digests[k] = digest
+                            buffer.clear()
+                    view = view[take:]
+                    written += take
+            if written != length:
+                raise UploadError(f'分块不完整: {written}/{length} 字节')
+            digest = chunk_hash.hexdigest()
+            if expected and expected[1] != digest:
+                raise UploadError('分块校验失败，请重传', 422)
+        except Exception:
+            if digests:
+                self.store.release(digests.values())
+                self.store.discard(created)
+            raise
+        finally:
+            os.close(fd)
+
+        with session.lock:
+            session.received.add(index)
+            # 重传的分块替换原来的摘要，原来的占用随之释放
+            replaced = [session.chunks[k] for k in digests if k in session.chunks]
+            session.chunks.update(digests)
+            session.created.extend(created)
+            session.updated_at = time.time()
+            self._save(session)
+        if replaced:
+            self.store.release(replaced)
+        return session, digest
+
+    def _commit_store(self, session):
+        # 补上跨上传分块的存储分块，然后提交清单；存储中已经找不到的分块（上传期间被清理）
+        # 对应的上传分块重新标记为未收到，返回 409 让客户端续传
+        digests = []
+        with open(self._part_path(session.upload_id), 'rb') as f:
+            for k in range(self._store_chunk_count(session)):
+                digest = session.chunks.get(k)
+                if digest is None:
+                    start, end = self._store_range(session, k)
+                    f.seek(start)
+                    data = f.read(end - start)
+                    digest = chunk_store.chunk_digest(data)
+                    if self.store.put_chunk_bytes(digest, data):
+                        session.created.append(digest)
+                    session.chunks[k] = digest
+                digests.append(digest)
+        lost = set(self.store.missing(digests))
+        if lost:
+            for k, digest in enumerate(digests):
+                if digest in lost:
+                    start, end = self._store_range(session, k)
+                    session.received.difference_update(range(start // session.chunk_size,
+                                                             (end - 1) // session.chunk_size + 1))
+                    self.store.release([session.chunks.pop(k)])
+            self._save(session)
+            raise UploadError(f'有 {len(lost)} 个存储分块丢失，请重新上传对应的分块', 409)
+        try:
+            self.store.commit(session.filename, session.size, digests)
+        except chunk_store.StoreError as e:
+            raise UploadError(e.message, e.status)
+        # 分块已经由清单引用，不再需要上传会话占用
+        session.chunks = {}
+        self.store.release(digests)
+
+    def finalize(self, upload_id):
+        # 返回 (session, 文件路径)；写进去重存储时路径为 None
+        session = self.get(upload_id)
+        with session.lock:
+            missing = session.total_chunks - len(session.received)
+            if missing:
+                raise UploadError(f'还有 {missing} 个分块未上传', 409)
+            part_path = self._part_path(upload_id)
+            if self.store is not None:
+                self._commit_store(session)
+                file_path = None
+                os.remove(part_path)
+            else:
+                fd = os.open(part_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                file_path = os.path.join(self.upload_folder, session.filename)
+                os.replace(part_path, file_path)
+            os.remove(self._state_path(upload_id))
+        with self.lock:
+            self.sessions.pop(upload_id, None)
+        return session, file_path
+
+    def _discard(self, upload_id, session):
+        for path in (self._part_path(upload_id), self._state_path(upload_id)):
+            if os.path.exists(path):
+                os.remove(path)
+        # 删除为这次上传写入存储、又没有被任何清单引用、也没有被其他未完成上传占用的分块
+        if self.store is not None and session is not None:
+            self.store.release(session.chunks.values())
+            session.chunks = {}
+            self.store.discard(session.created)
+
+    def abort(self, upload_id):
+        session = self.get(upload_id)
+        with self.lock:
+            self.sessions.pop(upload_id, None)
+            self._discard(upload_id, session)
+        return session
+
+    def cleanup(self, ttl=SESSION_TTL):
+        now = time.time()
+        with self.lock:
+            for name in os.listdir(self.partial_folder):
+                if not name.endswith('.json'):
+                    continue
+                upload_id = name[:-len('.json')]
+                session = self.sessions.get(upload_id) or self._load(upload_id)
+                if session is None or now - session.updated_at > ttl:
+                    self.sessions.pop(upload_id, None)
+                    self._discard(upload_id, session)
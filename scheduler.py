@@ -0,0 +1,397 @@
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import events
+import metrics
+
+# 传输调度：客户端的所有发送和接收都作为任务排队，由固定大小的线程池执行。
+#
+# - 同时运行的任务数不超过 max_active，同一对端不超过 per_peer
+# - 优先级 interactive > normal > bulk，同一优先级按提交顺序；
+#   bulk 任务最多占用 max_active - 1 个位置，始终给前台任务留一个
+# - 令牌桶限速：全局一个，另外每个优先级可以单独限速（默认只限制 bulk），
+#   任务通过 job.throttle(n) 在发送/接收 n 字节前取令牌，同时记录进度
+#
+# 也可以用 slot() 在调用线程里占用一个位置（例如必须在 HTTP 请求中完成的流水线发送），
+# 排队期间被取消时 slot() 抛出 JobCancelled；wait=False 时没有空闲位置直接得到 None。
+# slot() 中的任务可以用 hand_off() 转到后台继续执行，位置一直保留到后台任务结束
+#
+# 任务函数是协程函数时在传输核心（atransfer.TransferCore）的事件循环上运行，不占用线程池；
+# 这类任务可以在运行中取消，也受总超时 timeout 限制，限速和进度通过 await job.athrottle(n)
+#
+# 任务的进度（字节数、当前/平均速度、ETA）由 throttle 顺带统计，每 metrics.REPORT_INTERVAL 最多上报一次：
+# 写入 events（页面通过 SSE 订阅）并调用 on_update（客户端据此转发给协调服务器）。
+# 排队、开始、结束、取消时也各上报一次
+
+PRIORITIES = {'interactive': 0, 'normal': 1, 'bulk': 2}
+DEFAULT_PRIORITY = 'normal'
+MAX_ACTIVE = int(os.environ.get('EREVENT_TRANSFER_WORKERS', 4))
+PER_PEER = int(os.environ.get('EREVENT_PEER_TRANSFERS', 2))
+# 字节/秒，0 表示不限速
+RATE_LIMIT = int(os.environ.get('EREVENT_RATE_LIMIT', 0))
+BULK_RATE_LIMIT = int(os.environ.get('EREVENT_BULK_RATE_LIMIT', 0))
+# 异步任务的总超时（秒），0 表示不限
+TRANSFER_TIMEOUT = float(os.environ.get('EREVENT_TRANSFER_TIMEOUT', 0))
+# 令牌桶容量，允许的突发时长
+BURST_SECONDS = 0.5
+# 状态接口中保留的已结束任务数
+HISTORY = 50
+# 推送通道保留的最近事件数，落后更多的订阅者收到 reset
+EVENT_BACKLOG = 1000
+
+
+class JobCancelled(Exception):
+    # slot() 排队期间任务被取消
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate * BURST_SECONDS)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n):
+        # 取 n 个令牌，返回需要等待的时长；令牌不足时记为欠账，大块数据不需要拆分
+        if not self.rate:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def consume(self, n):
+        wait = self.reserve(n)
+        if wait:
+            time.sleep(wait)
+
+
+class Job:
+    def __init__(self, scheduler, fn, kind, peer, priority, name, size, transfer_id=None, timeout=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.transfer_id = transfer_id
+        self.fn = fn
+        self.is_async = asyncio.iscoroutinefunction(fn)
+        self.timeout = timeout
+        self.kind = kind
+        self.peer = peer
+        self.priority = priority
+        self.name = name
+        self.size = size
+        self.state = 'queued'
+        self.meter = metrics.Meter(size)
+        self.error = None
+        self.created = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.ready = threading.Event()
+        # 异步任务在事件循环中对应的 asyncio.Task，以及是否已请求取消
+        self.task = None
+        self.cancel_requested = False
+        self._scheduler = scheduler
+
+    @property
+    def transferred(self):
+        return self.meter.total
+
+    def throttle(self, n):
+        # 可以在多个连接线程中同时调用
+        if self.meter.add(n):
+            self._scheduler.report(self)
+        self._scheduler.consume(self.priority, n)
+
+    async def athrottle(self, n):
+        # 异步任务使用：限速时在事件循环上等待，不阻塞其他传输
+        if self.meter.add(n):
+            self._scheduler.report(self)
+        wait = self._scheduler.reserve(self.priority, n)
+        if wait:
+            await asyncio.sleep(wait)
+
+    @property
+    def cancellable(self):
+        return self.state == 'queued' or (self.state == 'running' and self.is_async)
+
+    def to_dict(self, now=None):
+        now = now or time.monotonic()
+        started = self.started or now
+        return dict(self.meter.snapshot(self.finished), **{
+            'id': self.id,
+            'transfer_id': self.transfer_id,
+            'kind': self.kind,
+            'name': self.name,
+            'peer': self.peer,
+            'priority': self.priority,
+            'state': self.state,
+            'cancellable': self.cancellable,
+            'waited': round(started - self.created, 3),
+            'elapsed': round((self.finished or now) - started, 3) if self.started else 0,
+            'error': self.error,
+        })
+
+
+class TransferScheduler:
+    def __init__(self, max_active=MAX_ACTIVE, per_peer=PER_PEER, rate=RATE_LIMIT, class_rates=None,
+                 on_update=None, core=None):
+        self.max_active = max(1, max_active)
+        self.per_peer = max(1, per_peer)
+        self.rate = rate
+        self.class_rates = {'bulk': BULK_RATE_LIMIT} if class_rates is None else class_rates
+        self._bucket = TokenBucket(rate)
+        self._class_buckets = {p: TokenBucket(r) for p, r in self.class_rates.items() if r}
+        self._executor = ThreadPoolExecutor(max_workers=self.max_active, thread_name_prefix='transfer')
+        # 运行异步任务的 atransfer.TransferCore
+        self.core = core
+        self._lock = threading.Lock()
+        self._queue = []
+        self._order = itertools.count()
+        self._running = {}
+        self._peers = {}
+        self._history = deque(maxlen=HISTORY)
+        self.events = events.EventLog(EVENT_BACKLOG)
+        # on_update(job_dict) 在传输线程中调用，不能阻塞
+        self.on_update = on_update
+        # 已结束任务的累计值：(kind, 结果) -> 任务数，(kind, priority) -> 字节数
+        self._finished_jobs = {}
+        self._finished_bytes = {}
+
+    def consume(self, priority, n):
+        bucket = self._class_buckets.get(priority)
+        if bucket is not None:
+            bucket.consume(n)
+        self._bucket.consume(n)
+
+    def reserve(self, priority, n):
+        bucket = self._class_buckets.get(priority)
+        wait = bucket.reserve(n) if bucket is not None else 0
+        return max(wait, self._bucket.reserve(n))
+
+    def report(self, job, event_type='progress'):
+        data = job.to_dict()
+        self.events.append({'type': event_type, 'job': data})
+        if self.on_update is not None:
+            self.on_update(data)
+
+    def _job(self, fn, kind, peer, priority, name, size, transfer_id, timeout=None):
+        if priority not in PRIORITIES:
+            raise ValueError(f'未知的优先级: {priority}')
+        job = Job(self, fn, kind, peer, priority, name, size, transfer_id, timeout)
+        if job.is_async and self.core is None:
+            raise ValueError('调度器没有传输核心，不能运行异步任务')
+        return job
+
+    def _enqueue(self, job, wait=True):
+        # wait=False 时只在能立即开始时入队，返回是否已经开始
+        with self._lock:
+            entry = (PRIORITIES[job.priority], next(self._order), job)
+            heapq.heappush(self._queue, entry)
+            if wait:
+                self.report(job, 'queued')
+            self._dispatch()
+            if not wait and job.state == 'queued':
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                return False
+            return True
+
+    def submit(self, fn, kind='send', peer=None, priority=DEFAULT_PRIORITY, name=None, size=None,
+               transfer_id=None, timeout=None):
+        # fn(job) 在线程池中执行，fn 为协程函数时在传输核心的事件循环上执行；返回 Job。
+        # timeout 只对异步任务有效，默认为 TRANSFER_TIMEOUT
+        job = self._job(fn, kind, peer, priority, name, size, transfer_id, timeout or TRANSFER_TIMEOUT or None)
+        self._enqueue(job)
+        return job
+
+    @contextmanager
+    def slot(self, kind='send', peer=None, priority=DEFAULT_PRIORITY, name=None, size=None, transfer_id=None,
+             wait=True):
+        # 在调用线程中排队等待位置，之后像线程池任务一样计入并发限制；
+        # wait=False 时不排队，没有空闲位置得到 None
+        job = self._job(None, kind, peer, priority, name, size, transfer_id)
+        if not self._enqueue(job, wait):
+            yield None
+            return
+        job.ready.wait()
+        if job.state == 'cancelled':
+            raise JobCancelled('任务已取消')
+        try:
+            yield job
+        except BaseException as e:
+            self._finish(job, e)
+            raise
+        if job.fn is None:
+            self._finish(job, None)
+        elif job.is_async:
+            self.core.submit(self._run_async(job))
+        else:
+            self._executor.submit(self._run, job)
+
+    def hand_off(self, job, fn):
+        # 在 slot() 中调用：离开 with 块后 fn(job) 在后台运行（协程函数在事件循环上），
+        # 还是同一个任务，占用的位置直到 fn 结束才释放
+        if asyncio.iscoroutinefunction(fn) and self.core is None:
+            raise ValueError('调度器没有传输核心，不能运行异步任务')
+        job.fn = fn
+        job.is_async = asyncio.iscoroutinefunction(fn)
+
+    def _eligible(self, job, bulk_active):
+        if self._peers.get(job.peer, 0) >= self.per_peer:
+            return False
+        return job.priority != 'bulk' or self.max_active == 1 or bulk_active < self.max_active - 1
+
+    def _dispatch(self):
+        # 持有 self._lock 时调用：按优先级启动可以运行的任务，
+        # 被对端并发数限制挡住的任务留在队列中，不影响后面的任务
+        if len(self._running) >= self.max_active or not self._queue:
+            return
+        bulk_active = sum(1 for job in self._running.values() if job.priority == 'bulk')
+        skipped = []
+        while self._queue and len(self._running) < self.max_active:
+            entry = heapq.heappop(self._queue)
+            job = entry[2]
+            if job.state == 'cancelled':
+                continue
+            if not self._eligible(job, bulk_active):
+                skipped.append(entry)
+                continue
+            job.state = 'running'
+            job.started = time.monotonic()
+            self._running[job.id] = job
+            self._peers[job.peer] = self._peers.get(job.peer, 0) + 1
+            if job.priority == 'bulk':
+                bulk_active += 1
+            self.report(job, 'started')
+            if job.fn is None:
+                job.ready.set()
+            elif job.is_async:
+                self.core.submit(self._run_async(job))
+            else:
+                self._executor.submit(self._run, job)
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+    def _run(self, job):
+        try:
+            job.fn(job)
+        except Exception as e:
+            self._finish(job, e)
+            return
+        self._finish(job, None)
+
+    async def _run_async(self, job):
+        # 在事件循环上运行；cancel() 可能在任务开始之前就已请求
+        job.task = asyncio.current_task()
+        try:
+            if job.cancel_requested:
+                raise asyncio.CancelledError()
+            await asyncio.wait_for(job.fn(job), job.timeout)
+        except asyncio.CancelledError:
+            self._finish(job, None, 'cancelled')
+        except asyncio.TimeoutError:
+            self._finish(job, TimeoutError(f'超过 {job.timeout:g} 秒没有完成'))
+        except Exception as e:
+            self._finish(job, e)
+        else:
+            self._finish(job, None)
+
+    def _finish(self, job, error, state=None):
+        with self._lock:
+            job.finished = time.monotonic()
+            job.state = state or ('failed' if error is not None else 'done')
+            job.error = str(error) if error is not None else None
+            self._running.pop(job.id, None)
+            count = self._peers.get(job.peer, 0) - 1
+            if count > 0:
+                self._peers[job.peer] = count
+            else:
+                self._peers.pop(job.peer, None)
+            self._history.append(job)
+            key = (job.kind, job.state)
+            self._finished_jobs[key] = self._finished_jobs.get(key, 0) + 1
+            key = (job.kind, job.priority)
+            self._finished_bytes[key] = self._finished_bytes.get(key, 0) + job.transferred
+            self.report(job, 'finished')
+            self._dispatch()
+
+    def cancel(self, job_id):
+        # 可以取消还在排队的任务和运行中的异步任务（线程池中的任务无法中断）
+        with self._lock:
+            job = self._running.get(job_id)
+            if job is not None:
+                if not job.is_async or job.cancel_requested:
+                    return False
+                job.cancel_requested = True
+                self.core.loop.call_soon_threadsafe(self._cancel_task, job)
+                return True
+            for _, _, job in self._queue:
+                if job.id == job_id and job.state == 'queued':
+                    job.state = 'cancelled'
+                    job.finished = time.monotonic()
+                    self._history.append(job)
+                    key = (job.kind, job.state)
+                    self._finished_jobs[key] = self._finished_jobs.get(key, 0) + 1
+                    self.report(job, 'finished')
+                    # slot() 中等待的线程醒来后抛出 JobCancelled
+                    job.ready.set()
+                    return True
+        return False
+
+    @staticmethod
+    def _cancel_task(job):
+        # 在事件循环中调用；任务还没开始时由 _run_async 检查 cancel_requested
+        if job.task is not None:
+            job.task.cancel()
+
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            queued = [entry[2] for entry in sorted(self._queue) if entry[2].state == 'queued']
+            running = list(self._running.values())
+            history = list(self._history)
+        return {
+            'limits': {
+                'max_active': self.max_active,
+                'per_peer': self.per_peer,
+                'rate': self.rate,
+                'class_rates': self.class_rates,
+            },
+            'active': len(running),
+            'queued': len(queued),
+            'jobs': [job.to_dict(now) for job in running + queued],
+            'recent': [job.to_dict(now) for job in reversed(history)],
+        }
+
+    def metric_families(self):
+        # Prometheus 指标（见 metrics.render），字节数包含运行中任务已传输的部分
+        with self._lock:
+            queued = sum(1 for entry in self._queue if entry[2].state == 'queued')
+            running = list(self._running.values())
+            jobs = dict(self._finished_jobs)
+            transferred = dict(self._finished_bytes)
+        rates = {}
+        for job in running:
+            key = (job.kind, job.priority)
+            transferred[key] = transferred.get(key, 0) + job.transferred
+            rates[job.kind] = rates.get(job.kind, 0) + job.meter.snapshot()['rate']
+        return [
+            ('erevent_transfer_jobs', 'gauge', '排队和运行中的传输任务数',
+             [({'state': 'queued'}, queued), ({'state': 'running'}, len(running))]),
+            ('erevent_transfer_jobs_finished_total', 'counter', '已结束的传输任务数',
+             [({'kind': kind, 'result': result}, n) for (kind, result), n in sorted(jobs.items())]),
+            ('erevent_transfer_bytes_total', 'counter', '已传输的字节数（线路上的字节，压缩时为压缩后的大小）',
+             [({'kind': kind, 'priority': priority}, n) for (kind, priority), n in sorted(transferred.items())]),
+            ('erevent_transfer_rate_bytes', 'gauge', '运行中任务的当前总速度（字节/秒）',
+             [({'kind': kind}, rate) for kind, rate in sorted(rates.items())]),
+        ]
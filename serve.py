@@ -0,0 +1,92 @@
+import argparse
+import json
+import logging
+
+import aserve
+
+# 生产环境入口：
+#   python serve.py server [--port 5000] [--workers 32]   协调服务器（server.py）
+#   python serve.py app    [--port 5000] [--workers 32]   文件服务（app.py）
+#
+# 两者都运行在 aserve 的 asyncio 服务器上。协调服务器的心跳、设备事件流和传输事件流是原生协程路由，
+# 成千上万个设备的 keep-alive 连接和 SSE 长连接不占用线程；其余接口在线程池中执行。
+# 注册表、文件索引等状态都在进程内，因此只能单进程运行，并发由事件循环和线程池提供
+
+
+def coordinator_routes(server):
+    import events
+
+    async def heartbeat(request):
+        try:
+            data = json.loads(await request.read_body() or b'{}')
+            result = server.heartbeat_result(data.get('device_id'), request.remote_addr)
+            status = 200
+        except (ValueError, AttributeError) as e:
+            result = {'status': 'error', 'message': str(e)}
+            status = 400
+        return await request.send_response(status, [('Content-Type', 'application/json')],
+                                           json.dumps(result).encode())
+
+    def sse_route(log, event_type, include=None):
+        # include(request) 返回该连接的事件过滤函数（或 None）
+        async def stream(request):
+            cursor = events.parse_cursor(
+                request.header('last-event-id') or request.query.get('epoch'),
+                request.query.get('since')
+            )
+            # 用 chunked 编码，客户端可以逐个事件读取；reset 之后正常结束响应
+            await request.write(b'HTTP/1.1 200 OK\r\n'
+                                b'Content-Type: text/event-stream; charset=utf-8\r\n'
+                                b'Cache-Control: no-cache\r\n'
+                                b'X-Accel-Buffering: no\r\n'
+                                b'Transfer-Encoding: chunked\r\n\r\n')
+            async for frame in events.sse_stream_async(log, cursor, event_type=event_type,
+                                                       include=include(request) if include else None):
+                data = frame.encode()
+                await request.write(b'%x\r\n%b\r\n' % (len(data), data))
+            await request.write(b'0\r\n\r\n')
+            return request.keep_alive and not request.server.closing
+        return stream
+
+    return {
+        ('POST', '/api/heartbeat'): heartbeat,
+        ('GET', '/api/devices/events'): sse_route(server.devices.events, 'device'),
+        ('GET', '/api/transfer/events'): sse_route(server.transfer_tasks.events, 'transfer',
+                                                   lambda request: server.offer_filter(request.query.get('device_id'))),
+        ('GET', '/api/transfer/progress'): sse_route(server.transfer_tasks.progress, 'progress',
+                                                     lambda request: server.progress_filter(request.query.get('transfer_id'))),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ER-Event 生产环境服务器')
+    parser.add_argument('service', choices=['server', 'app'])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=aserve.DEFAULT_WORKERS)
+    parser.add_argument('--no-zeroconf', action='store_true', help='不注册 Zeroconf 服务（用于测试）')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.service == 'app':
+        import app
+        aserve.run(app.app, args.host, args.port, args.workers)
+        return
+
+    import server
+    zeroconf = None if args.no_zeroconf else server.register_zeroconf_service(args.port)
+
+    def on_shutdown():
+        if zeroconf is not None:
+            logging.info("Unregistering Zeroconf service...")
+            zeroconf.unregister_all_services()
+            zeroconf.close()
+
+    aserve.run(server.app, args.host, args.port, args.workers,
+               routes=coordinator_routes(server),
+               stream_routes=['/api/devices/events', '/api/transfer/events', '/api/transfer/progress'],
+               on_shutdown=on_shutdown)
+
+
+if __name__ == '__main__':
+    main()
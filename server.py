@@ -1,11 +1,15 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from werkzeug.serving import WSGIRequestHandler
 from zeroconf import ServiceInfo, Zeroconf
 import socket
 import json
 import threading
-import time
+import uuid
 from datetime import datetime
 import logging
+import registry
+import events
+import metrics
 
 # 配置日志
 logging.basicConfig(level=logging.INFO,
@@ -14,9 +18,10 @@ logging.basicConfig(level=logging.INFO,
 app = Flask(__name__)
 
 # 存储设备信息
-devices = {}
-# 存储传输任务
-transfer_tasks = {}
+devices = registry.DeviceRegistry()
+devices.start_expiry()
+# 存储传输任务，超过上限或过期的任务会被淘汰
+transfer_tasks = registry.TransferTasks()
 
 def get_local_ip():
     try:
@@ -29,7 +34,7 @@ def get_local_ip():
         return '127.0.0.1'
 
 # 注册Zeroconf服务
-def register_zeroconf_service():
+def register_zeroconf_service(port=5000):
     local_ip = get_local_ip()
     logging.info(f"Local IP: {local_ip}")
     zeroconf = Zeroconf()
@@ -37,7 +42,7 @@ def register_zeroconf_service():
         "_erevent._tcp.local.",
         "ER-Event Server._erevent._tcp.local.",
         addresses=[socket.inet_aton(local_ip)],
-        port=5000,
+        port=port,
         properties={},
     )
     zeroconf.register_service(service_info)
@@ -62,12 +67,7 @@ def register_device():
                 'message': '缺少设备ID或设备名称'
             }), 400
         
-        devices[device_id] = {
-            'name': device_name,
-            'ip': device_ip,
-            'last_seen': datetime.now().isoformat(),
-            'status': 'online'
-        }
+        devices.register(device_id, device_name, device_ip)
         
         logging.info(f"Device registered successfully: {device_id} - {device_name}")
         return jsonify({
@@ -81,30 +81,63 @@ def register_device():
             'message': f'注册失败: {str(e)}'
         }), 500
 
-@app.route('/api/devices', methods=['GET'])
-def get_devices():
-    logging.info("Received devices list request")
-    # 清理超时设备
-    current_time = datetime.now()
-    for device_id in list(devices.keys()):
-        last_seen = datetime.fromisoformat(devices[device_id]['last_seen'])
-        if (current_time - last_seen).seconds > 60:  # 60秒超时
-            devices[device_id]['status'] = 'offline'
-    
+@app.route('/api/health', methods=['GET'])
+def health():
+    # 客户端的服务发现用它探测服务器是否可用并测量延迟；epoch 在服务器重启后变化
     return jsonify({
         'status': 'success',
-        'devices': devices
+        'epoch': devices.events.epoch,
+        'devices': len(devices)
     })
 
+@app.route('/api/devices', methods=['GET'])
+def get_devices():
+    # 带 epoch 和 since 参数时只返回之后的变化；无法续传时返回完整列表并带 reset 标记
+    if request.args.get('since') is not None:
+        epoch, seq = events.parse_cursor(request.args.get('epoch'), request.args.get('since'))
+        changes = devices.events.since(epoch, seq)
+        if changes is not None:
+            return jsonify({
+                'status': 'success',
+                'epoch': epoch,
+                'seq': changes[-1]['seq'] if changes else seq,
+                'events': changes
+            })
+    snapshot, epoch, seq = devices.snapshot()
+    response = {
+        'status': 'success',
+        'devices': snapshot,
+        'epoch': epoch,
+        'seq': seq
+    }
+    if request.args.get('since') is not None:
+        response['reset'] = True
+    return jsonify(response)
+
+@app.route('/api/devices/events', methods=['GET'])
+def device_events():
+    # SSE：推送 since 之后的设备变化，断线重连时 EventSource 会带上 Last-Event-ID
+    cursor = events.parse_cursor(
+        request.headers.get('Last-Event-ID') or request.args.get('epoch'),
+        request.args.get('since')
+    )
+    return Response(events.sse_stream(devices.events, cursor), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def heartbeat_result(device_id, ip):
+    # interval 为建议的下次心跳间隔；registered 为 False 时客户端需要重新注册（如服务器重启后）
+    registered = bool(device_id) and devices.heartbeat(device_id, ip)
+    return {
+        'status': 'success',
+        'registered': registered,
+        'interval': devices.heartbeat_interval()
+    }
+
 @app.route('/api/heartbeat', methods=['POST'])
 def heartbeat():
     try:
         data = request.json
-        device_id = data.get('device_id')
-        if device_id in devices:
-            devices[device_id]['last_seen'] = datetime.now().isoformat()
-            devices[device_id]['status'] = 'online'
-        return jsonify({'status': 'success'})
+        return jsonify(heartbeat_result(data.get('device_id'), request.remote_addr))
     except Exception as e:
         logging.error(f"Error during heartbeat: {str(e)}")
         return jsonify({
@@ -112,6 +145,10 @@ def heartbeat():
             'message': str(e)
         }), 500
 
+@app.route('/api/metrics/heartbeat', methods=['GET'])
+def heartbeat_metrics():
+    return jsonify(devices.metrics())
+
 @app.route('/api/transfer/init', methods=['POST'])
 def init_transfer():
     try:
@@ -120,14 +157,17 @@ def init_transfer():
         to_device = data.get('to_device')
         file_info = data.get('file_info')
         
-        transfer_id = f"{from_device}-{to_device}-{int(time.time())}"
-        transfer_tasks[transfer_id] = {
+        # 同一对设备在同一秒内可能发起多个传输，用随机 id 避免互相覆盖
+        transfer_id = uuid.uuid4().hex
+        transfer_tasks.add(transfer_id, {
             'from_device': from_device,
             'to_device': to_device,
             'file_info': file_info,
+            # 接收端连接发送端时的备选地址（发送端自己在 file_info['addresses'] 中给出的优先）
+            'source_ip': request.remote_addr,
             'status': 'pending',
             'created_at': datetime.now().isoformat()
-        }
+        })
         
         logging.info(f"Transfer initialized: {transfer_id}")
         return jsonify({
@@ -141,12 +181,110 @@ def init_transfer():
             'message': str(e)
         }), 500
 
+@app.route('/api/transfer/progress/<transfer_id>', methods=['POST'])
+def report_transfer_progress(transfer_id):
+    # 客户端的调度器定期上报：{"role": "sender"|"receiver", "state", "transferred", "size",
+    # "rate", "avg_rate", "eta", "error"}，速度单位为字节/秒
+    data = request.get_json(silent=True) or {}
+    role = data.get('role')
+    numbers = [data.get(key) for key in ('transferred', 'size', 'rate', 'avg_rate', 'eta')]
+    if (role not in ('sender', 'receiver') or data.get('state') not in registry.TRANSFER_STATUS
+            or not all(value is None or isinstance(value, (int, float)) for value in numbers)):
+        return jsonify({
+            'status': 'error',
+            'message': '参数无效'
+        }), 400
+    task = transfer_tasks.report(transfer_id, role, data)
+    if task is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Transfer not found'
+        }), 404
+    return jsonify({'status': 'success'})
+
+@app.route('/api/transfer/offers', methods=['GET'])
+def transfer_offers():
+    # 发给 device_id 的待接收传输（接收端订阅 /api/transfer/events 前的快照）
+    device_id = request.args.get('device_id')
+    if not device_id:
+        return jsonify({
+            'status': 'error',
+            'message': '缺少设备ID'
+        }), 400
+    epoch, seq = transfer_tasks.events.cursor()
+    return jsonify({
+        'status': 'success',
+        'offers': transfer_tasks.offers(device_id),
+        'epoch': epoch,
+        'seq': seq
+    })
+
+def offer_filter(device_id):
+    # 带 device_id 时只推送发给该设备的新传输，接收端据此直接连接发送端
+    if not device_id:
+        return None
+    return lambda event: event['type'] == 'init' and event['task'].get('to_device') == device_id
+
+@app.route('/api/transfer/events', methods=['GET'])
+def transfer_events():
+    # SSE：传输任务的创建
+    cursor = events.parse_cursor(
+        request.headers.get('Last-Event-ID') or request.args.get('epoch'),
+        request.args.get('since')
+    )
+    stream = events.sse_stream(transfer_tasks.events, cursor, event_type='transfer',
+                               include=offer_filter(request.args.get('device_id')))
+    return Response(stream,
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def progress_filter(transfer_id):
+    # 带 transfer_id 时只推送该任务的进度
+    if not transfer_id:
+        return None
+    return lambda event: event['transfer_id'] == transfer_id
+
+@app.route('/api/transfer/progress', methods=['GET'])
+def transfer_progress_events():
+    # SSE：两端上报的进度（合并后的任务状态）
+    cursor = events.parse_cursor(
+        request.headers.get('Last-Event-ID') or request.args.get('epoch'),
+        request.args.get('since')
+    )
+    stream = events.sse_stream(transfer_tasks.progress, cursor, event_type='progress',
+                               include=progress_filter(request.args.get('transfer_id')))
+    return Response(stream,
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def metric_families():
+    online, offline = devices.counts()
+    stats = devices.metrics()
+    transfers = transfer_tasks.summary()
+    return [
+        ('erevent_devices', 'gauge', '已注册的设备数',
+         [({'status': 'online'}, online), ({'status': 'offline'}, offline)]),
+        ('erevent_heartbeats_total', 'counter', '收到的心跳数', [({}, stats['heartbeats'])]),
+        ('erevent_heartbeat_batches_total', 'counter', '心跳批量写入的次数', [({}, stats['batches'])]),
+        ('erevent_heartbeat_pending', 'gauge', '等待批量写入的心跳数', [({}, stats['pending'])]),
+        ('erevent_heartbeat_interval_seconds', 'gauge', '建议的心跳间隔', [({}, stats['heartbeat_interval'])]),
+        ('erevent_heartbeat_flush_seconds_total', 'counter', '批量写入心跳的累计耗时', [({}, stats['flush_seconds'])]),
+        ('erevent_transfer_tasks', 'gauge', '任务表中各状态的传输任务数',
+         [({'status': status}, n) for status, n in sorted(transfers['counts'].items())]),
+        ('erevent_transfer_rate_bytes', 'gauge', '运行中传输的当前总速度（字节/秒）', [({}, transfers['rate'])]),
+    ]
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(metric_families()), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/api/transfer/status/<transfer_id>', methods=['GET'])
 def get_transfer_status(transfer_id):
-    if transfer_id in transfer_tasks:
+    task = transfer_tasks.get(transfer_id)
+    if task is not None:
         return jsonify({
             'status': 'success',
-            'task': transfer_tasks[transfer_id]
+            'task': task
         })
     return jsonify({
         'status': 'error',
@@ -160,6 +298,8 @@ def main():
     local_ip = get_local_ip()
     logging.info(f"Server running on {local_ip}:5000")
     
+    # 使用 HTTP/1.1，客户端的心跳可以复用同一个连接
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
     try:
         app.run(host='0.0.0.0', port=5000, debug=True)
     finally:
@@ -0,0 +1,88 @@
+import importlib
+import io
+import os
+
+import pytest
+
+import chunk_store
+
+# 去重存储用默认分块大小，文件跨多个存储分块，Range 需要拼接分块
+SIZE = 2 * chunk_store.CHUNK_SIZE + 12345
+
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    # app.py 在导入时按相对路径创建 uploads/，在临时目录里导入并一直保持该工作目录
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    try:
+        module = importlib.import_module('app')
+        yield module
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope='module')
+def client(app_module):
+    test_client = app_module.app.test_client()
+    test_client.data = os.urandom(SIZE)
+    response = test_client.post('/upload', data={'file': (io.BytesIO(test_client.data), 'stored.bin')},
+                                content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert app_module.store is not None and app_module.store.get('stored.bin') is not None
+    with open(os.path.join(app_module.app.config['UPLOAD_FOLDER'], 'plain.txt'), 'wb') as f:
+        f.write(b'plain file')
+    return test_client
+
+
+def test_download_store_file(client):
+    response = client.get('/download/stored.bin')
+    assert response.status_code == 200
+    assert response.data == client.data
+
+
+def test_download_store_file_range(client):
+    # 跨越存储分块边界的区间
+    start = chunk_store.CHUNK_SIZE - 100
+    end = 2 * chunk_store.CHUNK_SIZE + 99
+    response = client.get('/download/stored.bin', headers={'Range': f'bytes={start}-{end}'})
+    assert response.status_code == 206
+    assert response.data == client.data[start:end + 1]
+    assert response.headers['Content-Range'] == f'bytes {start}-{end}/{SIZE}'
+
+
+def test_download_store_file_resume(client):
+    head = client.get('/download/stored.bin', headers={'Range': 'bytes=0-999'})
+    response = client.get('/download/stored.bin', headers={'Range': 'bytes=1000-',
+                                                            'If-Range': head.headers['ETag']})
+    assert response.status_code == 206
+    assert head.data + response.data == client.data
+
+
+def test_download_plain_file(client):
+    response = client.get('/download/plain.txt', headers={'Range': 'bytes=6-'})
+    assert response.status_code == 206
+    assert response.data == b'file'
+
+
+@pytest.mark.parametrize('path', [
+    '/download/..%2Fapp.py',
+    '/download/..',
+    '/download/.store',
+    '/download/.partial',
+    '/download/.store%2Fchunks',
+    '/download/missing.bin',
+])
+def test_download_rejects_hidden_and_outside_paths(client, app_module, path):
+    response = client.get(path)
+    assert response.status_code == 404
+    assert response.data != client.data
+
+
+def test_download_rejects_store_chunk(client, app_module):
+    # 直接按分块路径请求存储里的分块也不行
+    store = app_module.store
+    digest = store.get('stored.bin').chunks[0]
+    relative = os.path.relpath(store.chunk_path(digest), app_module.app.config['UPLOAD_FOLDER'])
+    response = client.get('/download/' + relative.replace(os.sep, '%2F'))
+    assert response.status_code == 404
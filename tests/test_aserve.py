@@ -0,0 +1,169 @@
+import asyncio
+import os
+import socket
+import threading
+
+import pytest
+
+import aserve
+import events
+
+
+def wsgi_app(environ, start_response):
+    path = environ['PATH_INFO']
+    if path == '/echo':
+        body = environ['wsgi.input'].read()
+        start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+    if path == '/file':
+        f = open(environ['QUERY_STRING'], 'rb')
+        start_response('200 OK', [('Content-Length', str(os.path.getsize(environ['QUERY_STRING'])))])
+        return environ['wsgi.file_wrapper'](f)
+    body = path.encode()
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+
+
+@pytest.fixture
+def server():
+    # 在后台线程的事件循环里运行服务器，监听随机端口
+    log = events.EventLog()
+
+    async def sse(request):
+        await request.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                            b'Transfer-Encoding: chunked\r\n\r\n')
+        async for frame in events.sse_stream_async(log, log.cursor(), keepalive=1, event_type='device'):
+            data = frame.encode()
+            await request.write(b'%x\r\n%b\r\n' % (len(data), data))
+        return False
+
+    ready = threading.Event()
+    instance = aserve.Server(wsgi_app, workers=4, routes={('GET', '/events'): sse}, stream_routes=['/events'])
+    thread = threading.Thread(target=asyncio.run,
+                              args=(instance.serve('127.0.0.1', 0, ready=lambda s: ready.set()),), daemon=True)
+    thread.start()
+    assert ready.wait(5)
+    instance.log = log
+    yield instance
+    instance.loop.call_soon_threadsafe(instance.stop)
+    thread.join(aserve.SHUTDOWN_GRACE + 5)
+
+
+def connect(server):
+    sock = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+    return sock, sock.makefile('rb')
+
+
+def read_response(f):
+    status = int(f.readline().split()[1])
+    headers = {}
+    while (line := f.readline()) not in (b'\r\n', b''):
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if 'content-length' in headers:
+        body = f.read(int(headers['content-length']))
+    elif headers.get('transfer-encoding') == 'chunked':
+        body = b''
+        while size := int(f.readline(), 16):
+            body += f.read(size)
+            f.readline()
+        f.readline()
+    else:
+        body = f.read()
+    return status, headers, body
+
+
+def test_chunked_request_body(server):
+    sock, f = connect(server)
+    with sock:
+        sock.sendall(b'POST /echo HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n'
+                     b'5\r\nhello\r\n7;ext=1\r\n, world\r\n0\r\nX-Trailer: 1\r\n\r\n')
+        status, headers, body = read_response(f)
+    assert status == 200
+    assert body == b'hello, world'
+    assert headers['connection'] == 'keep-alive'
+
+
+def test_pipelined_keep_alive(server):
+    # 一次发出三个请求，按顺序收到三个响应，连接保持
+    sock, f = connect(server)
+    with sock:
+        sock.sendall(b'GET /a HTTP/1.1\r\nHost: x\r\n\r\n'
+                     b'POST /echo HTTP/1.1\r\nHost: x\r\nContent-Length: 3\r\n\r\nabc'
+                     b'GET /b HTTP/1.1\r\nHost: x\r\n\r\n')
+        assert [read_response(f)[2] for _ in range(3)] == [b'/a', b'abc', b'/b']
+        sock.sendall(b'GET /c HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+        status, headers, body = read_response(f)
+        assert (status, body, headers['connection']) == (200, b'/c', 'close')
+        assert f.read() == b''
+
+
+@pytest.mark.parametrize('request_bytes', [
+    b'GET /\r\n\r\n',
+    b'GET / HTTP/2.0\r\n\r\n',
+    b'GET / HTTP/1.1\r\nno colon here\r\n\r\n',
+    b'POST /echo HTTP/1.1\r\nContent-Length: -1\r\n\r\n',
+    b'POST /echo HTTP/1.1\r\nContent-Length: abc\r\n\r\n',
+])
+def test_malformed_request(server, request_bytes):
+    sock, f = connect(server)
+    with sock:
+        sock.sendall(request_bytes)
+        status, headers, _ = read_response(f)
+    assert status == 400
+    assert headers['connection'] == 'close'
+
+
+def test_oversized_headers(server):
+    sock, f = connect(server)
+    with sock:
+        sock.sendall(b'GET / HTTP/1.1\r\nX-Big: ' + b'a' * (aserve.MAX_HEADER_SIZE + 1024) + b'\r\n\r\n')
+        status, _, _ = read_response(f)
+    assert status == 431
+
+
+def test_file_wrapper_uses_sendfile(server, tmp_path, monkeypatch):
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    path = tmp_path / 'data.bin'
+    path.write_bytes(data)
+    calls = []
+    sendfile = server.loop.sendfile
+
+    async def recording_sendfile(transport, f, offset, count):
+        calls.append((offset, count))
+        return await sendfile(transport, f, offset, count)
+
+    monkeypatch.setattr(server.loop, 'sendfile', recording_sendfile)
+    sock, f = connect(server)
+    with sock:
+        sock.sendall(f'GET /file?{path} HTTP/1.1\r\nHost: x\r\n\r\n'.encode())
+        status, headers, body = read_response(f)
+        assert status == 200
+        assert body == data
+        # sendfile 之后连接仍可继续使用
+        sock.sendall(b'GET /after HTTP/1.1\r\nHost: x\r\n\r\n')
+        assert read_response(f)[2] == b'/after'
+    assert calls == [(0, len(data))]
+
+
+def test_sse_stream(server):
+    sock, f = connect(server)
+    with sock:
+        sock.sendall(b'GET /events HTTP/1.1\r\nHost: x\r\n\r\n')
+        assert f.readline().startswith(b'HTTP/1.1 200')
+        while f.readline() != b'\r\n':
+            pass
+
+        def frame():
+            size = int(f.readline(), 16)
+            data = f.read(size)
+            f.readline()
+            return data.decode()
+
+        assert frame() == 'retry: 3000\n\n'
+        server.log.append({'type': 'join', 'device_id': 'd1'})
+        data = frame()
+        assert 'event: device' in data and '"device_id": "d1"' in data
+        # 没有事件时发送 keepalive 注释
+        assert frame() == ': keepalive\n\n'
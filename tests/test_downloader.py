@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+
+import pytest
+import requests
+from flask import Flask, request
+from werkzeug.serving import make_server
+
+import downloader
+import http_range
+
+SIZE = 50000
+# 4 段时每段的请求
+FULL_RANGES = ['bytes=0-12499', 'bytes=12500-24999', 'bytes=25000-37499', 'bytes=37500-49999']
+
+
+@pytest.fixture
+def server(tmp_path):
+    # 真实的 HTTP 服务器，downloader 通过 requests 连接；记录每个 GET 的 Range/If-Range
+    path = tmp_path / 'source.bin'
+    path.write_bytes(os.urandom(SIZE))
+    requests_seen = []
+    app = Flask(__name__)
+
+    @app.route('/source.bin', methods=['GET', 'HEAD'])
+    def source():
+        if request.method == 'GET':
+            requests_seen.append((request.headers.get('Range'), request.headers.get('If-Range')))
+        return http_range.send_path(str(path))
+
+    httpd = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.path = path
+    httpd.url = f'http://127.0.0.1:{httpd.server_port}/source.bin'
+    httpd.requests_seen = requests_seen
+    yield httpd
+    httpd.shutdown()
+    thread.join()
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    monkeypatch.setattr(downloader, 'MIN_SEGMENT_SIZE', 8192)
+
+
+def test_segmented_download(server, tmp_path):
+    dest = str(tmp_path / 'out.bin')
+    result = downloader.segmented_download(server.url, dest, segments=4)
+    with open(dest, 'rb') as f:
+        assert f.read() == server.path.read_bytes()
+    assert result['segments'] == 4
+    assert result['resumed_bytes'] == 0
+    assert not os.path.exists(dest + '.part')
+    assert not os.path.exists(dest + '.part.json')
+    assert sorted(r for r, _ in server.requests_seen) == FULL_RANGES
+
+
+def _interrupted(dest, data, etag, done):
+    # 模拟中断的下载：每段已经写了 done 字节，进度保存在 .part.json
+    segments = downloader._plan(len(data), 4)
+    with open(dest + '.part', 'wb') as f:
+        f.truncate(len(data))
+        for segment in segments:
+            f.seek(segment[0])
+            f.write(data[segment[0]:segment[0] + done])
+            segment[1] = segment[0] + done
+    with open(dest + '.part.json', 'w') as f:
+        json.dump({'etag': etag, 'size': len(data), 'segments': segments}, f)
+    return segments
+
+
+def test_resume_from_part_json(server, tmp_path):
+    dest = str(tmp_path / 'out.bin')
+    data = server.path.read_bytes()
+    etag = requests.head(server.url).headers['ETag']
+    segments = _interrupted(dest, data, etag, 5000)
+
+    result = downloader.segmented_download(server.url, dest, segments=4)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert result['resumed_bytes'] == 4 * 5000
+    # 只请求每段剩下的部分，并用 If-Range 确认文件没有变化
+    assert sorted(server.requests_seen) == sorted(
+        (f'bytes={start + 5000}-{stop - 1}', etag) for start, _, stop in segments)
+    assert not os.path.exists(dest + '.part.json')
+
+
+def test_resume_skips_finished_segments(server, tmp_path):
+    dest = str(tmp_path / 'out.bin')
+    data = server.path.read_bytes()
+    etag = requests.head(server.url).headers['ETag']
+    _interrupted(dest, data, etag, 12500)
+
+    result = downloader.segmented_download(server.url, dest, segments=4)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert result['resumed_bytes'] == SIZE
+    assert server.requests_seen == []
+
+
+def test_changed_file_restarts(server, tmp_path):
+    # 保存的 ETag 与服务器不一致时丢弃旧进度，从头下载
+    dest = str(tmp_path / 'out.bin')
+    data = server.path.read_bytes()
+    _interrupted(dest, b'x' * SIZE, '"stale"', 5000)
+
+    result = downloader.segmented_download(server.url, dest, segments=4)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert result['resumed_bytes'] == 0
+    assert sorted(r for r, _ in server.requests_seen) == FULL_RANGES
+
+
+def test_file_changed_during_download(server, tmp_path, monkeypatch):
+    # HEAD 之后服务器上的文件被替换：If-Range 不匹配返回 200，下载失败并保留进度
+    dest = str(tmp_path / 'out.bin')
+    head = requests.Session.head
+
+    def head_then_replace(self, *args, **kwargs):
+        response = head(self, *args, **kwargs)
+        server.path.write_bytes(os.urandom(SIZE))
+        os.utime(server.path, (1, 1))
+        return response
+
+    monkeypatch.setattr(requests.Session, 'head', head_then_replace)
+    with pytest.raises(downloader.DownloadError):
+        downloader.segmented_download(server.url, dest, segments=4)
+    assert os.path.exists(dest + '.part.json')
+    assert not os.path.exists(dest)
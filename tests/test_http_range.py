@@ -0,0 +1,157 @@
+import os
+
+import pytest
+from flask import Flask
+
+import chunk_store
+import http_range
+
+SIZE = 10000
+
+
+@pytest.fixture(params=['file', 'store'])
+def client(request, tmp_path):
+    # 普通文件走 send_path，去重存储中的文件走 ManifestReader
+    mode = request.param
+    data = os.urandom(SIZE)
+    path = tmp_path / 'data.bin'
+    path.write_bytes(data)
+    store = chunk_store.ChunkStore(str(tmp_path / '.store'), chunk_size=4096)
+    writer = store.writer()
+    writer.write(data)
+    manifest = writer.commit('data.bin', os.path.getmtime(path))
+
+    app = Flask(__name__)
+
+    @app.route('/download')
+    def download():
+        if mode == 'store':
+            return http_range.send_ranges(chunk_store.ManifestReader(store, manifest), manifest.size,
+                                          manifest.mtime, 'data.bin')
+        return http_range.send_path(str(path))
+
+    test_client = app.test_client()
+    test_client.data = data
+    return test_client
+
+
+def test_full_download(client):
+    response = client.get('/download')
+    assert response.status_code == 200
+    assert response.data == client.data
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['Content-Length'] == str(SIZE)
+
+
+def test_single_range(client):
+    response = client.get('/download', headers={'Range': 'bytes=100-4195'})
+    assert response.status_code == 206
+    assert response.data == client.data[100:4196]
+    assert response.headers['Content-Range'] == f'bytes 100-4195/{SIZE}'
+    assert response.headers['Content-Length'] == '4096'
+
+
+def test_open_ended_range(client):
+    response = client.get('/download', headers={'Range': 'bytes=9000-'})
+    assert response.status_code == 206
+    assert response.data == client.data[9000:]
+    assert response.headers['Content-Range'] == f'bytes 9000-{SIZE - 1}/{SIZE}'
+
+
+def test_suffix_range(client):
+    response = client.get('/download', headers={'Range': 'bytes=-500'})
+    assert response.status_code == 206
+    assert response.data == client.data[-500:]
+    assert response.headers['Content-Range'] == f'bytes {SIZE - 500}-{SIZE - 1}/{SIZE}'
+
+
+def test_suffix_longer_than_file(client):
+    response = client.get('/download', headers={'Range': f'bytes=-{SIZE * 2}'})
+    assert response.status_code == 206
+    assert response.data == client.data
+
+
+def test_multiple_ranges(client):
+    response = client.get('/download', headers={'Range': 'bytes=8000-8099, 0-9, 4090-4105'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    boundary = response.mimetype_params['boundary']
+    # 区间按偏移排序返回
+    expected = b''.join(
+        f'\r\n--{boundary}\r\nContent-Type: application/octet-stream\r\n'
+        f'Content-Range: bytes {start}-{stop - 1}/{SIZE}\r\n\r\n'.encode() + client.data[start:stop]
+        for start, stop in [(0, 10), (4090, 4106), (8000, 8100)]
+    ) + f'\r\n--{boundary}--\r\n'.encode()
+    assert response.data == expected
+    assert response.headers['Content-Length'] == str(len(expected))
+
+
+def test_overlapping_ranges_are_merged(client):
+    response = client.get('/download', headers={'Range': 'bytes=0-99, 50-199'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 0-199/{SIZE}'
+    assert response.data == client.data[:200]
+
+
+@pytest.mark.parametrize('value', [f'bytes={SIZE}-', f'bytes={SIZE + 10}-{SIZE + 20}', 'bytes=-0'])
+def test_unsatisfiable_range(client, value):
+    response = client.get('/download', headers={'Range': value})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{SIZE}'
+    assert response.data == b''
+
+
+@pytest.mark.parametrize('value', ['items=0-10', 'bytes=abc', 'bytes=20-10'])
+def test_invalid_range_is_ignored(client, value):
+    response = client.get('/download', headers={'Range': value})
+    assert response.status_code == 200
+    assert response.data == client.data
+
+
+def test_if_none_match(client):
+    etag = client.get('/download').headers['ETag']
+    response = client.get('/download', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+    assert client.get('/download', headers={'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_if_modified_since(client):
+    last_modified = client.get('/download').headers['Last-Modified']
+    assert client.get('/download', headers={'If-Modified-Since': last_modified}).status_code == 304
+
+
+def test_if_match(client):
+    etag = client.get('/download').headers['ETag']
+    response = client.get('/download', headers={'If-Match': '"other"'})
+    assert response.status_code == 412
+    assert response.data == b''
+    response = client.get('/download', headers={'If-Match': etag, 'Range': 'bytes=0-9'})
+    assert response.status_code == 206
+    assert response.data == client.data[:10]
+
+
+def test_if_unmodified_since(client):
+    response = client.get('/download', headers={'If-Unmodified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+    assert response.status_code == 412
+
+
+def test_if_range_match(client):
+    etag = client.get('/download').headers['ETag']
+    response = client.get('/download', headers={'Range': 'bytes=10-19', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.data == client.data[10:20]
+
+
+@pytest.mark.parametrize('if_range', ['"other"', 'W/"other"', 'Thu, 01 Jan 1970 00:00:00 GMT'])
+def test_if_range_mismatch_sends_full_file(client, if_range):
+    response = client.get('/download', headers={'Range': 'bytes=10-19', 'If-Range': if_range})
+    assert response.status_code == 200
+    assert response.data == client.data
+
+
+def test_if_range_weak_etag_sends_full_file(client):
+    etag = client.get('/download').headers['ETag']
+    response = client.get('/download', headers={'Range': 'bytes=10-19', 'If-Range': 'W/' + etag})
+    assert response.status_code == 200
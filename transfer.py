@@ -0,0 +1,515 @@
+import mmap
+import os
+import socket
+import threading
+import time
+
+import compression
+import delta
+import integrity
+from netio import (
+    BUFFER_SIZE, TransferError, pwrite, tune_socket, send_header, recv_header, send_file, connect, notify_done,
+)
+
+# 传输引擎：发送端走 socket.sendfile（Linux 上即 os.sendfile 零拷贝），
+# 接收端用预分配缓冲区 recv_into，避免每次 recv 都分配新的 bytes 对象。
+# 接收的数据先写入同目录下的 <文件名>.part（见 FileSink），全部收完并校验通过后再原子地改名
+
+# 并行传输的连接数
+DEFAULT_STREAMS = int(os.environ.get('EREVENT_STREAMS', 4))
+MAX_STREAMS = 16
+# 小于该大小的分段不再拆分
+MIN_STREAM_SIZE = 16 * 1024 * 1024
+# 发送端等待接收端连接的超时时间
+ACCEPT_TIMEOUT = 600
+# 接收端开始连接后，发送端在没有新连接时的空闲超时
+IDLE_TIMEOUT = 60
+# 读取控制头的超时时间
+HEADER_TIMEOUT = 10
+# 校验失败的分块最多重传几轮
+MAX_RETRANSMITS = 3
+# 接收端写文件的方式：pwrite 从复用的缓冲区按偏移写入；mmap 把 .part 文件映射进内存，
+# recv_into 直接收进映射区，省去一次复制
+RECEIVE_MODE = os.environ.get('EREVENT_RECEIVE_MODE', 'pwrite')
+PART_SUFFIX = '.part'
+# 流水线发送时的内存环形缓冲区大小
+RING_BUFFER_SIZE = int(os.environ.get('EREVENT_RING_BUFFER_SIZE', 16 * 1024 * 1024))
+
+
+def plan_ranges(size, streams, align=integrity.CHUNK_SIZE):
+    # 把文件切成最多 streams 段，每段不小于 MIN_STREAM_SIZE，
+    # 分段边界对齐到校验分块，便于每个连接独立校验
+    streams = max(1, min(streams, MAX_STREAMS, -(-size // MIN_STREAM_SIZE)))
+    step = -(-size // streams) if size else 0
+    step = -(-step // align) * align
+    ranges = []
+    offset = 0
+    while offset < size:
+        length = min(step, size - offset)
+        ranges.append((offset, length))
+        offset += length
+    return ranges or [(0, 0)]
+
+
+def recv_to_file(sock, f, size=None, buffer_size=BUFFER_SIZE):
+    # size 为 None 时一直读到对端关闭连接
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    received = 0
+    while size is None or received < size:
+        want = buffer_size if size is None else min(buffer_size, size - received)
+        n = sock.recv_into(view, want)
+        if not n:
+            break
+        f.write(view[:n])
+        received += n
+    if size is not None and received != size:
+        raise TransferError(f'接收不完整: {received}/{size} 字节')
+    return received
+
+
+def recv_to_fd(sock, fd, offset, length, buffer_size=BUFFER_SIZE, hasher=None, throttle=None, buf=None):
+    # 把 length 字节写到 fd 的 offset 处，缓冲区在整个区间内复用；
+    # 传入 hasher 时在同一缓冲区上顺带计算分块摘要，throttle 与 send_file 相同；
+    # buf 为调用方复用的缓冲区（见 BufferPool），不提供时为该区间分配一个
+    if buf is None:
+        buf = bytearray(min(buffer_size, max(length, 1)))
+    view = memoryview(buf)
+    received = 0
+    while received < length:
+        n = sock.recv_into(view, min(len(buf), length - received))
+        if not n:
+            raise TransferError(f'接收不完整: {received}/{length} 字节')
+        pwrite(fd, view[:n], offset + received)
+        if hasher is not None:
+            hasher.update(view[:n])
+        if throttle is not None:
+            throttle(n)
+        received += n
+    return received
+
+
+def recv_into_view(sock, view, hasher=None, throttle=None):
+    # 直接收进调用方给出的内存（如 mmap 映射区），不经过中间缓冲区
+    received = 0
+    length = len(view)
+    while received < length:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise TransferError(f'接收不完整: {received}/{length} 字节')
+        if hasher is not None:
+            hasher.update(view[received:received + n])
+        if throttle is not None:
+            throttle(n)
+        received += n
+    return received
+
+
+def trailer(digests, offset, length, chunk_size):
+    # 区间数据之后附带该区间内各分块的摘要
+    first = offset // chunk_size
+    last = -(-(offset + length) // chunk_size)
+    return {'chunks': {str(i): digests[i] for i in range(first, last) if i in digests}}
+
+
+def send_trailer(sock, digests, offset, length, chunk_size):
+    send_header(sock, trailer(digests, offset, length, chunk_size))
+
+
+def check_trailer(received, hasher):
+    # 返回 (校验失败的分块序号, 发送端没有提供摘要、无法校验的分块数)
+    expected = received.get('chunks', {})
+    digests = hasher.finish()
+    bad = [i for i, d in digests.items() if str(i) in expected and expected[str(i)] != d]
+    return bad, sum(1 for i in digests if str(i) not in expected)
+
+
+def verify_trailer(sock, hasher):
+    return check_trailer(recv_header(sock), hasher)
+
+
+def preallocate(fd, size):
+    # 预分配完整大小，各连接按偏移写入
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+
+class BufferPool:
+    # 接收缓冲区池：每个连接取一个，用完放回，同一个文件的各连接、各轮重传共用；
+    # allocated 为实际分配过的缓冲区个数
+    def __init__(self, size=BUFFER_SIZE):
+        self.size = size
+        self.allocated = 0
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buf):
+        with self._lock:
+            self._free.append(buf)
+
+
+class FileSink:
+    # 接收端的目标文件：先写入 <path>.part 并预分配完整大小，各连接按偏移写入，顺序任意；
+    # 全部完成后 commit() 落盘并原子地改名为 path，目标路径上要么是旧文件、要么是完整的新文件；
+    # 失败时 abort() 删除 .part
+    def __init__(self, path, size, mode=RECEIVE_MODE, buffer_size=BUFFER_SIZE):
+        self.path = path
+        self.part_path = path + PART_SUFFIX
+        self.size = size
+        self.buffers = BufferPool(min(buffer_size, max(size, 1)))
+        self.map = None
+        self.fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+        try:
+            preallocate(self.fd, size)
+            # 空文件无法映射
+            if mode == 'mmap' and size:
+                self.map = mmap.mmap(self.fd, size)
+        except Exception:
+            self._close()
+            os.remove(self.part_path)
+            raise
+        self.mode = 'mmap' if self.map is not None else 'pwrite'
+
+    def write(self, data, offset):
+        if offset < 0 or offset + len(data) > self.size:
+            raise TransferError('数据超出声明的文件大小')
+        if self.map is not None:
+            self.map[offset:offset + len(data)] = data
+        else:
+            pwrite(self.fd, data, offset)
+        return len(data)
+
+    def recv_range(self, sock, offset, length, hasher=None, throttle=None):
+        # 从套接字接收 length 字节写到 offset 处
+        if offset < 0 or offset + length > self.size:
+            raise TransferError('数据超出声明的文件大小')
+        if self.map is not None:
+            view = memoryview(self.map)[offset:offset + length]
+            try:
+                return recv_into_view(sock, view, hasher, throttle)
+            finally:
+                view.release()
+        buf = self.buffers.acquire()
+        try:
+            return recv_to_fd(sock, self.fd, offset, length, hasher=hasher, throttle=throttle, buf=buf)
+        finally:
+            self.buffers.release(buf)
+
+    def commit(self):
+        if self.map is not None:
+            self.map.flush()
+        os.fsync(self.fd)
+        self._close()
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        self._close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def _close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 没有 commit 就离开（出错）时丢弃 .part
+        if self.fd is not None:
+            self.abort()
+
+
+class RingBuffer:
+    # 有界的单生产者/单消费者字节环：写满时 write 阻塞，读空时消费者阻塞，
+    # 任一端出错都会让另一端立即抛出异常
+    def __init__(self, capacity=RING_BUFFER_SIZE):
+        self.buf = bytearray(capacity)
+        self.capacity = capacity
+        self.start = 0
+        self.length = 0
+        self.closed = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            with self.cond:
+                while self.length == self.capacity and self.error is None:
+                    self.cond.wait()
+                if self.error is not None:
+                    raise TransferError(f'发送中断: {self.error}')
+                end = (self.start + self.length) % self.capacity
+                n = min(len(view), self.capacity - self.length, self.capacity - end)
+                self.buf[end:end + n] = view[:n]
+                self.length += n
+                self.cond.notify_all()
+            view = view[n:]
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def abort(self, error):
+        with self.cond:
+            self.error = error
+            self.cond.notify_all()
+
+    def send_to(self, sock):
+        # 消费者：把缓冲区中连续的一段直接发给套接字，返回 0 表示已结束
+        with self.cond:
+            while self.length == 0 and not self.closed and self.error is None:
+                self.cond.wait()
+            if self.error is not None:
+                raise TransferError(f'读取中断: {self.error}')
+            if self.length == 0:
+                return 0
+            n = min(self.length, self.capacity - self.start)
+            view = memoryview(self.buf)[self.start:self.start + n]
+        # 发送时不持锁，生产者只会写入空闲区域
+        sent = sock.send(view)
+        view.release()
+        with self.cond:
+            self.start = (self.start + sent) % self.capacity
+            self.length -= sent
+            self.cond.notify_all()
+        return sent
+
+
+def accept_request(server_socket, timeout):
+    # 等待一个数据连接并读取其控制头，超时返回 None
+    server_socket.settimeout(timeout)
+    try:
+        conn, _ = server_socket.accept()
+    except socket.timeout:
+        return None
+    try:
+        conn.settimeout(HEADER_TIMEOUT)
+        header = recv_header(conn)
+        conn.settimeout(None)
+    except (OSError, ValueError, TransferError) as e:
+        # 单个连接的控制头出错不影响监听套接字
+        conn.close()
+        raise TransferError(f'读取控制头失败: {e}')
+    return conn, header
+
+
+def pipe_to_socket(chunks, conn, size, ring_size=RING_BUFFER_SIZE, hasher=None, throttle=None):
+    # 流水线发送：调用线程把 chunks 写入环形缓冲区，后台线程同时把数据发往对端。
+    # 传入 hasher 时在写入缓冲区前顺带计算分块摘要。size 为 None 时不检查总长度
+    # （例如压缩后的帧，由生成帧的一方检查）。返回 (首字节耗时, 总耗时)
+    ring = RingBuffer(ring_size if size is None else min(ring_size, max(size, 1)))
+    start = time.perf_counter()
+    first_byte = []
+    errors = []
+
+    def drain():
+        try:
+            sent_total = 0
+            while True:
+                sent = ring.send_to(conn)
+                if not sent:
+                    break
+                if throttle is not None:
+                    throttle(sent)
+                if not first_byte:
+                    first_byte.append(time.perf_counter() - start)
+                sent_total += sent
+            if size is not None and sent_total != size:
+                raise TransferError(f'发送不完整: {sent_total}/{size} 字节')
+        except Exception as e:
+            errors.append(e)
+            ring.abort(e)
+
+    sender = threading.Thread(target=drain, daemon=True)
+    sender.start()
+    written = 0
+    try:
+        for chunk in chunks:
+            written += len(chunk)
+            if size is not None and written > size:
+                raise TransferError('数据超出声明的文件大小')
+            if hasher is not None:
+                hasher.update(chunk)
+            ring.write(chunk)
+    except Exception as e:
+        ring.abort(e)
+        sender.join()
+        raise
+    ring.close()
+    sender.join()
+    if errors:
+        raise TransferError(str(errors[0]))
+    return (first_byte[0] if first_byte else 0), time.perf_counter() - start
+
+
+def serve_request(conn, f, header, hasher=None, throttle=None):
+    # 处理一个数据连接的请求（区间或增量），参数同 serve_file
+    if header.get('op') == 'range':
+        offset, length = int(header['offset']), int(header['length'])
+        if header.get('compression'):
+            # 接收端选择了压缩，按块自适应压缩后分帧发送
+            level = int(header['level']) if header.get('level') is not None else None
+            encoder = compression.AdaptiveEncoder(header['compression'], level)
+            compression.send_range(conn, f, offset, length, encoder, throttle)
+        else:
+            send_file(conn, f, offset, length, throttle)
+        if header.get('checksums'):
+            if hasher is not None:
+                send_trailer(conn, hasher.digests, offset, length, hasher.chunk_size)
+            else:
+                send_header(conn, {'chunks': {}})
+    elif header.get('op') == 'delta':
+        # 接收端已有旧版本时只发送差异部分
+        delta.serve_delta(conn, f, header, hasher)
+    else:
+        raise TransferError(f"未知的控制操作: {header.get('op')}")
+
+
+def serve_file(server_socket, path, accept_timeout=ACCEPT_TIMEOUT, idle_timeout=IDLE_TIMEOUT, hasher=None,
+               pending=None, throttle=None):
+    # 发送端：在监听套接字上为每个连接回送其请求的区间，直到收到 done 或超时。
+    # hasher 为发送前已算好的分块摘要，接收端要求时随区间一起发送；
+    # pending 为调用方已经接受并读取了控制头的连接 (conn, header)；
+    # throttle 在各连接线程中调用，需要线程安全
+    finished = threading.Event()
+    errors = []
+    workers = []
+
+    def handle(conn, header):
+        try:
+            with conn, open(path, 'rb') as f:
+                serve_request(conn, f, header, hasher, throttle)
+        except (OSError, ValueError, KeyError, TransferError) as e:
+            errors.append(e)
+
+    timeout = accept_timeout
+    try:
+        while not finished.is_set():
+            # 控制头在接受循环里读取，这样收到 done 后可以立即结束监听
+            try:
+                request = pending or accept_request(server_socket, timeout)
+                pending = None
+            except TransferError as e:
+                errors.append(e)
+                continue
+            if request is None:
+                break
+            timeout = idle_timeout
+            conn, header = request
+            if header.get('op') == 'done':
+                conn.close()
+                if not header.get('ok', True):
+                    errors.append(TransferError('接收端报告传输失败'))
+                finished.set()
+                break
+            tune_socket(conn)
+            worker = threading.Thread(target=handle, args=(conn, header), daemon=True)
+            worker.start()
+            workers.append(worker)
+    finally:
+        for worker in workers:
+            worker.join()
+    if not finished.is_set():
+        raise TransferError(str(errors[0]) if errors else '等待接收端连接超时')
+    if errors:
+        raise TransferError(str(errors[0]))
+
+
+def receive_file(host, port, path, size, streams=DEFAULT_STREAMS, buffer_size=BUFFER_SIZE, checksum=None,
+                 throttle=None, codecs=None, mode=RECEIVE_MODE):
+    # 接收端：按区间开 streams 个连接并行下载，写入预分配的 .part 文件，成功后改名为 path。
+    # checksum 为 file_info 中协商的校验参数，提供时边收边校验，只重传校验失败的分块；
+    # codecs 为 file_info 中发送端提供的压缩算法，选中一个时请求压缩传输
+    checksum = integrity.negotiate(checksum)
+    compress = compression.negotiate(codecs)
+    chunk_size = checksum['chunk_size'] if checksum else integrity.CHUNK_SIZE
+    ranges = plan_ranges(size, streams, align=chunk_size)
+    errors = []
+    bad_chunks = []
+    digests = {}
+    unverified = []
+    retransmitted = 0
+    sink = FileSink(path, size, mode, buffer_size)
+    try:
+        def fetch(offset, length):
+            try:
+                with connect(host, port) as s:
+                    tune_socket(s)
+                    header = {'op': 'range', 'offset': offset, 'length': length}
+                    hasher = None
+                    if checksum:
+                        header['checksums'] = True
+                        hasher = integrity.ChunkHasher(checksum['algorithm'], chunk_size, offset // chunk_size)
+                    if compress:
+                        header.update(compress)
+                    send_header(s, header)
+                    if compress:
+                        compression.recv_range(s, sink, offset, length, compress['compression'], hasher, throttle)
+                    else:
+                        sink.recv_range(s, offset, length, hasher, throttle)
+                    if hasher is not None:
+                        bad, missing = verify_trailer(s, hasher)
+                        bad_chunks.extend(bad)
+                        unverified.append(missing)
+                        digests.update(hasher.digests)
+            except (OSError, ValueError, TransferError) as e:
+                errors.append(e)
+
+        def fetch_all(ranges):
+            threads = [threading.Thread(target=fetch, args=r, daemon=True) for r in ranges[1:]]
+            for t in threads:
+                t.start()
+            fetch(*ranges[0])
+            for t in threads:
+                t.join()
+
+        fetch_all(ranges)
+        for _ in range(MAX_RETRANSMITS):
+            if errors or not bad_chunks:
+                break
+            # 只重新请求校验失败的分块
+            retry = sorted(set(bad_chunks))
+            bad_chunks.clear()
+            retransmitted += len(retry)
+            fetch_all([(i * chunk_size, min(chunk_size, size - i * chunk_size)) for i in retry])
+        if not errors and bad_chunks:
+            errors.append(TransferError(f'{len(set(bad_chunks))} 个分块多次校验失败'))
+        if not errors and checksum and checksum.get('digest'):
+            if integrity.combine((digests[i] for i in sorted(digests)), checksum['algorithm']) != checksum['digest']:
+                errors.append(TransferError('文件整体校验失败'))
+        if not errors:
+            try:
+                sink.commit()
+            except OSError as e:
+                errors.append(TransferError(f'保存文件失败: {e}'))
+    finally:
+        if errors or sink.fd is not None:
+            sink.abort()
+        notify_done(host, port, not errors)
+    if errors:
+        raise TransferError(f'接收失败: {errors[0]}')
+    return {
+        'size': size,
+        'verified': bool(checksum) and not any(unverified),
+        'retransmitted_chunks': retransmitted,
+        'compression': compress['compression'] if compress else None
+    }
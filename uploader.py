@@ -0,0 +1,146 @@
+import argparse
+import os
+import threading
+import time
+
+import requests
+
+import batch
+import chunk_store
+
+# 去重上传：先在本地按服务器的分块大小计算每块的 SHA-256，
+# 通过 /api/store/check 询问服务器缺少哪些分块，只上传这些，最后提交清单。
+# 服务器上已有相同内容（其他设备上传过，或者上次上传中断）时几乎不需要传输数据。
+# 上传目录时所有文件作为一个 batch 数据流在一次请求中发送（/upload/batch）
+
+DEFAULT_PARALLEL = 4
+CHECK_BATCH = 1000
+
+
+class UploadError(Exception):
+    pass
+
+
+def _chunk_digests(path, chunk_size):
+    digests = []
+    with open(path, 'rb') as f:
+        while data := f.read(chunk_size):
+            digests.append(chunk_store.chunk_digest(data))
+    return digests
+
+
+def _missing(session, base_url, digests, timeout):
+    missing = []
+    for start in range(0, len(digests), CHECK_BATCH):
+        response = session.post(f'{base_url}/api/store/check',
+                                json={'chunks': digests[start:start + CHECK_BATCH]}, timeout=timeout)
+        response.raise_for_status()
+        missing.extend(response.json()['missing'])
+    return set(missing)
+
+
+def dedup_upload(base_url, path, filename=None, parallel=DEFAULT_PARALLEL, session=None, timeout=30, retries=3):
+    session = session or requests.Session()
+    base_url = base_url.rstrip('/')
+    stats = session.get(f'{base_url}/api/store/stats', timeout=timeout)
+    stats.raise_for_status()
+    stats = stats.json()
+    if not stats.get('enabled'):
+        raise UploadError('服务器未启用去重存储')
+    if stats['chunk_size'] != chunk_store.CHUNK_SIZE or stats['algorithm'] != chunk_store.ALGORITHM:
+        raise UploadError('服务器的分块参数与本地不一致')
+
+    start_time = time.perf_counter()
+    chunk_size = stats['chunk_size']
+    size = os.path.getsize(path)
+    digests = _chunk_digests(path, chunk_size)
+    missing = _missing(session, base_url, digests, timeout)
+    # 同一内容的分块只上传一次
+    pending = []
+    for index, digest in enumerate(digests):
+        if digest in missing:
+            missing.discard(digest)
+            pending.append((index, digest))
+    uploaded = sum(min(chunk_size, size - index * chunk_size) for index, _ in pending)
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        with open(path, 'rb') as f:
+            while True:
+                with lock:
+                    if not pending or errors:
+                        return
+                    index, digest = pending.pop()
+                f.seek(index * chunk_size)
+                data = f.read(chunk_size)
+                for attempt in range(1, retries + 1):
+                    try:
+                        response = session.put(f'{base_url}/api/store/chunk/{digest}', data=data, timeout=timeout)
+                        response.raise_for_status()
+                        break
+                    except requests.RequestException as e:
+                        if attempt == retries:
+                            errors.append(e)
+                            return
+                        time.sleep(0.5 * attempt)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, parallel))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+    response = session.post(f'{base_url}/api/store/commit', json={
+        'filename': filename or os.path.basename(path),
+        'size': size,
+        'chunks': digests,
+    }, timeout=timeout)
+    if response.status_code != 200:
+        raise UploadError(f'提交失败: {response.text}')
+    elapsed = time.perf_counter() - start_time
+    return {
+        'size': size,
+        'uploaded_bytes': uploaded,
+        'skipped_bytes': size - uploaded,
+        'elapsed': elapsed,
+    }
+
+
+def batch_upload(base_url, path, session=None, timeout=300):
+    session = session or requests.Session()
+    start_time = time.perf_counter()
+    entries, count, size = batch.scan(path)
+    # 生成器作为请求体，以 chunked 编码边读边发
+    response = session.post(f"{base_url.rstrip('/')}/upload/batch", data=batch.iter_stream(entries),
+                            headers={'Content-Type': batch.CONTENT_TYPE}, timeout=timeout)
+    if response.status_code != 200:
+        raise UploadError(f'批量上传失败: {response.text}')
+    return {
+        'count': count,
+        'size': size,
+        'elapsed': time.perf_counter() - start_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ER-Event 去重上传')
+    parser.add_argument('server', help='例如 http://192.168.1.10:5000')
+    parser.add_argument('path', help='文件，或者目录（整个目录在一次请求中上传）')
+    parser.add_argument('-n', '--name')
+    parser.add_argument('-p', '--parallel', type=int, default=DEFAULT_PARALLEL)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.path):
+        result = batch_upload(args.server, args.path)
+        print(f"上传完成: {result['count']} 个文件, {result['size']} 字节, 用时 {result['elapsed']:.1f} 秒")
+        return
+    result = dedup_upload(args.server, args.path, filename=args.name, parallel=args.parallel)
+    print(f"上传完成: {result['size']} 字节, 实际发送 {result['uploaded_bytes']} 字节, "
+          f"跳过 {result['skipped_bytes']} 字节, 用时 {result['elapsed']:.1f} 秒")
+
+
+if __name__ == '__main__':
+    main()